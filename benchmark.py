@@ -0,0 +1,237 @@
+#!/usr/bin/python3
+"""
+Micro benchmarks for the tool internals. Does not need root or a device.
+
+Usage:
+
+  ./benchmark.py [NAME]...
+
+##License:
+Original work Copyright 2016 Richard Case
+
+Everyone is permitted to copy, distribute and modify this software,
+subject to this statement and the copyright notice above being included.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND.
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
+"""
+import sys, os, time, random, io, tracemalloc, tempfile, shutil, types
+from bisect import bisect_right
+from extents import ExtentStore
+from btrace import BtraceParser, Extent
+import getused, fiemap, extentops
+
+def random_extents(count, seed=1):
+    "Returns a list of small (start, n) extents scattered over a 20TB disk."
+    rand = random.Random(seed)
+    disk = 20 * 2**40 // 512
+    return [(rand.randrange(disk), rand.choice((8, 8, 8, 16, 64, 256)))
+                for _ in range(count)]
+
+def timed(label, func, *args):
+    "Runs func(*args) printing and returning the elapsed time."
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    print('{:<40} {:>9.3f} s'.format(label, elapsed))
+    return elapsed, result
+
+def _fill_store(elist):
+    store = ExtentStore()
+    for start, n in elist:
+        store.add(start, n)
+    return store
+
+def _fill_list(elist):
+    "Baseline: sorted list insert & start list rebuild per extent, no merging."
+    extents, start_sectors = [], []
+    for start, n in elist:
+        i = bisect_right(start_sectors, start)
+        extents.insert(i, (start, n))
+        start_sectors = [data[0] for data in extents]
+    return extents
+
+def bench_extentstore():
+    "ExtentStore.add against the previous sorted list approach."
+    for count in (5000, 10000, 20000):
+        elist = random_extents(count)
+        t_list = timed('list insert+rebuild {} extents'.format(count),
+                        _fill_list, elist)[0]
+        t_store = timed('ExtentStore.add {} extents'.format(count),
+                        _fill_store, elist)[0]
+        print('{:<40} {:>9.1f} x'.format('speedup', t_list / t_store))
+    for count in (100000, 1000000):
+        elist = random_extents(count)
+        t_store, store = timed('ExtentStore.add {} extents'.format(count),
+                        _fill_store, elist)
+        print('{:<40} {:>9.2f} us'.format('per extent', 1e6 * t_store / count))
+        timed('ExtentStore.tolist {} runs'.format(len(store)), store.tolist)
+
+def synthetic_trace(count, seed=1):
+    "Returns (binary blktrace stream, equivalent blkparse text) of Q,D,C reads."
+    trace = BtraceParser.trace_struct
+    read = 1 << 16
+    raw = [trace.pack(BtraceParser.trace_magic | 7, 0, 0, 0, 0,
+                BtraceParser.BLK_TC_NOTIFY, 1000, 0, 0, 0, 8) + b'fsck\0\0\0\0']
+    text = []
+    line = '  8,16   0 {:8d} {:12.9f}  1000  {}   R {} + {} [{}]\n'
+    for i, (start, n) in enumerate(random_extents(count // 3, seed)):
+        for code, act, last in ((1, 'Q', 'fsck'), (7, 'D', 'fsck'), (8, 'C', '0')):
+            raw.append(trace.pack(BtraceParser.trace_magic | 7, i, i, start,
+                        n * 512, code | read, 1000, 0, 0, 0, 0))
+            text.append(line.format(i, i / 1e9, act, start, n, last))
+    return b''.join(raw), ''.join(text)
+
+def _parse_trace(source):
+    parser = BtraceParser(source)
+    parser.read_btrace()
+    return parser
+
+def bench_rawtrace():
+    "Binary blk_io_trace ingestion against blkparse text parsing."
+    count = 300000
+    raw, text = synthetic_trace(count)
+    t_text, p_text = timed('blkparse text {} events'.format(count), _parse_trace,
+                        io.TextIOWrapper(io.BytesIO(text.encode('ascii'))))
+    t_raw, p_raw = timed('blktrace binary {} events'.format(count), _parse_trace,
+                        io.BufferedReader(io.BytesIO(raw)))
+    print('{:<40} {:>9.1f} x'.format('speedup', t_text / t_raw))
+    if p_text.stats != p_raw.stats or p_text.extents != p_raw.extents:
+        sys.exit('Binary and text parsing disagree!')
+
+def measured(func, *args):
+    "Returns (bytes still allocated by func's result, result)."
+    tracemalloc.start()
+    result = func(*args)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size, result
+
+def _tuple_lists(count):
+    "The previous representation: sorted tuple list plus start sector list."
+    extents = sorted(random_extents(count))
+    return extents, [data[0] for data in extents]
+
+class _DictExtent(object):
+    "Extent without __slots__ for comparison."
+    def __init__(self, start, n):
+        self.start = int(start)
+        self.n = int(n)
+        self.next = self.start + self.n
+        self.end = self.next - 1
+
+def bench_memory():
+    "Memory per extent of the extent store and Extent objects."
+    count = 1000000
+    size, (extents, starts) = measured(_tuple_lists, count)
+    print('{:<40} {:>9.1f} B'.format('tuple list + start list per extent',
+                                        size / len(extents)))
+    del extents, starts
+    elist = random_extents(count)
+    size, store = measured(_fill_store, elist)
+    print('{:<40} {:>9.1f} B'.format('ExtentStore per extent', size / len(store)))
+    print('{:<40} {:>9.1f} B'.format('ExtentStore.nbytes per extent',
+                                        store.nbytes() / len(store)))
+    del store
+    for cls in (_DictExtent, Extent):
+        size, objs = measured(lambda: [cls(s, n) for s, n in elist[:100000]])
+        print('{:<40} {:>9.1f} B'.format('{} per object'.format(cls.__name__),
+                                            size / len(objs)))
+
+def synthetic_tree(root, count, seed=1):
+    "Creates count small files of 1-64KiB in 100 directories under root."
+    rand = random.Random(seed)
+    data = os.urandom(64 * 1024)
+    for d in range(100):
+        os.mkdir(os.path.join(root, str(d)))
+    for i in range(count):
+        with open(os.path.join(root, str(i % 100), str(i)), 'wb') as f:
+            f.write(data[:rand.randint(1, 64) * 1024])
+    os.sync()
+
+def _map_tree(root, extents):
+    total = 0
+    for dirpath, dirs, files in os.walk(root):
+        for name in files + dirs:
+            total += len(extents(os.path.join(dirpath, name)))
+    return total
+
+def bench_fiemap():
+    "FIEMAP ioctl extent reader against forking filefrag per file."
+    count = 100000
+    # Under the current directory as tmpfs, a common /tmp, has no FIEMAP
+    root = tempfile.mkdtemp(prefix='bench_fiemap.', dir='.')
+    try:
+        timed('create {} files'.format(count), synthetic_tree, root, count)
+        mapper = getused.MapExtents(types.SimpleNamespace(), 0)
+        reader = fiemap.ExtentReader()
+        t_fiemap, n_fiemap = timed('FIEMAP {} files'.format(count),
+                                    _map_tree, root, reader)
+        if reader.unsupported:
+            print('FIEMAP is not supported here, skipping filefrag comparison')
+            return
+        t_frag, n_frag = timed('filefrag {} files'.format(count),
+                                _map_tree, root, mapper._filefrag_extents)
+        print('{:<40} {:>9.1f} x'.format('speedup', t_frag / t_fiemap))
+        if n_fiemap != n_frag:
+            sys.exit('FIEMAP found {} extents, filefrag {}!'.format(n_fiemap, n_frag))
+    finally:
+        shutil.rmtree(root)
+
+def _bulk_store(elist):
+    batch = extentops.Batch()
+    for start, n in elist:
+        batch.add(start, n)
+    store = ExtentStore()
+    store.update(*batch.runs())
+    return store
+
+def _complement_adds(runs, lo, hi):
+    "Baseline: the gaps between the runs added one at a time."
+    store = ExtentStore()
+    prev = lo
+    for start, n in extentops.extents(runs):
+        store.add(prev, start - prev)
+        prev = start + n
+    store.add(prev, hi - prev)
+    return store
+
+def _complement_bulk(runs, lo, hi):
+    store = ExtentStore()
+    store.update(*extentops.complement(runs, lo, hi))
+    return store
+
+def bench_extentops():
+    "Bulk extent algebra & ExtentStore.update against one add per extent."
+    print('NumPy backend' if extentops.numpy is not None else 'Pure Python backend')
+    count = 1000000
+    elist = random_extents(count)
+    t_add, added = timed('ExtentStore.add {} extents'.format(count),
+                        _fill_store, elist)
+    t_bulk, bulk = timed('ExtentStore.update {} extents'.format(count),
+                        _bulk_store, elist)
+    if added.tolist() != bulk.tolist():
+        raise Exception('Bulk load differs from ExtentStore.add')
+    print('{:<40} {:>9.1f} x'.format('speedup', t_add / t_bulk))
+    runs = bulk.runs()
+    hi = runs[1][-1] + 1
+    t_add, added = timed('complement by add', _complement_adds, runs, 0, hi)
+    t_bulk, bulk = timed('complement by extentops', _complement_bulk, runs, 0, hi)
+    if added.tolist() != bulk.tolist():
+        raise Exception('Bulk complement differs')
+    print('{:<40} {:>9.1f} x'.format('speedup', t_add / t_bulk))
+
+BENCHMARKS = {'extentstore': bench_extentstore,
+              'extentops': bench_extentops,
+              'fiemap': bench_fiemap,
+              'memory': bench_memory,
+              'rawtrace': bench_rawtrace}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            sys.exit('Unknown benchmark {}, choose from: {}'
+                        .format(name, ' '.join(sorted(BENCHMARKS))))
+        print('## {}: {}'.format(name, BENCHMARKS[name].__doc__))
+        BENCHMARKS[name]()
@@ -12,23 +12,29 @@ IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
 """
 import logging
 import subprocess
-import fcntl, os, io, sys, re, shutil
-from bisect import bisect_right
-import constants
+import fcntl, os, io, sys, re, shutil, struct, gzip
+import constants, json
 import pprint
-import helpers, ddrescue
+import helpers, ddrescue, mapfile, traceworker, coalesce
+from extents import ExtentStore
+from latency import LatencyHistograms
 
 # NOTE: if you don't read from stdout deadlock can occur
 # CTRL-C on blktrace to kill
 blktrace = None
-blkparse = None
+reader = None
 parser = None
-def start_bgproc(device, devsize):
-    "Starts the btrace process."
+def start_bgproc(options, devsize):
+    """Starts the btrace process and the worker process parsing its output.
+
+    options.rawtrace - parse blktrace's binary output directly instead of blkparse text
+    """
     global blktrace
-    global blkparse
+    global reader
     global parser
 
+    device = options.device
+    raw = options.rawtrace
     # Flush the device buffers first
     # trial fix for fs OSError I/O problem after copying to image - didn't work
     helpers.get_procoutput(['blockdev', '--flushbufs', device])
@@ -37,22 +43,77 @@ def start_bgproc(device, devsize):
                                     stdout=subprocess.PIPE,
                                     stderr=subprocess.DEVNULL)
     logging.debug('blktrace: {}'.format(helpers.get_process_cmd(blktrace)))
-    blkparse = subprocess.Popen(['blkparse', '-q', '-i-'],
+    if raw:
+        reader = blktrace
+    else:
+        reader = subprocess.Popen(['blkparse', '-q', '-i-'],
                                     stdin=blktrace.stdout,
                                     stdout=subprocess.PIPE,
                                     stderr=subprocess.DEVNULL)
-    logging.debug('blkparse: {}'.format(helpers.get_process_cmd(blkparse)))
-    # something to do with blktrace receiving a SIGPIPE if blkparse exits?
-    blktrace.stdout.close()
-    # make blkparse.stdout non-blocking. May receive IOError instead:
-    fcntl.fcntl(blkparse.stdout.fileno(), fcntl.F_SETFL, os.O_NONBLOCK)
-
-    # create instance of parser
-    parser = BtraceParser(blkparse)
+        logging.debug('blkparse: {}'.format(helpers.get_process_cmd(reader)))
+        # something to do with blktrace receiving a SIGPIPE if blkparse exits?
+        blktrace.stdout.close()
+    # make reader stdout non-blocking. May receive IOError instead:
+    fcntl.fcntl(reader.stdout.fileno(), fcntl.F_SETFL, os.O_NONBLOCK)
+
+    # Parse in a worker process; the viewer log is written alongside the btrace log
+    copies = [ddrescue.ddrlog] if ddrescue.VIEWER is not None else []
+    capture = None
+    if options.capture:
+        capture = helpers.image(options) + (rawcapture_suffix if raw else textcapture_suffix)
+    parser = traceworker.TraceWorker(reader, raw, options, devsize, copies, capture)
+    if options.ownio:
+        # Tell the worker about processes started from now on
+        helpers.SPAWN_LISTENERS.append(parser.add_pid)
     return blktrace
 
+rawcapture_suffix = '.blktrace.gz'
+textcapture_suffix = '.blkparse.gz'
+def open_capture(path):
+    """Opens a compressed trace capture for replay with BtraceParser.
+
+    Binary blktrace captures are detected by their magic, otherwise blkparse text.
+    """
+    f = gzip.open(path, 'rb')
+    head = f.peek(4)[:4]
+    if (len(head) == 4 and
+            (struct.unpack('=I', head)[0] & 0xffffff00) == BtraceParser.trace_magic):
+        return f
+    return io.TextIOWrapper(f, encoding='ascii')
+
+def replay(capture, devsize, logpath):
+    """Rebuilds a btrace log from a capture at full speed.
+
+    The start and end 1Mi are marked used as during a live trace.
+    Returns the parser for its stats.
+    """
+    with open_capture(capture) as source:
+        replayer = BtraceParser(source)
+        replayer.add_extent(0, 2048)
+        replayer.add_extent(devsize - 2048, 2048)
+        replayer.read_btrace()
+    replayer.usedlog = mapfile.write_store(logpath, replayer.write_header,
+                    replayer.store, replayer.get_status_char('non-tried'),
+                    replayer.get_status_char('finished'), 0, devsize)
+    return replayer
+
+def finished():
+    "Returns True once the process being parsed has exited and been fully parsed."
+    return reader.poll() is not None and parser.finished()
+
 def movelog(options):
     "Copies or moves the btrace log depending whether a copy should be kept."
+    if parser.usedlog is None:
+        raise Exception('The btrace worker died before writing {}, the metadata '
+                        'map is lost. Run again to repeat the trace.'
+                            .format(helpers.image(options) + BtraceParser.ddrlog_suffix))
+    if parser.died:
+        logging.warning('The btrace worker died, the btrace log is from its last '
+                        'update and may miss metadata read since.')
+    # Stats are kept for planning the data rescue, see plan.py
+    dump_stats(options)
+    if parser.add_pid in helpers.SPAWN_LISTENERS:
+        helpers.SPAWN_LISTENERS.remove(parser.add_pid)
     if options.keeplogs:
         shutil.copyfile(parser.usedlog, ddrescue.ddrlog)
     else:
@@ -60,11 +121,33 @@ def movelog(options):
         parser.usedlog = None
 
 def stop():
-    "Kill blktrace, returns blkparse because it will terminate after blktrace."
+    "Kill blktrace, returns the reader because it will terminate after blktrace."
     global blktrace
     helpers.ctrlc_process(blktrace)
     blktrace = None
-    return blkparse
+    return reader
+
+def pprint_stats(stats):
+    "Pretty prints stats, latencies as a per zone summary rather than histograms."
+    pprint.pprint(dict((k, v) for k, v in stats.items()
+                        if k not in ('latency', 'latency_summary')))
+    rows = stats.get('latency_summary')
+    if rows:
+        print('Device service time (D2C) by 1GiB zone, slowest first:')
+        print('{:>3} {:>9} {:>9} {:>10} {:>10}'
+                .format('R/W', 'zone', 'requests', 'p50', 'p99'))
+        for rw, zone, count, p50, p99 in rows[:20]:
+            print('{:>3} {:>6}GiB {:>9} {:>10} {:>10}'
+                    .format(rw, zone, count, p50, p99))
+
+statsjson_suffix = '.btrace.json'
+def dump_stats(options):
+    "Writes the btrace stats and latency histograms as JSON to the destination."
+    filename = helpers.image(options) + statsjson_suffix
+    with open(filename, 'w') as f:
+        json.dump(parser.get_stats(), f, indent=1, sort_keys=True)
+    logging.info('Btrace stats written to {}'.format(filename))
+    return filename
 
 def add_used_extent(start=None, size=None, next=None):
     "Add a 'used' extent to btrace list, must supply at least two parameters."
@@ -77,6 +160,8 @@ def add_used_extent(start=None, size=None, next=None):
 ###
 class Extent(object):
     "Mini-class for implementing 'in', overlaps and union for an extent to make code more readable."
+    # No per-instance __dict__, these are created in loops
+    __slots__ = ('start', 'n', 'next', 'end')
     # When thinking about start and ends, think about boundaries to sectors rather than the sectors themselves:
     # | 0 | 1 | 2 | 3 | 4 | 5 | 6 |
     # 0   1   2   3   4   5   6   7
@@ -123,17 +208,174 @@ class Extent(object):
         else:
             raise ValueError('Extents do not overlap: {}, {}'.format(self, item))
 
+###
+class PidFilter(object):
+    """Decides whether trace events were submitted by processes the tool started.
+
+    Admits tracked pids and their descendants (e.g. fsck -> fsck.ext4), exact
+    pids such as the tool itself, and kernel threads: I/O through the loop
+    devices the tool attaches reaches the disk from loop/kworker threads.
+    Events are parsed late, so scan() records descendants while they are alive.
+    A pid that is gone and was never seen is admitted as GONE only if it ran a
+    command the tracked pids ran, otherwise it is rejected: short-lived foreign
+    probes such as udev's blkid are gone by the time their events are parsed.
+    Decisions are cached per pid and command, so a pid reused by another
+    program is checked again.
+    """
+    PF_KTHREAD = 0x00200000
+    GONE = 'gone'
+    pat_kthread = re.compile(r"^(loop\d+|kworker)")
+    def __init__(self, pids=(), exact=()):
+        self.pids = set(pids)
+        self.exact = set(exact)
+        # Tracked pids that may still have children to find
+        self.live = set(self.pids)
+        # Command names of tracked pids seen by scan(), as blktrace reports
+        # them. A pid read just after fork still has the tool's own name
+        self.commands = set()
+        self.own_commands = set(self.comm(pid) for pid in self.exact)
+        self.decisions = {}
+        # Without CONFIG_PROC_CHILDREN the whole of /proc is scanned
+        self.children_files = os.path.exists('/proc/self/task/{}/children'
+                                                .format(os.getpid()))
+
+    def add_pid(self, pid):
+        self.pids.add(pid)
+        self.live.add(pid)
+        self.decisions.pop(pid, None)
+
+    @staticmethod
+    def comm(pid):
+        "Returns the command name of a process, None if it is gone."
+        try:
+            with open('/proc/{}/comm'.format(pid), 'r') as f:
+                return f.read().rstrip('\n')
+        except OSError:
+            return None
+
+    @staticmethod
+    def procstat(pid):
+        "Returns (ppid, flags) from /proc/<pid>/stat, None if the process is gone."
+        try:
+            with open('/proc/{}/stat'.format(pid), 'r') as f:
+                # comm may contain spaces and parentheses
+                fields = f.read().rsplit(')', 1)[1].split()
+            return (int(fields[1]), int(fields[6]))
+        except (OSError, IndexError, ValueError):
+            return None
+
+    @staticmethod
+    def process_tree():
+        "Returns {pid: set of child pids} for every process in /proc."
+        tree = {}
+        parents = {}
+        for name in os.listdir('/proc'):
+            if name.isdigit():
+                stat = PidFilter.procstat(name)
+                if stat is not None:
+                    tree[int(name)] = set()
+                    parents[int(name)] = stat[0]
+        for pid, ppid in parents.items():
+            if ppid in tree:
+                tree[ppid].add(pid)
+        return tree
+
+    @staticmethod
+    def children(pid):
+        "Returns the set of child pids of a process, None if it is gone."
+        try:
+            tids = os.listdir('/proc/{}/task'.format(pid))
+        except OSError:
+            return None
+        found = set()
+        for tid in tids:
+            try:
+                with open('/proc/{}/task/{}/children'.format(pid, tid), 'r') as f:
+                    found.update(int(child) for child in f.read().split())
+            except (OSError, ValueError):
+                pass
+        return found
+
+    def scan(self):
+        "Tracks the living descendants of tracked pids, call it often."
+        tree = None if self.children_files else self.process_tree()
+        stack = list(self.live)
+        while stack:
+            pid = stack.pop()
+            if tree is None:
+                found = self.children(pid)
+            else:
+                found = tree.get(pid)
+            if found is None:
+                self.live.discard(pid)
+                continue
+            command = self.comm(pid)
+            if command and command not in self.own_commands:
+                self.commands.add(command)
+            for child in found - self.pids:
+                self.add_pid(child)
+                stack.append(child)
+
+    def admit(self, pid, command):
+        "Returns True, False or GONE for an event of pid running command."
+        cached = self.decisions.get(pid)
+        if cached is not None and cached[0] == command:
+            return cached[1]
+        result = self.check(pid, command)
+        self.decisions[pid] = (command, result)
+        return result
+
+    def check(self, pid, command):
+        if pid in self.pids or pid in self.exact:
+            return True
+        if command and self.pat_kthread.match(command):
+            return True
+        stat = self.procstat(pid)
+        if stat is None:
+            # Exited before it could be told apart. Only a command we run is
+            # given the benefit of the doubt, e.g. a child scan() missed
+            if command in self.commands:
+                return self.GONE
+            return False
+        if stat[1] & self.PF_KTHREAD:
+            return True
+        # Walk up the parents looking for one we started
+        depth = 0
+        while stat is not None and stat[0] > 1 and depth < 32:
+            if stat[0] in self.pids:
+                return True
+            stat = self.procstat(stat[0])
+            depth += 1
+        return False
+
+###
+class BtraceFormatError(Exception):
+    "Binary trace input that is not a blk_io_trace record."
+    def __init__(self, magic, offset):
+        super().__init__('Bad blktrace magic {:#x} at stream offset {}'
+                            .format(magic, offset))
+        self.magic = magic
+        self.offset = offset
+
 ###
 class BtraceParser(object):
     "Class for parsing btrace output to a used space extent list and ddrescue log."
-    def __init__(self, source):
+    def __init__(self, source, raw=False):
+        """source - blkparse/blktrace process, blkparse text file or blktrace binary file
+        raw - process source outputs binary blk_io_trace records
+        """
         self.inproc = None
         self.infile = None
+        self.rawfile = None
         self.usedlog = None
+        self.raw = raw
         if isinstance(source, subprocess.Popen):
             self.inproc = source
         elif isinstance(source, io.TextIOWrapper):
             self.infile = source
+        elif isinstance(source, io.BufferedIOBase):
+            self.rawfile = source
+            self.raw = True
         else:
             raise Exception('Did not recognise btrace source: {}'.format(type(source)))
         # Only include items you want to see zero/empty, others are dynamically added
@@ -143,83 +385,39 @@ class BtraceParser(object):
                         'read_lines':0,
                         'R_sectors':0,
                         'W_sectors':0 }
-    # The extents list is formed of tuples: (start_sector, n_sectors)
-    # and sorted by start_sector, sector size is 512 bytes
-        self.extents = []
-        self.start_sectors = []
+        # Records and lines may straddle reads, pid names come from notify records
+        self.rawbuf = bytearray()
+        # Stream offset of the start of rawbuf, for errors
+        self.rawoffset = 0
+        self.pidnames = {}
+        self.writer = None
+        self.eof = False
+        # Binary file object every chunk read from the process is teed to
+        self.capture = None
+        # PidFilter admitting only our own I/O, None admits everything
+        self.pidfilter = None
+        self.latency = LatencyHistograms()
+    # The extent store holds merged (start_sector, n_sectors) runs
+    # sorted by start_sector, sector size is 512 bytes
+        self.store = ExtentStore()
         return None
 
     ddrlog_suffix = '.btrace.log'
     logmagic = 'MetaRescue'
 
-    def get_closest_extent(self, sector, i_start):
-        if len(self.extents) != 0:
-            i_insert = bisect_right(self.start_sectors, sector, lo=i_start)
-            i = i_insert
-            if i > 0:
-                i -= 1
-            e = Extent(self.extents[i][0],self.extents[i][1])
-            return (i_insert, i, e)
-        else:
-            return (0, 0, None)
+    @property
+    def extents(self):
+        "Sorted list of (start_sector, n_sectors) tuples, built on demand."
+        return self.store.tolist()
 
     def add_extent(self, start, n):
         # Inputs must always be >= 0
         if start < 0 or n < 0:
             raise Exception('add_extent: Input less than zero: {}:{}'
                                 .format(start, n))
-        if n == 0:
-            return
-        # INSERT straight away if first extent
-        if 0 == len(self.extents):
-            self.extents.insert(0, (start, n))
-            self.start_sectors.insert(0, start)
-            logging.log(5, 'add_first_extent INSERT: pos={} new={}'
-                            .format(0, Extent(start, n)))
-            return
-
-        e_new = Extent(start, n)
-        (ii_left,  i_left,  e_left)  = self.get_closest_extent(e_new.start, 0)
-        (ii_right, i_right, e_right) = self.get_closest_extent(e_new.next, ii_left)
-
-        i_diff  = i_right - i_left
-        overlaps = 0
-        b_left = False
-        eu = e_new
-        if e_left.overlaps(eu):
-            overlaps += 1
-            b_left = True
-            eu = eu.union(e_left)
-        if i_diff > 0:
-            if e_right.overlaps(eu):
-                overlaps += 1
-                b_left = False
-                eu = eu.union(e_right)
-
-        # INSERT if no overlaps
-        if 0 == overlaps:
-            self.extents.insert(ii_left, (eu.start, eu.n))
-            logging.log(5, 'add_extent INSERT: pos={} new={}'
-                            .format(ii_left, eu))
-        # REPLACE if overlap once
-        elif 1 == overlaps:
-            if b_left:
-                self.extents[i_left] = (eu.start, eu.n)
-                logging.log(5, 'add_extent REPLACE: pos={} org={} new={} union={}'
-                                .format(i_left, e_left, e_new, eu))
-            else:
-                self.extents[i_right] = (eu.start, eu.n)
-                logging.log(5, 'add_extent REPLACE: pos={} org={} new={} union={}'
-                                .format(i_right, e_right, e_new, eu))
-        # REPLACE & DELETE if overlap twice or more
-        else:
-            self.extents[i_left] = (eu.start, eu.n)
-            for i in range(i_left + 1, i_right + 1):
-                del self.extents[i]
-            logging.log(5, 'add_extent REPLACE&DELETE: pos={}-{} orgs={}-{} new={} union={}'
-                            .format(i_left, i_right, e_left, e_right, e_new, eu))
-        # Rebuild start_sectors list
-        self.start_sectors = [data[0] for data in self.extents]
+        self.store.add(start, n)
+        logging.log(5, 'add_extent: start={} n={} runs={}'
+                        .format(start, n, len(self.store)))
         return
 
     def statinc(self, key, section=None, value=1):
@@ -253,6 +451,7 @@ class BtraceParser(object):
             sector = int(plus_match.group(1))
             n_sectors = int(plus_match.group(2))
 
+        command = None
         if sqbrace_match is not None:
             sqbrace_content = sqbrace_match.group(1)
             if is_C:
@@ -260,9 +459,41 @@ class BtraceParser(object):
                 if sqbrace_content != '0':
                     self.statinc(sqbrace_content, 'error_list')
             else:
+                command = sqbrace_content
                 self.statinc(sqbrace_content, 'commands')
 
-        return (sector, n_sectors)
+        return (sector, n_sectors, command)
+
+    def admitted(self, action, pid, command, n_sectors):
+        """Returns True if the event's sectors belong in the extent store.
+
+        With a pid filter only queue events are used; they are the one event
+        reliably carrying the submitting pid, the others repeat the same sectors
+        from kworker or interrupt context. Rejections, and events admitted for
+        pids that exited before they could be checked, are counted in the stats.
+        """
+        if self.pidfilter is None:
+            return True
+        if 'Q' not in action:
+            return False
+        decision = self.pidfilter.admit(pid, command)
+        if decision is PidFilter.GONE:
+            # Kept, since missing metadata costs more than some foreign reads
+            self.statinc('unverified_events')
+            self.statinc('unverified_sectors', value=n_sectors)
+            return True
+        if decision:
+            return True
+        self.statinc('rejected_events')
+        self.statinc('rejected_sectors', value=n_sectors)
+        self.statinc(command or str(pid), 'rejected_commands')
+        return False
+
+    @staticmethod
+    def secnsec_to_ns(secnsec):
+        "Converts a blkparse 'seconds.nanoseconds' timestamp to integer ns."
+        sec, _, nsec = secnsec.partition('.')
+        return int(sec) * 1000000000 + int(nsec or 0)
 
     # 'other' formats:
     #  7,0    0       12     0.005528571 30641  Q   R 12583104 + 8 [testdisk]
@@ -292,23 +523,163 @@ class BtraceParser(object):
 
         # Parse other
         if 'C' in action:
-            (sector, n_sectors) = self.parse_other(True, other)
+            (sector, n_sectors, command) = self.parse_other(True, other)
         elif 'B' in action or 'D' in action or 'I' in action or 'Q' in action or \
             'F' in action or 'G' in action or 'M' in action or 'S' in action:
-            (sector, n_sectors) = self.parse_other(False, other)
+            (sector, n_sectors, command) = self.parse_other(False, other)
         else:
             return
 
         # Add to extents list & update stats with n_sectors
-        self.add_extent(sector, n_sectors)
+        if self.admitted(action, int(pid), command, n_sectors):
+            self.add_extent(sector, n_sectors)
         if 'R' in RWBS:
             self.statinc('R_sectors', value=n_sectors)
+            self.latency.event(action, 'R', sector, self.secnsec_to_ns(secnsec))
         elif 'W' in RWBS:
             self.statinc('W_sectors', value=n_sectors)
+            self.latency.event(action, 'W', sector, self.secnsec_to_ns(secnsec))
         return
 
+    # struct blk_io_trace from linux/blktrace_api.h, written in native byte order:
+    # magic, sequence, time(ns), sector, bytes, action, pid, device, cpu,
+    # error, pdu_len; followed by pdu_len bytes of payload
+    trace_struct = struct.Struct('=IIQQIIIIIHH')
+    trace_magic = 0x65617400
+    # Low 16 bits of action are the __BLK_TA_* code, high 16 bits BLK_TC_* categories
+    trace_actions = ' QMFGSRDCPUTIXBA'
+    BLK_TC_WRITE    = 1 << (1 + 16)
+    BLK_TC_FLUSH    = 1 << (2 + 16)
+    BLK_TC_SYNC     = 1 << (3 + 16)
+    BLK_TC_PC       = 1 << (9 + 16)
+    BLK_TC_NOTIFY   = 1 << (10 + 16)
+    BLK_TC_AHEAD    = 1 << (11 + 16)
+    BLK_TC_META     = 1 << (12 + 16)
+    BLK_TC_DISCARD  = 1 << (13 + 16)
+    BLK_TC_FUA      = 1 << (15 + 16)
+    BLK_TN_PROCESS  = 0
+    def trace_rwbs(self, action, nbytes):
+        "Returns the blkparse RWBS string for a binary action."
+        rwbs = ''
+        if action & self.BLK_TC_FLUSH: rwbs += 'F'
+        if action & self.BLK_TC_DISCARD: rwbs += 'D'
+        elif action & self.BLK_TC_WRITE: rwbs += 'W'
+        elif nbytes: rwbs += 'R'
+        else: rwbs += 'N'
+        if action & self.BLK_TC_FUA: rwbs += 'F'
+        if action & self.BLK_TC_AHEAD: rwbs += 'A'
+        if action & self.BLK_TC_SYNC: rwbs += 'S'
+        if action & self.BLK_TC_META: rwbs += 'M'
+        return rwbs
+
+    def parse_trace(self, time, sector, nbytes, action, pid, error):
+        "Binary equivalent of parse_btrace, giving identical stats and extents."
+        code = action & 0xff
+        if code >= len(self.trace_actions):
+            self.statinc('unknown_actions')
+            return
+        act = self.trace_actions[code]
+        RWBS = self.trace_rwbs(action, nbytes)
+        for i, char in enumerate(RWBS):
+            if 0 != i and 'F' == char:
+                self.statinc('FUA', 'RWBS')
+            else:
+                self.statinc(char, 'RWBS')
+        self.statinc(act, 'actions')
+
+        if act not in 'CBDIQFGMS':
+            return
+        if action & self.BLK_TC_PC:
+            self.statinc('payloads')
+            sector, n_sectors = 0, 0
+        else:
+            n_sectors = nbytes >> 9
+        command = None
+        if 'C' == act:
+            # Remove successes: error = 0
+            if error != 0:
+                self.statinc(str(error), 'error_list')
+        elif pid in self.pidnames:
+            command = self.pidnames[pid]
+            self.statinc(command, 'commands')
+
+        # Add to extents list & update stats with n_sectors
+        if self.admitted(act, pid, command, n_sectors):
+            self.add_extent(sector, n_sectors)
+        if 'R' in RWBS:
+            self.statinc('R_sectors', value=n_sectors)
+            self.latency.event(act, 'R', sector, time)
+        elif 'W' in RWBS:
+            self.statinc('W_sectors', value=n_sectors)
+            self.latency.event(act, 'W', sector, time)
+        return
+
+    def parse_raw(self, buf):
+        """Parses whole blk_io_trace records at the start of buf.
+
+        Returns (bytes consumed, records parsed) so a partial record can be kept.
+        Raises BtraceFormatError if buf is not at a record.
+        """
+        unpack_from = self.trace_struct.unpack_from
+        size = self.trace_struct.size
+        end = len(buf)
+        offset = 0
+        records = 0
+        while offset + size <= end:
+            (magic, seq, time, sector, nbytes, action, pid, device, cpu,
+                error, pdu_len) = unpack_from(buf, offset)
+            if (magic & 0xffffff00) != self.trace_magic:
+                raise BtraceFormatError(magic, self.rawoffset + offset)
+            nxt = offset + size + pdu_len
+            if nxt > end:
+                break
+            if action & self.BLK_TC_NOTIFY:
+                # Process notify payload is the NUL padded command name
+                if (action & 0xff) == self.BLK_TN_PROCESS:
+                    pdu = bytes(buf[offset + size:nxt])
+                    self.pidnames[pid] = pdu.split(b'\0', 1)[0].decode('ascii', 'replace')
+            else:
+                self.statinc('read_lines')
+                self.parse_trace(time, sector, nbytes, action, pid, error)
+                records += 1
+            offset = nxt
+        return (offset, records)
+
+    chunksize = 1024 * 1024
+    def read_chunk(self):
+        "Returns the next chunk of binary input or None if none is ready, sets eof."
+        try:
+            if self.rawfile is not None:
+                chunk = self.rawfile.read(self.chunksize)
+            else:
+                chunk = os.read(self.inproc.stdout.fileno(), self.chunksize)
+        except BlockingIOError:
+            return None
+        if chunk == b'':
+            self.eof = True
+            return None
+        if chunk and self.capture is not None:
+            self.capture.write(chunk)
+        return chunk
+
+    def read_btrace_raw(self):
+        "Reads all available binary records in large chunks, exits on EOF or no data."
+        local_records = 0
+        while True:
+            chunk = self.read_chunk()
+            if not chunk:
+                break
+            self.rawbuf += chunk
+            consumed, records = self.parse_raw(self.rawbuf)
+            del self.rawbuf[:consumed]
+            self.rawoffset += consumed
+            local_records += records
+        return local_records
+
     def read_btrace(self):
-        if self.inproc is not None:
+        if self.raw:
+            local_lines = self.read_btrace_raw()
+        elif self.inproc is not None:
             local_lines = self.read_btrace_process()
         elif self.infile is not None:
             local_lines = self.read_btrace_file()
@@ -319,22 +690,24 @@ class BtraceParser(object):
         return local_lines
 
     def read_btrace_process(self):
-        full = True
+        "Reads all available blkparse lines in large chunks, a partial line is kept."
         local_lines = 0
-        while(full):
-            try:
-                bytes = self.inproc.stdout.readline()
-                line = bytes.decode(encoding='ascii').strip('\n\r')
-                length = len(line)
-                if length > 0:
+        while True:
+            chunk = self.read_chunk()
+            if not chunk:
+                break
+            self.rawbuf += chunk
+            end = self.rawbuf.rfind(b'\n') + 1
+            if end == 0:
+                continue
+            lines = self.rawbuf[:end].decode(encoding='ascii').splitlines()
+            del self.rawbuf[:end]
+            for line in lines:
+                if len(line) > 0:
                     logging.log(5, '{}:{}'.format(self.stats['read_lines'],line))
                     self.statinc('read_lines')
                     local_lines += 1
                     self.parse_btrace(*line.split(None,maxsplit=7))
-                else:
-                    full = False
-            except IOError:
-                full = False
         return local_lines
 
     # exits on EOF
@@ -346,9 +719,16 @@ class BtraceParser(object):
             local_lines += 1
         return local_lines
 
+    def get_stats(self):
+        "Returns the stats including the latency histograms."
+        stats = dict(self.stats)
+        stats['latency'] = self.latency.todict()
+        stats['latency_summary'] = self.latency.summary()
+        return stats
+
     # Pretty print stats
     def pprint_stats(self):
-        pprint.pprint(self.stats)
+        pprint_stats(self.get_stats())
 
     ddrescue_status = {'non-tried':'?', 'non-trimmed':'*', 'non-split':'/',
                             'bad-sector':'-', 'finished':'+'}
@@ -370,36 +750,33 @@ class BtraceParser(object):
         file_obj.write(self.header_l4)
         file_obj.write(self.header_l5)
 
-    def write_extent_line(self, file_obj, start, size, status_char):
-        file_obj.write('{:#012X}  {:#012X}  {}\n'.format(start, size, status_char))
-        return
-
     # Note all extents are in bytes rather than sectors
     def write_ddrescuelog(self, options, extent_status, fill_status,
                             sectstart, sectend):
         "Writes a ddrescue log file."
-        prev_e = Extent(512 * sectstart, 0)
-        fill_char    = self.get_status_char(fill_status)
-        extent_char  = self.get_status_char(extent_status)
         filename = helpers.image(options) + self.ddrlog_suffix
-        # Overwrite not append to file
-        with open(filename,'w') as f:
-            self.write_header(f)
-            for tup in self.extents:
-                e = Extent(512 * tup[0], 512 * tup[1])
-                fill_e = Extent(prev_e.next, e.start - prev_e.next)
-                if fill_e.n > 0:
-                    # FILL
-                    self.write_extent_line(f, fill_e.start, fill_e.n, fill_char)
-                # EXTENT
-                self.write_extent_line(f, e.start, e.n, extent_char)
-                prev_e = e
-            devend = 512 * sectend
-            fill_e = Extent(prev_e.next, devend - prev_e.next)
-            if fill_e.n > 0:
-                # FILL to the end
-                self.write_extent_line(f, fill_e.start, fill_e.n, fill_char)
-            f.write('\n')
-        self.usedlog = filename
+        store = self.store
+        if coalesce.active(options):
+            store = coalesce.coalesce_options(store, options, sectstart, sectend)[0]
+        self.usedlog = mapfile.write_store(filename, self.write_header, store,
+                        self.get_status_char(extent_status),
+                        self.get_status_char(fill_status), sectstart, sectend)
         return filename
 
+    def update_ddrescuelog(self, options, extent_status, fill_status,
+                            sectstart, sectend, copies=(), force=False):
+        """Throttled, incremental write_ddrescuelog for use while tracing.
+
+        copies - other paths that receive the same content, e.g. the viewer log
+        Returns the filename if written, otherwise None.
+        """
+        if self.writer is None:
+            filename = helpers.image(options) + self.ddrlog_suffix
+            self.writer = mapfile.MapfileWriter(self.store, filename,
+                        self.write_header, self.get_status_char(extent_status),
+                        self.get_status_char(fill_status), sectstart, sectend,
+                        copies)
+        if self.writer.update(force):
+            self.usedlog = self.writer.path
+            return self.usedlog
+        return None
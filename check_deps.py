@@ -19,18 +19,17 @@ from pkg_resources import parse_version
 deps_mandatory = {
             'blktrace':     ('1.0.5-1', 'blktrace', 'blkparse'),
             'testdisk':     ('6.14-2', 'testdisk'),
-# NOTE: there a lot of bugs in ddrescuelog before 1.19.1
-            'gddrescue':    ('1.17-1', 'ddrescue', 'ddrescuelog'),
+            'gddrescue':    ('1.17-1', 'ddrescue'),
             'mount':        ('2.20.1-5.1ubuntu20.7', 'losetup', 'mount', 'umount'),
             'util-linux':   ('2.20.1-5.1ubuntu20.7', 'blkid', 'blockdev'),
             'parted':       ('2.3-19ubuntu1', 'partprobe'),
             'coreutils':    ('8.21-1ubuntu5.4', 'truncate'),
-            'hdparm':       ('9.43-1ubuntu3', 'hdparm'),
             'e2fsprogs':    ('1.43~WIP.2016.03.15-2', 'filefrag', 'e2image', 'e2fsck'),
             'diffutils':    ('1:3.3-1', 'diff') }
 
 deps_optional = {
             'dosfstools':   ('3.0.26-1', 'fsck.fat'),
+            'exfatprogs':   ('1.0.0-1', 'fsck.exfat'),
             'hfsprogs':     ('332.25-11', 'fsck.hfsplus'),
             'ntfs-3g':      ('1:2013.1.13AR.1-2ubuntu2', 'ntfsfix', 'ntfsclone'),
             'btrfs-tools':  ('4.1', 'btrfs', 'btrfstune', 'btrfs-image'),
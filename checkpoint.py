@@ -0,0 +1,124 @@
+"""
+Append-only checkpoints of the used space mapping of each partition.
+
+A checkpoint file is a header followed by 16 byte records of two little endian
+64 bit numbers:
+  (start, n) with n > 0 - a mapped extent in 512B sectors
+  (position, 0) - a marker: every walk entry before position is recorded
+  (DONE, 0) - the partition is completely mapped
+Extents are buffered in memory and appended with a marker at most every
+interval seconds, so the mapping hot path only appends to an array. On load,
+records after the last marker are incomplete and are discarded.
+
+##License:
+Original work Copyright 2016 Richard Case
+
+Everyone is permitted to copy, distribute and modify this software,
+subject to this statement and the copyright notice above being included.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND.
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
+"""
+import os, sys, time, struct, logging
+from array import array
+
+MAGIC = b'DDRUCKP1'
+DONE = 2**64 - 1
+header_struct = struct.Struct('<8sQQ')
+record_struct = struct.Struct('<QQ')
+
+class Checkpoint(object):
+    "Checkpoint of one partition, identified by its start & size sectors."
+    interval = 10.0
+
+    def __init__(self, path, start, size):
+        self.path = path
+        self.header = header_struct.pack(MAGIC, start, size)
+        self.pending = array('Q')
+        self.position = 0
+        self.done = False
+        self.fd = None
+        self.last = time.monotonic()
+
+    def load(self, add_extent):
+        """Replays the committed extents through add_extent(start, n).
+
+        Returns the walk position to continue from; self.done is set if the
+        partition was completely mapped. A missing or mismatched file is
+        started afresh.
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return 0
+        if not data.startswith(self.header):
+            logging.warning('Ignoring checkpoint {} of another partition'
+                                .format(self.path))
+            os.remove(self.path)
+            return 0
+        body = data[len(self.header):]
+        body = body[:len(body) - len(body) % record_struct.size]
+        extents = []
+        count = 0
+        committed = 0
+        for i, (start, n) in enumerate(record_struct.iter_unpack(body)):
+            if n:
+                extents.append((start, n))
+                continue
+            # Marker: everything before it is complete
+            for extent in extents:
+                add_extent(*extent)
+            count += len(extents)
+            extents = []
+            committed = i + 1
+            if start == DONE:
+                self.done = True
+            else:
+                self.position = start
+        size = len(self.header) + record_struct.size * committed
+        if size < len(data):
+            # Incomplete tail after the last marker
+            with open(self.path, 'r+b') as f:
+                f.truncate(size)
+        logging.info('Checkpoint {}: {} extents, position {}{}'
+                        .format(self.path, count, self.position,
+                                ', done' if self.done else ''))
+        return self.position
+
+    def add(self, start, n):
+        "Buffers a mapped extent."
+        self.pending.append(start)
+        self.pending.append(n)
+
+    def _append(self, position):
+        if self.fd is None:
+            exists = os.path.isfile(self.path)
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            if not exists:
+                os.write(self.fd, self.header)
+        self.pending.append(position)
+        self.pending.append(0)
+        if sys.byteorder == 'big':
+            self.pending.byteswap()
+        os.write(self.fd, self.pending.tobytes())
+        os.fsync(self.fd)
+        self.pending = array('Q')
+        self.last = time.monotonic()
+
+    def mark(self, position, force=False):
+        "Records that every walk entry before position is mapped, throttled by interval."
+        if force or time.monotonic() - self.last >= self.interval:
+            self._append(position)
+            self.position = position
+
+    def finish(self):
+        "Records the partition as completely mapped and closes the file."
+        self._append(DONE)
+        self.done = True
+        self.close()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,89 @@
+"""
+Coalesces extents before a ddrescue map is written.
+
+Captured metadata is thousands of small reads separated by tiny gaps, which
+makes ddrescue seek constantly on spinning disks and bloats the mapfile.
+Policies, applied in this order:
+  align - round extents out to the device's physical sector and optimal I/O size
+  bridge - join extents separated by gaps smaller than a threshold
+  cap - bridge the smallest remaining gaps until at most N extents remain
+
+##License:
+Original work Copyright 2016 Richard Case
+
+Everyone is permitted to copy, distribute and modify this software,
+subject to this statement and the copyright notice above being included.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND.
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
+"""
+import logging
+from math import gcd
+import helpers
+from extents import ExtentStore
+
+def active(options):
+    "Returns True if any coalescing policy is switched on."
+    return bool(options.bridge or options.align or options.maxextents)
+
+def device_alignment(device):
+    "Returns the alignment in 512B sectors: lcm of physical sector & optimal I/O sizes."
+    align = 512
+    for attribute in ('physical_block_size', 'optimal_io_size'):
+        size = helpers.get_device_queue(device, attribute)
+        # optimal_io_size is 0 when the device does not report one
+        if size and size % 512 == 0:
+            align = align * size // gcd(align, size)
+    return align // 512
+
+def coalesce(store, sectstart, sectend, bridge=0, align=1, maxruns=0):
+    """Returns (new ExtentStore, report dict) for the coalesced store.
+
+    bridge - gaps smaller than this many sectors are joined
+    align - extents are rounded out to multiples of this many sectors
+    maxruns - if > 0, the maximum number of extents to output
+    """
+    runs = []
+    for start, n in store:
+        nxt = start + n
+        if align > 1:
+            start = max(start - start % align, sectstart)
+            nxt = min(-(-nxt // align) * align, sectend)
+        if runs and start - runs[-1][1] < max(bridge, 1):
+            runs[-1][1] = max(runs[-1][1], nxt)
+        else:
+            runs.append([start, nxt])
+
+    if maxruns > 0 and len(runs) > maxruns:
+        gaps = [runs[i + 1][0] - runs[i][1] for i in range(len(runs) - 1)]
+        smallest = sorted(range(len(gaps)), key=gaps.__getitem__)
+        bridged = set(smallest[:len(runs) - maxruns])
+        capped = [runs[0]]
+        for i in range(len(gaps)):
+            if i in bridged:
+                capped[-1][1] = runs[i + 1][1]
+            else:
+                capped.append(runs[i + 1])
+        runs = capped
+
+    out = ExtentStore()
+    for start, nxt in runs:
+        out.add(start, nxt - start)
+    report = {'runs_before': len(store), 'runs_after': len(out),
+              'seeks_removed': len(store) - len(out),
+              'extra_bytes': 512 * (out.sectors() - store.sectors())}
+    return (out, report)
+
+def coalesce_options(store, options, sectstart, sectend):
+    "Applies the command line policies to a store, logging what it costs and saves."
+    align = device_alignment(options.device) if options.align else 1
+    out, report = coalesce(store, sectstart, sectend,
+                            bridge=2 * options.bridge, align=align,
+                            maxruns=options.maxextents)
+    logging.info('Coalesced {} extents to {} (align {} sectors, bridge {} KiB, cap {}):'
+                 ' {} seeks removed for {} MB extra'
+                    .format(report['runs_before'], report['runs_after'], align,
+                            options.bridge, options.maxextents,
+                            report['seeks_removed'],
+                            report['extra_bytes'] // 2**20))
+    return (out, report)
@@ -12,9 +12,8 @@ IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
 """
 import subprocess
 import logging
-import helpers
-import os, shutil
-from shlex import quote
+import helpers, mapfile
+import os
 
 ddrlog_suffix = '.xfer.log'
 ddrlog = None
@@ -34,6 +33,13 @@ def interactive(options, args=[]):
         yield DDRESCUE.returncode is None
     DDRESCUE = None
 
+def interactive_passes(options, passes):
+    "Runs ddrescue once per list of extra args in passes, e.g. domain mapfiles."
+    for args in passes:
+        logging.info('ddrescue pass with extra args: {}'.format(' '.join(args)))
+        for running in interactive(options, args):
+            yield running
+
 def stop():
     global DDRESCUE
     ddr = DDRESCUE
@@ -57,22 +63,13 @@ def remove_ddrlog(options):
     if ddrlog is not None and not options.keeplogs:
         helpers.removefile(ddrlog)
 
-# ddrescuelog command output
-def logcmd(options, cmd, prefix=''):
-    """Runs a ddrescuelog shell command.
+# Native ddrescuelog operations
+def logop(options, operation, *args):
+    """Applies a mapfile operation to ddrlog in place, see mapfile.OPERATIONS.
 
-    Substitutes {0} with ddrlog in the command and overwrites ddrlog with the
-    result.
+    e.g. logop(options, 'and', otherlog) or logop(options, 'change', '-', '?')
     """
-    tmpfile = helpers.randpath(options, 'tmp.')
-    fullcmd = (cmd + ' > {1}').format(quote(ddrlog), quote(tmpfile))
-    proc = helpers.get_procoutput(fullcmd, shell=True)[0]
-    if proc.returncode != 0:
-        raise Exception('ddrescuelog failed!')
-    if options.keeplogs:
-        shutil.copyfile(tmpfile, ddrlog)
-    else:
-        shutil.move(tmpfile, ddrlog)
+    mapfile.rewrite(ddrlog, operation, *args)
 
 # Start ddrescueview
 VIEWER = None
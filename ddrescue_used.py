@@ -14,8 +14,8 @@ IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
 import sys, signal
 import os, shutil
 import logging, traceback
-import btrace, testdisk, pt, ddrescue, helpers, fsmeta, getused
-import parse_args, check_deps, constants, clone, diff
+import btrace, testdisk, pt, ddrescue, helpers, fsmeta, getused, plan, priority, impact
+import parse_args, check_deps, constants, clone, diff, mapfile
 from statemachine import State, StateMachine
 
 #TODO: test with lots of images: MBR & GPT, FS combos, PEXL's, errors...
@@ -49,6 +49,10 @@ def cleanup():
     ddrescue.stop()
     ddrescue.stop_viewer()
     ddrescue.remove_ddrlog(OPTIONS)
+    getused.remove_checkpoints(OPTIONS)
+    plan.remove_domains(OPTIONS)
+    priority.remove_domains(OPTIONS)
+    impact.remove_index(OPTIONS)
     pt.rmbackup(OPTIONS)
     btrace.stop()
 
@@ -70,7 +74,7 @@ if hasattr(OPTIONS, 'noshow') and OPTIONS.noshow == False:
 MetaClone = State('Transfer Clonable Metadata',
     "partinfo = clone.clonemeta(OPTIONS, DEVSIZE, partinfo)")
 StartBtrace = State('Btrace',
-    "btrace.start_bgproc(OPTIONS.device, DEVSIZE); BTRACE_POLL_COUNT = 0")
+    "btrace.start_bgproc(OPTIONS, DEVSIZE); BTRACE_POLL_COUNT = 0")
 AddStartEnd = State('Mark Start & End 1Mi Used',
     "btrace.add_used_extent(start=0, size=2048); " +
     "btrace.add_used_extent(size=2048, next=DEVSIZE)")
@@ -93,7 +97,7 @@ CloseBtrace = State('Stop Btrace',
 OutputBtraceStats = State('Btrace Stats',
     "btrace.parser.pprint_stats()")
 MetaRescue = State('DDrescue PT & FSs',
-    "ddrrunning = ddrescue.interactive(OPTIONS)")
+    "ddrrunning = ddrescue.interactive_passes(OPTIONS, plan.passes(OPTIONS, DEVSIZE))")
 PTResume = State('Read PT after Resume',
     "ptable = pt.PartitionTable(testdisk.get_list(OPTIONS.device), OPTIONS, DEVSIZE)")
 PTRepair = State('Testdisk Repair Image PT',
@@ -101,9 +105,14 @@ PTRepair = State('Testdisk Repair Image PT',
 FixImgRW = State('Repair Image Using FSCK',
     "fixmetarunning = fsmeta.fixmeta_image_running(OPTIONS, ptable)")
 MapExtents = State('Clone and/or Find Used Space',
-    "mapper = getused.MapExtents(OPTIONS, DEVSIZE); partinfo = mapper.map(partinfo, USED)")
+    "mapper = getused.MapExtents(OPTIONS, DEVSIZE, resume=(statetag == 'map')); " +
+    "partinfo = mapper.map(partinfo, USED)")
 DataRescue = State('DDrescue Used Space',
-    "ddrrunning = ddrescue.interactive(OPTIONS)")
+    "ddrrunning = ddrescue.interactive_passes(OPTIONS, " +
+    "priority.passes(OPTIONS) + plan.passes(OPTIONS, DEVSIZE))")
+ImpactReport = State('Report Damaged Files',
+    "getused.MapExtents(OPTIONS, DEVSIZE).index_files(partinfo); " +
+    "impact.report(OPTIONS, ddrescue.ddrlog)")
 DiffFS = State('Diff Corresponding Device and Image FSs',
     "diff.difffs(OPTIONS, partinfo)")
 
@@ -143,11 +152,11 @@ FindMeta.add_transition(BtraceWait,
 BtraceWait.add_transition(CloseBtrace,
     condition='BTRACE_POLL_COUNT >= 3')
 CloseBtrace.add_transition(OutputBtraceStats,
-    condition="btrace.blkparse.poll() is not None and OPTIONS.stats",
-    actions="btrace.blkparse = None; btrace.movelog(OPTIONS)")
+    condition="btrace.finished() and OPTIONS.stats",
+    actions="btrace.reader = None; btrace.movelog(OPTIONS)")
 CloseBtrace.add_transition(MetaRescue,
-    condition="btrace.blkparse.poll() is not None and not OPTIONS.stats",
-    actions="btrace.blkparse = None; btrace.movelog(OPTIONS)")
+    condition="btrace.finished() and not OPTIONS.stats",
+    actions="btrace.reader = None; btrace.movelog(OPTIONS)")
 OutputBtraceStats.add_transition(MetaRescue,
     condition="True")
 MetaRescue.add_transition(FixImgRW,
@@ -166,14 +175,25 @@ FixImgRW.add_transition(MapExtents,
     condition="not next(fixmetarunning, False)")
 MapExtents.add_transition(DataRescue,
     condition="True")
+DataRescue.add_transition(ImpactReport,
+    condition="not next(ddrrunning, False) and OPTIONS.impact")
 DataRescue.add_transition(DiffFS,
-    condition="not next(ddrrunning, False) and OPTIONS.diff")
+    condition="not next(ddrrunning, False) and not OPTIONS.impact and OPTIONS.diff")
 DataRescue.add_transition(None,
-    condition="not next(ddrrunning, False) and not OPTIONS.diff")
+    condition="not next(ddrrunning, False) and not OPTIONS.impact and not OPTIONS.diff")
+ImpactReport.add_transition(DiffFS,
+    condition="OPTIONS.diff")
+ImpactReport.add_transition(None,
+    condition="not OPTIONS.diff")
 DiffFS.add_transition(None,
     condition="True")
 
 # RESUME
+def _written_by(log, magic):
+    "Returns True if the log header shows this tool wrote it in the magic stage."
+    header = mapfile.read_header(log)
+    return header is not None and header.written_by('ddrescue_used', magic)
+
 def resumable(options):
     "Check to see if ddrescue log files exist and they indicate a resumable state."
     imgfile = helpers.image(options)
@@ -182,12 +202,12 @@ def resumable(options):
     usedlog = imgfile + getused.MapExtents.ddrlog_suffix
     if os.path.isfile(ddrlog) and os.stat(ddrlog).st_size > 0:
         if (os.path.isfile(usedlog) and
-                helpers.grep(usedlog, 'ddrescue_used') and
-                helpers.grep(usedlog, getused.MapExtents.logmagic)):
+                _written_by(usedlog, getused.MapExtents.logmagic)):
             return 'data'
+        elif getused.checkpoint_paths(options):
+            return 'map'
         elif (os.path.isfile(btracelog) and
-                helpers.grep(btracelog, 'ddrescue_used') and
-                helpers.grep(btracelog, btrace.BtraceParser.logmagic)):
+                _written_by(btracelog, btrace.BtraceParser.logmagic)):
             return 'meta'
         else:
             raise Exception('Non-resumable state. Use {} in ddrescue directly or remove it.'
@@ -201,29 +221,29 @@ if 'data' == statetag:
     startstate = DataRescue
     resumed = True
     logging.info("Resuming at Data Rescue...")
+elif 'map' == statetag:
+    startstate = MapExtents
+    resumed = True
+    logging.info("Resuming at Find Used Space from checkpoints...")
 elif 'meta' == statetag:
     startstate = MetaRescue
     resumed = True
     logging.info("Resuming at Metadata Rescue...")
 else:
     startstate = MetaClone
+    # Checkpoints kept from an earlier run must not be resumed by this one
+    getused.remove_checkpoints(OPTIONS, force=True)
 
 # STATEMACHINE
 sm = StateMachine(0.1, startstate, globals(), locals())
 
 BTRACE_POLL_COUNT = 0
 def btrace_poller(smobj):
+    "Collects updates from the btrace worker, which parses and writes the log."
     global BTRACE_POLL_COUNT
-    if btrace.blkparse is not None and btrace.parser is not None:
-        lines_read = btrace.parser.read_btrace()
+    if btrace.reader is not None and btrace.parser is not None:
+        btrace.parser.read_btrace()
         BTRACE_POLL_COUNT += 1
-        if lines_read > 0:
-            # unused are marked finished so when ANDed using ddrescuelog
-            # only definitely unused parts remain finished
-            btracelog = btrace.parser.write_ddrescuelog(OPTIONS,
-                'non-tried', 'finished', 0, DEVSIZE)
-            if ddrescue.VIEWER is not None:
-                shutil.copyfile(btracelog, ddrescue.ddrlog)
 sm.add_persistent_task(btrace_poller)
 
 # EXECUTE
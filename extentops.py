@@ -0,0 +1,181 @@
+"""
+Bulk set algebra on sector extents: merge, union, complement, intersect, subtract.
+
+A run set is a (starts, nexts) pair of equal length arrays holding sorted,
+disjoint, non-adjacent half-open runs [start, next) of 512 byte sectors, the
+same form as an ExtentStore leaf. normalise() builds one from any extents.
+
+With NumPy the operations are vectorised over int64 arrays, which matters for
+the millions of extents of a whole filesystem. NumPy is optional: without it
+the same functions work on array('q') in pure Python, in linear time after the
+sort.
+
+##License:
+Original work Copyright 2016 Richard Case
+
+Everyone is permitted to copy, distribute and modify this software,
+subject to this statement and the copyright notice above being included.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND.
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
+"""
+from array import array
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Fewer extents than this, e.g. one file's, are quicker to merge without NumPy
+vector_min = 64
+
+def _new(values=()):
+    "Returns a 64 bit integer array of the backend in use."
+    if numpy is not None:
+        return numpy.asarray(values, dtype=numpy.int64)
+    return array('q', values)
+
+def empty():
+    "Returns an empty run set."
+    return (_new(), _new())
+
+def normalise(starts, lengths):
+    """Returns the run set of extents given as start & length sequences.
+
+    The extents may be in any order, overlap or touch; zero lengths are dropped.
+    Few extents give array('q') runs even with NumPy, which every function takes.
+    """
+    if numpy is not None and len(starts) >= vector_min:
+        starts = numpy.asarray(starts, dtype=numpy.int64)
+        lengths = numpy.asarray(lengths, dtype=numpy.int64)
+        keep = lengths > 0
+        starts, lengths = starts[keep], lengths[keep]
+        if not len(starts):
+            return empty()
+        order = numpy.argsort(starts, kind='stable')
+        starts = starts[order]
+        reach = numpy.maximum.accumulate(starts + lengths[order])
+        # A run begins where an extent starts beyond everything before it
+        first = numpy.flatnonzero(numpy.concatenate(([True],
+                                                    starts[1:] > reach[:-1])))
+        last = numpy.concatenate((first[1:] - 1, [len(starts) - 1]))
+        return (starts[first], reach[last])
+    out_starts, out_nexts = array('q'), array('q')
+    for start, n in sorted(zip(starts, lengths)):
+        if n <= 0:
+            continue
+        if out_nexts and start <= out_nexts[-1]:
+            if start + n > out_nexts[-1]:
+                out_nexts[-1] = start + n
+        else:
+            out_starts.append(start)
+            out_nexts.append(start + n)
+    return (out_starts, out_nexts)
+
+def from_extents(extents):
+    "Returns the run set of an iterable of (start, n_sectors)."
+    starts, lengths = array('q'), array('q')
+    for start, n in extents:
+        starts.append(start)
+        lengths.append(n)
+    return normalise(starts, lengths)
+
+def extents(runs):
+    "Returns the runs as a list of (start, n_sectors) tuples."
+    starts, nexts = runs
+    return [(int(start), int(nxt - start)) for start, nxt in zip(starts, nexts)]
+
+def sectors(runs):
+    "Returns the number of sectors covered."
+    starts, nexts = runs
+    if numpy is not None:
+        return int(numpy.sum(numpy.asarray(nexts, dtype=numpy.int64)) -
+                   numpy.sum(numpy.asarray(starts, dtype=numpy.int64)))
+    return sum(nexts) - sum(starts)
+
+def _concat(a, b):
+    if numpy is not None:
+        return numpy.concatenate((numpy.asarray(a, dtype=numpy.int64),
+                                  numpy.asarray(b, dtype=numpy.int64)))
+    return array('q', a) + array('q', b)
+
+def _lengths(runs):
+    starts, nexts = runs
+    if numpy is not None:
+        return (numpy.asarray(nexts, dtype=numpy.int64) -
+                numpy.asarray(starts, dtype=numpy.int64))
+    return array('q', (nxt - start for start, nxt in zip(starts, nexts)))
+
+def union(a, b):
+    "Returns the runs covered by either run set."
+    return normalise(_concat(a[0], b[0]), _concat(_lengths(a), _lengths(b)))
+
+def clip(runs, lo, hi):
+    "Returns the runs cut to [lo, hi)."
+    starts, nexts = runs
+    if numpy is not None:
+        starts = numpy.maximum(numpy.asarray(starts, dtype=numpy.int64), lo)
+        nexts = numpy.minimum(numpy.asarray(nexts, dtype=numpy.int64), hi)
+        keep = nexts > starts
+        return (starts[keep], nexts[keep])
+    out_starts, out_nexts = array('q'), array('q')
+    for start, nxt in zip(starts, nexts):
+        start, nxt = max(start, lo), min(nxt, hi)
+        if nxt > start:
+            out_starts.append(start)
+            out_nexts.append(nxt)
+    return (out_starts, out_nexts)
+
+def complement(runs, lo, hi):
+    "Returns the gaps between the runs within [lo, hi)."
+    starts, nexts = clip(runs, lo, hi)
+    # Gaps run from each next, or lo, to the following start, or hi
+    gap_starts = _concat(_new((lo,)), nexts)
+    gap_nexts = _concat(starts, _new((hi,)))
+    if numpy is not None:
+        keep = gap_nexts > gap_starts
+        return (gap_starts[keep], gap_nexts[keep])
+    out_starts, out_nexts = array('q'), array('q')
+    for start, nxt in zip(gap_starts, gap_nexts):
+        if nxt > start:
+            out_starts.append(start)
+            out_nexts.append(nxt)
+    return (out_starts, out_nexts)
+
+def _bounds(a, b):
+    "Returns (lo, hi) spanning both run sets, None if both are empty."
+    ends = [(runs[0][0], runs[1][-1]) for runs in (a, b) if len(runs[0])]
+    if not ends:
+        return None
+    return (int(min(lo for lo, hi in ends)), int(max(hi for lo, hi in ends)))
+
+def intersect(a, b):
+    "Returns the runs covered by both run sets."
+    bounds = _bounds(a, b)
+    if bounds is None or not len(a[0]) or not len(b[0]):
+        return empty()
+    lo, hi = bounds
+    return complement(union(complement(a, lo, hi), complement(b, lo, hi)), lo, hi)
+
+def subtract(a, b):
+    "Returns the runs of a not covered by b."
+    if not len(a[0]) or not len(b[0]):
+        return a
+    lo, hi = _bounds(a, b)
+    return intersect(a, complement(b, lo, hi))
+
+class Batch(object):
+    "Collects extents cheaply for one normalise(), e.g. a whole filesystem's."
+    def __init__(self):
+        self.starts = array('q')
+        self.lengths = array('q')
+
+    def __len__(self):
+        return len(self.starts)
+
+    def add(self, start, n):
+        self.starts.append(start)
+        self.lengths.append(n)
+
+    def runs(self):
+        "Returns the run set of the extents collected."
+        return normalise(self.starts, self.lengths)
@@ -0,0 +1,245 @@
+"""
+Ordered store of disjoint sector extents with merge on insert.
+
+Extents are half-open intervals [start, next) of 512 byte sectors. Adjacent or
+overlapping extents are merged as they are added, so the store always holds the
+minimal sorted list of runs.
+
+The runs are kept in a two level B+tree: a list of leaf blocks, each holding
+up to 2 * _LOAD sorted runs, plus an index of the last 'next' sector of every
+leaf. Locating an extent is two bisections, O(log n), and an insert or merge
+only shifts items within one bounded leaf. Leaves are split when they grow too
+large and dropped when emptied by a merge.
+
+Leaves are array('Q') pairs of start and next sectors, 16 bytes per run with
+no per-run Python objects, which matters for millions of extents.
+
+Sorted, disjoint runs from extentops can be added in bulk with update(): a
+large batch is merged with the existing runs in one pass and the leaves are
+rebuilt, instead of locating and inserting each run.
+
+##License:
+Original work Copyright 2016 Richard Case
+
+Everyone is permitted to copy, distribute and modify this software,
+subject to this statement and the copyright notice above being included.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND.
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
+"""
+from bisect import bisect_left, bisect_right
+from array import array
+import sys
+import extentops
+
+_LOAD = 512
+# update() rebuilds the leaves when adding at least 1/_BULK_RATIO of the runs
+_BULK_RATIO = 8
+
+class ExtentStore(object):
+    "Sorted, merged set of (start, n_sectors) extents."
+    def __init__(self):
+        # Parallel leaves of start and next sectors, plus the leaf index
+        self._starts = []
+        self._nexts = []
+        self._maxes = []
+        self._len = 0
+        self._tuples = None
+        # Sector range touched and number of adds since the last take_dirty()
+        self.dirty = None
+        self.added = 0
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        "Yields (start, n_sectors) tuples in start sector order."
+        for starts, nexts in zip(self._starts, self._nexts):
+            for start, nxt in zip(starts, nexts):
+                yield (start, nxt - start)
+
+    def __repr__(self):
+        return 'ExtentStore(runs={}, sectors={})'.format(self._len, self.sectors())
+
+    def clear(self):
+        "Removes all extents."
+        self.__init__()
+
+    def tolist(self):
+        "Returns the extents as a list of tuples, cached until the next change."
+        if self._tuples is None:
+            self._tuples = list(self)
+        return self._tuples
+
+    def runs(self):
+        "Returns the extentops run set, (starts, nexts) arrays."
+        starts, nexts = array('Q'), array('Q')
+        for leaf_starts, leaf_nexts in zip(self._starts, self._nexts):
+            starts.extend(leaf_starts)
+            nexts.extend(leaf_nexts)
+        return (starts, nexts)
+
+    def sectors(self):
+        "Returns the total number of sectors covered."
+        total = 0
+        for starts, nexts in zip(self._starts, self._nexts):
+            total += sum(nexts) - sum(starts)
+        return total
+
+    def nbytes(self):
+        "Returns the approximate memory used by the leaves and index in bytes."
+        total = sys.getsizeof(self._starts) + sys.getsizeof(self._nexts)
+        total += sys.getsizeof(self._maxes) + 32 * len(self._maxes)
+        for starts, nexts in zip(self._starts, self._nexts):
+            total += sys.getsizeof(starts) + sys.getsizeof(nexts)
+        return total
+
+    def take_dirty(self):
+        "Returns and resets ((lo, hi) sector range or None, adds) changed since last call."
+        result = (self.dirty, self.added)
+        self.dirty = None
+        self.added = 0
+        return result
+
+    def irange(self, lo, hi):
+        "Yields (start, n_sectors) for runs with lo <= start < hi, in order."
+        if not self._starts:
+            return
+        leaf, pos = self._locate(lo)
+        while leaf < len(self._starts):
+            starts, nexts = self._starts[leaf], self._nexts[leaf]
+            for i in range(pos, len(starts)):
+                if starts[i] >= hi:
+                    return
+                if starts[i] >= lo:
+                    yield (starts[i], nexts[i] - starts[i])
+            leaf, pos = leaf + 1, 0
+
+    def _locate(self, sector):
+        "Returns (leaf, pos) of the first run whose next is >= sector."
+        leaf = bisect_left(self._maxes, sector)
+        if leaf == len(self._maxes):
+            leaf -= 1
+            return (leaf, len(self._starts[leaf]))
+        return (leaf, bisect_left(self._nexts[leaf], sector))
+
+    def add(self, start, n):
+        "Adds an extent, merging with any overlapping or adjacent runs."
+        if start < 0 or n < 0:
+            raise Exception('ExtentStore.add: Input less than zero: {}:{}'
+                                .format(start, n))
+        if n == 0:
+            return
+        self._tuples = None
+        self.added += 1
+        nxt = start + n
+        if not self._starts:
+            self._starts.append(array('Q', (start,)))
+            self._nexts.append(array('Q', (nxt,)))
+            self._maxes.append(nxt)
+            self._len = 1
+            self.dirty = (start, nxt)
+            return
+
+        first_leaf, first_pos = self._locate(start)
+        # Scan forward for every run starting at or before the new next,
+        # these all touch the new extent and are absorbed into it
+        leaf, pos = first_leaf, first_pos
+        removed = 0
+        while leaf < len(self._starts):
+            starts = self._starts[leaf]
+            end = bisect_right(starts, nxt, pos)
+            if end > pos:
+                if leaf == first_leaf and pos == first_pos:
+                    start = min(start, starts[pos])
+                nxt = max(nxt, self._nexts[leaf][end - 1])
+                removed += end - pos
+            if end < len(starts):
+                break
+            leaf, pos = leaf + 1, 0
+        last_leaf, last_pos = leaf, (end if leaf < len(self._starts) else 0)
+
+        if removed:
+            self._delete(first_leaf, first_pos, last_leaf, last_pos)
+        starts = self._starts[first_leaf]
+        nexts = self._nexts[first_leaf]
+        starts.insert(first_pos, start)
+        nexts.insert(first_pos, nxt)
+        self._maxes[first_leaf] = nexts[-1]
+        self._len += 1 - removed
+        if self.dirty is None:
+            self.dirty = (start, nxt)
+        else:
+            self.dirty = (min(self.dirty[0], start), max(self.dirty[1], nxt))
+        if len(starts) > 2 * _LOAD:
+            self._split(first_leaf)
+
+    def update(self, starts, nexts):
+        """Adds sorted, disjoint runs [start, next), e.g. an extentops run set.
+
+        Small batches are added run by run; larger ones are merged in one pass.
+        """
+        count = len(starts)
+        if count == 0:
+            return
+        if starts[0] < 0:
+            raise Exception('ExtentStore.update: Input less than zero: {}'
+                                .format(starts[0]))
+        if count * _BULK_RATIO < self._len:
+            for start, nxt in zip(starts, nexts):
+                self.add(int(start), int(nxt - start))
+            return
+        lo, hi = int(starts[0]), int(nexts[-1])
+        if self._len:
+            starts, nexts = extentops.union(self.runs(), (starts, nexts))
+        self._build(starts, nexts)
+        self.added += count
+        if self.dirty is None:
+            self.dirty = (lo, hi)
+        else:
+            self.dirty = (min(self.dirty[0], lo), max(self.dirty[1], hi))
+
+    def _build(self, starts, nexts):
+        "Replaces the leaves with sorted, disjoint runs."
+        if not isinstance(starts, array):
+            # NumPy arrays convert through their buffers
+            starts = array('Q', starts.astype('uint64').tobytes())
+            nexts = array('Q', nexts.astype('uint64').tobytes())
+        elif starts.typecode != 'Q':
+            starts, nexts = array('Q', starts), array('Q', nexts)
+        self._starts = [starts[i:i + _LOAD] for i in range(0, len(starts), _LOAD)]
+        self._nexts = [nexts[i:i + _LOAD] for i in range(0, len(nexts), _LOAD)]
+        self._maxes = [leaf[-1] for leaf in self._nexts]
+        self._len = len(starts)
+        self._tuples = None
+
+    def _delete(self, first_leaf, first_pos, last_leaf, last_pos):
+        "Deletes runs from (first_leaf, first_pos) up to (last_leaf, last_pos)."
+        if first_leaf == last_leaf:
+            del self._starts[first_leaf][first_pos:last_pos]
+            del self._nexts[first_leaf][first_pos:last_pos]
+            return
+        # The first leaf is kept even if emptied since the merged run goes there
+        del self._starts[first_leaf][first_pos:]
+        del self._nexts[first_leaf][first_pos:]
+        if last_leaf < len(self._starts):
+            del self._starts[last_leaf][:last_pos]
+            del self._nexts[last_leaf][:last_pos]
+            if self._starts[last_leaf]:
+                self._maxes[last_leaf] = self._nexts[last_leaf][-1]
+            else:
+                last_leaf += 1
+        del self._starts[first_leaf + 1:last_leaf]
+        del self._nexts[first_leaf + 1:last_leaf]
+        del self._maxes[first_leaf + 1:last_leaf]
+
+    def _split(self, leaf):
+        "Splits a full leaf in two."
+        starts = self._starts[leaf]
+        nexts = self._nexts[leaf]
+        self._starts.insert(leaf + 1, starts[_LOAD:])
+        self._nexts.insert(leaf + 1, nexts[_LOAD:])
+        del starts[_LOAD:]
+        del nexts[_LOAD:]
+        self._maxes[leaf] = nexts[-1]
+        self._maxes.insert(leaf + 1, self._nexts[leaf + 1][-1])
@@ -0,0 +1,179 @@
+"""
+ext2/3/4 used blocks from the superblock, group descriptors and block bitmaps.
+
+Every group's block bitmap is read, except groups flagged BLOCK_UNINIT (only
+trusted with the uninit_bg/gdt_csum or metadata_csum features) whose bitmap was
+never written. For those the used blocks are computed as the kernel does: the
+superblock backup and group descriptor blocks at the start of the group. The
+block and inode bitmaps and inode table of every group are added from the
+descriptors, since with flex_bg they live in another group, which may itself
+be uninitialised.
+
+##License:
+Original work Copyright 2016 Richard Case
+
+Everyone is permitted to copy, distribute and modify this software,
+subject to this statement and the copyright notice above being included.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND.
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
+"""
+import struct, logging
+from fsmap import bit_runs
+
+EXT_MAGIC = 0xEF53
+COMPAT_SPARSE_SUPER2 = 0x200
+INCOMPAT_META_BG = 0x10
+INCOMPAT_64BIT = 0x80
+RO_COMPAT_SPARSE_SUPER = 0x1
+RO_COMPAT_GDT_CSUM = 0x10
+RO_COMPAT_BIGALLOC = 0x200
+RO_COMPAT_METADATA_CSUM = 0x400
+BG_BLOCK_UNINIT = 0x2
+# Bitmaps read per pread when they are consecutive, e.g. with flex_bg
+max_batch = 256
+
+class Superblock(object):
+    "The ext superblock fields needed to find the block bitmaps."
+    def __init__(self, data):
+        (self.inodes_count, blocks_lo, self.first_data_block, log_block_size,
+            self.blocks_per_group, self.inodes_per_group) = \
+            struct.unpack_from('<IIxxxxxxxxxxxxIIxxxxIxxxxI', data, 0)
+        magic = struct.unpack_from('<H', data, 0x38)[0]
+        if magic != EXT_MAGIC:
+            raise Exception('Bad ext superblock magic: {:#x}'.format(magic))
+        self.blocksize = 1024 << log_block_size
+        self.inode_size = struct.unpack_from('<H', data, 0x58)[0]
+        self.compat, self.incompat, self.ro_compat = \
+            struct.unpack_from('<III', data, 0x5C)
+        self.reserved_gdt = struct.unpack_from('<H', data, 0xCE)[0]
+        desc_size = struct.unpack_from('<H', data, 0xFE)[0]
+        self.first_meta_bg = struct.unpack_from('<I', data, 0x104)[0]
+        blocks_hi = struct.unpack_from('<I', data, 0x150)[0]
+        self.backup_bgs = struct.unpack_from('<II', data, 0x24C)
+        if self.ro_compat & RO_COMPAT_BIGALLOC:
+            raise Exception('ext bigalloc cluster bitmaps are not supported')
+        if self.incompat & INCOMPAT_64BIT:
+            self.blocks_count = blocks_lo | blocks_hi << 32
+            self.desc_size = max(desc_size, 32)
+        else:
+            self.blocks_count = blocks_lo
+            self.desc_size = 32
+        self.groups = -(-(self.blocks_count - self.first_data_block)
+                            // self.blocks_per_group)
+        self.descs_per_block = self.blocksize // self.desc_size
+        self.gdt_blocks = -(-self.groups // self.descs_per_block)
+        self.meta_bg = bool(self.incompat & INCOMPAT_META_BG)
+        self.uninit = bool(self.ro_compat &
+                            (RO_COMPAT_GDT_CSUM | RO_COMPAT_METADATA_CSUM))
+
+    def has_super(self, group):
+        "Returns True if the group holds a superblock (backup)."
+        if group == 0:
+            return True
+        if self.compat & COMPAT_SPARSE_SUPER2:
+            return group in self.backup_bgs
+        if group == 1 or not self.ro_compat & RO_COMPAT_SPARSE_SUPER:
+            return True
+        for base in (3, 5, 7):
+            power = base
+            while power < group:
+                power *= base
+            if power == group:
+                return True
+        return False
+
+    def group_first_block(self, group):
+        return self.first_data_block + group * self.blocks_per_group
+
+    def base_meta_blocks(self, group):
+        "Returns the number of superblock & descriptor blocks at the group start."
+        num = int(self.has_super(group))
+        if (not self.meta_bg or
+                group < self.first_meta_bg * self.descs_per_block):
+            if num:
+                num += self.first_meta_bg if self.meta_bg else self.gdt_blocks
+                num += self.reserved_gdt
+        else:
+            first = group - group % self.descs_per_block
+            if group in (first, first + 1, first + self.descs_per_block - 1):
+                num += 1
+        return num
+
+    def descriptor_block(self, n):
+        "Returns the block number of the nth group descriptor table block."
+        if not self.meta_bg or n < self.first_meta_bg:
+            return self.first_data_block + n + 1
+        group = self.descs_per_block * n
+        return self.group_first_block(group) + int(self.has_super(group))
+
+def read_descriptors(volume, sb):
+    "Returns a list of (block bitmap, inode bitmap, inode table, flags) per group."
+    descs = []
+    for n in range(sb.gdt_blocks):
+        data = volume.read(sb.blocksize * sb.descriptor_block(n), sb.blocksize)
+        for i in range(min(sb.descs_per_block, sb.groups - len(descs))):
+            offset = i * sb.desc_size
+            bbitmap, ibitmap, itable = struct.unpack_from('<III', data, offset)
+            flags = struct.unpack_from('<H', data, offset + 0x12)[0]
+            if sb.desc_size >= 64:
+                hi = struct.unpack_from('<III', data, offset + 0x20)
+                bbitmap |= hi[0] << 32
+                ibitmap |= hi[1] << 32
+                itable |= hi[2] << 32
+            descs.append((bbitmap, ibitmap, itable, flags))
+    return descs
+
+def used_blocks(volume):
+    "Yields (first block, count) of used blocks."
+    sb = Superblock(volume.read(1024, 1024))
+    logging.debug('ext: {} groups of {} {}B blocks, flags compat={:#x} '
+                  'incompat={:#x} ro_compat={:#x}'
+                    .format(sb.groups, sb.blocks_per_group, sb.blocksize,
+                            sb.compat, sb.incompat, sb.ro_compat))
+    descs = read_descriptors(volume, sb)
+    itable_blocks = -(-sb.inodes_per_group * sb.inode_size // sb.blocksize)
+    # Boot block and primary superblock, outside group 0 with 1KiB blocks
+    yield (0, max(sb.first_data_block + 1, 2048 // sb.blocksize))
+    uninit = 0
+    group = 0
+    while group < sb.groups:
+        bbitmap, ibitmap, itable, flags = descs[group]
+        yield (bbitmap, 1)
+        yield (ibitmap, 1)
+        yield (itable, itable_blocks)
+        first = sb.group_first_block(group)
+        if sb.uninit and flags & BG_BLOCK_UNINIT:
+            uninit += 1
+            yield (first, sb.base_meta_blocks(group))
+            group += 1
+            continue
+        # Batch this and any following groups with consecutive bitmaps
+        count = 1
+        while (count < max_batch and group + count < sb.groups and
+                descs[group + count][0] == bbitmap + count and
+                not (sb.uninit and descs[group + count][3] & BG_BLOCK_UNINIT)):
+            count += 1
+        data = volume.read(sb.blocksize * bbitmap, sb.blocksize * count)
+        for i in range(count):
+            first = sb.group_first_block(group + i)
+            nblocks = min(sb.blocks_per_group, sb.blocks_count - first)
+            bitmap = data[i * sb.blocksize:i * sb.blocksize + -(-nblocks // 8)]
+            for start, n in bit_runs(bitmap):
+                n = min(start + n, nblocks) - start
+                if n > 0:
+                    yield (first + start, n)
+            if i:
+                bbitmap, ibitmap, itable, flags = descs[group + i]
+                yield (bbitmap, 1)
+                yield (ibitmap, 1)
+                yield (itable, itable_blocks)
+        group += count
+    logging.debug('ext: {} BLOCK_UNINIT groups'.format(uninit))
+
+def used_extents(volume):
+    "Yields used (start, n_sectors) extents."
+    blocksize = Superblock(volume.read(1024, 1024)).blocksize
+    factor = blocksize // 512
+    for start, n in used_blocks(volume):
+        yield (start * factor, n * factor)
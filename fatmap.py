@@ -0,0 +1,166 @@
+"""
+FAT12/16/32 and exFAT used clusters from the FAT or allocation bitmap.
+
+FAT: the reserved sectors, FATs and FAT12/16 root directory are always used,
+then a data cluster is used when its FAT entry is not zero. The FAT is read in
+chunks as an array of entries and reduced to one byte per cluster at C speed,
+so runs of used clusters are found with a regex rather than a Python loop.
+
+exFAT: the boot region and FAT are always used, then the allocation bitmap,
+found from its entry in the root directory, has one bit per heap cluster.
+
+##License:
+Original work Copyright 2016 Richard Case
+
+Everyone is permitted to copy, distribute and modify this software,
+subject to this statement and the copyright notice above being included.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND.
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
+"""
+import re, sys, struct, logging
+from array import array
+from fsmap import bit_runs
+
+EXFAT_OEM = b'EXFAT   '
+EXFAT_ENTRY_BITMAP = 0x81
+FAT32_MASK = 0x0FFFFFFF
+# Entries per read of the FAT
+chunk_entries = 2**20
+_used_runs = re.compile(b'\x01+')
+
+def _nonzero(entries):
+    "Returns one byte per entry, 1 if the entry is not zero."
+    return bytes(map(bool, entries))
+
+class BPB(object):
+    "FAT BIOS parameter block."
+    def __init__(self, data):
+        (self.bytes_per_sector, self.sectors_per_cluster, self.reserved,
+            self.fats, self.root_entries, total16, fat16) = \
+            struct.unpack_from('<HBHBHHxH', data, 0x0B)
+        total32, fat32 = struct.unpack_from('<II', data, 0x20)
+        if (data[510:512] != b'\x55\xAA' or not self.bytes_per_sector or
+                not self.sectors_per_cluster or not self.fats):
+            raise Exception('Not a FAT boot sector')
+        self.total = total16 or total32
+        self.fat_sectors = fat16 or fat32
+        root_sectors = -(-32 * self.root_entries // self.bytes_per_sector)
+        self.first_data = self.reserved + self.fats * self.fat_sectors + root_sectors
+        self.clusters = (self.total - self.first_data) // self.sectors_per_cluster
+        if self.clusters < 4085:
+            self.fat_type = 12
+        elif self.clusters < 65525:
+            self.fat_type = 16
+        else:
+            self.fat_type = 32
+
+def fat_used_clusters(volume, bpb):
+    "Yields (first cluster index from 0, count) of used data clusters."
+    fat_pos = bpb.reserved * bpb.bytes_per_sector
+    if bpb.fat_type == 12:
+        size = -(-3 * (bpb.clusters + 2) // 2)
+        fat = volume.read(fat_pos, size)
+        used = bytearray(bpb.clusters)
+        for cluster in range(2, bpb.clusters + 2):
+            word = struct.unpack_from('<H', fat, cluster * 3 // 2)[0]
+            used[cluster - 2] = bool(word >> 4 if cluster & 1 else word & 0xFFF)
+        for m in _used_runs.finditer(used):
+            yield (m.start(), m.end() - m.start())
+        return
+    width = bpb.fat_type // 8
+    typecode = 'H' if width == 2 else 'I'
+    if array(typecode).itemsize != width:
+        typecode = 'L'
+    # Entries 0 & 1 are reserved, the data clusters start at entry 2
+    entry = 2
+    last = bpb.clusters + 2
+    while entry < last:
+        n = min(chunk_entries, last - entry)
+        entries = array(typecode, volume.read(fat_pos + width * entry, width * n))
+        if sys.byteorder == 'big':
+            entries.byteswap()
+        if width == 4:
+            entries = map(FAT32_MASK.__and__, entries)
+        for m in _used_runs.finditer(_nonzero(entries)):
+            yield (entry - 2 + m.start(), m.end() - m.start())
+        entry += n
+
+def fat_used_extents(volume, bpb):
+    "Yields used (start, n_sectors) extents of a FAT volume."
+    factor = bpb.bytes_per_sector // 512
+    logging.debug('fat: FAT{} with {} clusters of {} sectors'
+                    .format(bpb.fat_type, bpb.clusters, bpb.sectors_per_cluster))
+    yield (0, bpb.first_data * factor)
+    spc = bpb.sectors_per_cluster
+    for start, n in fat_used_clusters(volume, bpb):
+        yield ((bpb.first_data + start * spc) * factor, n * spc * factor)
+
+class ExfatBoot(object):
+    "exFAT boot sector."
+    def __init__(self, data):
+        (self.fat_offset, self.fat_length, self.heap_offset, self.clusters,
+            self.root_cluster) = struct.unpack_from('<IIIII', data, 0x50)
+        bps_shift, spc_shift = struct.unpack_from('<BB', data, 0x6C)
+        self.bytes_per_sector = 1 << bps_shift
+        self.cluster_size = self.bytes_per_sector << spc_shift
+        self.pages = {}
+
+    def cluster_pos(self, cluster):
+        "Returns the byte position of a heap cluster, numbered from 2."
+        return (self.heap_offset * self.bytes_per_sector +
+                (cluster - 2) * self.cluster_size)
+
+    def chain(self, volume, cluster):
+        "Yields the clusters of a FAT chain."
+        seen = 0
+        while 2 <= cluster < self.clusters + 2:
+            yield cluster
+            seen += 1
+            if seen > self.clusters:
+                raise Exception('exFAT FAT chain loop at cluster {}'.format(cluster))
+            pos = self.fat_offset * self.bytes_per_sector + 4 * cluster
+            page = pos - pos % 4096
+            if page not in self.pages:
+                self.pages[page] = volume.read(page, 4096)
+            cluster = struct.unpack_from('<I', self.pages[page], pos - page)[0]
+
+def exfat_bitmap(volume, boot):
+    "Returns (first cluster, length in bytes) of the allocation bitmap."
+    for cluster in boot.chain(volume, boot.root_cluster):
+        data = volume.read(boot.cluster_pos(cluster), boot.cluster_size)
+        for offset in range(0, len(data), 32):
+            etype = data[offset]
+            if etype == 0:
+                raise Exception('exFAT allocation bitmap entry not found')
+            if etype == EXFAT_ENTRY_BITMAP:
+                return struct.unpack_from('<IQ', data, offset + 20)
+    raise Exception('exFAT allocation bitmap entry not found')
+
+def exfat_used_extents(volume, boot):
+    "Yields used (start, n_sectors) extents of an exFAT volume."
+    factor = boot.bytes_per_sector // 512
+    spc = boot.cluster_size // boot.bytes_per_sector
+    logging.debug('exfat: {} clusters of {}B'.format(boot.clusters, boot.cluster_size))
+    yield (0, boot.heap_offset * factor)
+    first, length = exfat_bitmap(volume, boot)
+    remaining = min(length, -(-boot.clusters // 8))
+    bit = 0
+    for cluster in boot.chain(volume, first):
+        n = min(boot.cluster_size, remaining)
+        for start, count in bit_runs(volume.read(boot.cluster_pos(cluster), n)):
+            count = min(start + count, boot.clusters - bit) - start
+            if count > 0:
+                sector = boot.heap_offset + (bit + start) * spc
+                yield (sector * factor, count * spc * factor)
+        bit += 8 * n
+        remaining -= n
+        if remaining <= 0:
+            break
+
+def used_extents(volume):
+    "Yields used (start, n_sectors) extents."
+    data = volume.read(0, 512)
+    if data[3:11] == EXFAT_OEM:
+        return exfat_used_extents(volume, ExfatBoot(data))
+    return fat_used_extents(volume, BPB(data))
@@ -0,0 +1,155 @@
+"""
+Techniques for allocating all the free space of a mounted filesystem to a file.
+
+The file's extents are then the free space, see getused.MapExtents._foundfree.
+  fallocate - fallocate(2) mode 0, allocates unwritten extents without any data
+              writes; fails with EOPNOTSUPP where unsupported (no emulation)
+  sparse - writes the last 512KiB only; filesystems without sparse files, like
+           vfat, allocate everything before it
+  fill - writes zeros until ENOSPC with O_DIRECT from one reused, page aligned
+         buffer; halves the write size at ENOSPC to fill the last blocks
+The technique that worked is recorded per fstype in the destination directory so
+later partitions and runs try it first.
+
+##License:
+Original work Copyright 2016 Richard Case
+
+Everyone is permitted to copy, distribute and modify this software,
+subject to this statement and the copyright notice above being included.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND.
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
+"""
+import os, errno, fcntl, mmap, json, ctypes, ctypes.util, logging
+from imagecopy import Progress
+import mapfile
+
+TECHNIQUES = ('fallocate', 'sparse', 'fill')
+cache_filename = 'freespace.json'
+lock_suffix = '.lock'
+fill_buffer = 8 * 2**20
+min_write = 4096
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+_libc.fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64,
+                            ctypes.c_int64)
+
+def fallocate(fd, mode, offset, length):
+    "fallocate(2), raises OSError. mode is a combination of FALLOC_FL_* flags."
+    if _libc.fallocate(fd, mode, offset, length) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+def by_fallocate(path, nbytes):
+    "Allocates nbytes, retrying a little smaller on ENOSPC. Returns bytes allocated."
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        for _ in range(4):
+            try:
+                fallocate(fd, 0, 0, nbytes)
+                return nbytes
+            except OSError as e:
+                if e.errno != errno.ENOSPC:
+                    raise
+                # Metadata for the new file can use some of the reported space
+                nbytes -= max(nbytes // 100, 512 * 1024)
+        raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC), path)
+    finally:
+        os.close(fd)
+
+def by_sparse(path, nbytes):
+    "Writes only the last 512KiB of nbytes. Returns the file size."
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        tail = 512 * 1024
+        os.pwrite(fd, bytes(tail), max(nbytes - tail, 0))
+        os.fsync(fd)
+        return max(nbytes, tail)
+    finally:
+        os.close(fd)
+
+def by_fill(path, nbytes):
+    """Writes zeros until ENOSPC, or nbytes plus a margin. Returns bytes written.
+
+    nbytes - the reported free space, only used for progress and as a limit in
+             case the filesystem never reports ENOSPC
+    """
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    try:
+        fd = os.open(path, flags | os.O_DIRECT, 0o644)
+    except OSError as e:
+        if e.errno != errno.EINVAL:
+            raise
+        logging.debug('O_DIRECT not supported for {}, using buffered writes'
+                        .format(path))
+        fd = os.open(path, flags, 0o644)
+    # Anonymous mmap memory is zeroed and page aligned, as O_DIRECT requires
+    buf = mmap.mmap(-1, fill_buffer)
+    view = memoryview(buf)
+    progress = Progress('Filling free space', nbytes)
+    limit = nbytes + fill_buffer
+    written = 0
+    size = fill_buffer
+    try:
+        while written < limit:
+            try:
+                n = os.write(fd, view[:size])
+            except OSError as e:
+                if e.errno not in (errno.ENOSPC, errno.EINVAL):
+                    raise
+                if size <= min_write:
+                    if e.errno == errno.ENOSPC:
+                        break
+                    raise
+                # Fill what is left with smaller writes
+                size //= 2
+                continue
+            if n < size:
+                # Partial write: the filesystem is full
+                written += n
+                progress.add(n)
+                break
+            written += n
+            progress.add(n)
+        os.fsync(fd)
+    finally:
+        view.release()
+        buf.close()
+        os.close(fd)
+    logging.info('Filled {} MB, {:.1f} MB/s'.format(written // 2**20, progress.rate()))
+    return written
+
+class TechniqueCache(object):
+    """Remembers which technique found the free space for each fstype.
+
+    Concurrent mapping workers share the file, so it is updated under a lock.
+    """
+    def __init__(self, directory):
+        self.path = os.path.join(directory, cache_filename)
+        self.known = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def order(self, fstype):
+        "Returns the techniques to try, the last successful one first."
+        best = self.known.get(fstype)
+        if best not in TECHNIQUES:
+            return list(TECHNIQUES)
+        return [best] + [t for t in TECHNIQUES if t != best]
+
+    def record(self, fstype, technique):
+        if fstype is None or self.known.get(fstype) == technique:
+            return
+        with open(self.path + lock_suffix, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Keep what other workers recorded since we loaded
+            self.known = self._load()
+            self.known[fstype] = technique
+            mapfile.replace_atomic(self.path,
+                                   json.dumps(self.known, indent=1, sort_keys=True))
+        logging.debug('Free space technique for {} is {}'.format(fstype, technique))
@@ -59,6 +59,15 @@ _FILESYSTEMS = {
         None,
         None,
         None ),
+    'exfat': (
+        # exFAT uses the NTFS partition type id, 0x07
+        'NTFS',
+        'mkfs.exfat -L EXFAT',
+        ('fsck.exfat', '-n'),
+        ('fsck.exfat', '-p'),
+        None,
+        None,
+        None ),
     'ext2': _EXT,
     'ext3': _EXT,
     'ext4': _EXT,
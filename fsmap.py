@@ -0,0 +1,109 @@
+"""
+Native filesystem allocation map readers.
+
+For filesystems with a backend, the used space is read straight from the
+allocation structures on the (read-only) image or device: no mount, no image
+copy and no fill file. Backends are modules with a function:
+
+  used_extents(volume) - yields (start, n_sectors) used extents relative to the
+                         partition start, in any order; raises Exception if the
+                         filesystem cannot be parsed
+
+##License:
+Original work Copyright 2016 Richard Case
+
+Everyone is permitted to copy, distribute and modify this software,
+subject to this statement and the copyright notice above being included.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND.
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
+"""
+import os, re, importlib
+
+# fstype -> backend module name, imported on first use
+BACKENDS = {
+    'ext2': 'extmap',
+    'ext3': 'extmap',
+    'ext4': 'extmap',
+    'ntfs': 'ntfsmap',
+    'vfat': 'fatmap',
+    'exfat': 'fatmap',
+    'xfs': 'xfsmap',
+    'hfsplus': 'hfsmap',
+    }
+
+def supported(fstype):
+    "Returns True if there is a native allocation map reader for the fstype."
+    return fstype in BACKENDS
+
+def used_extents(fstype, path, start, size):
+    """Yields the used (start, n_sectors) extents of a partition.
+
+    path - image file or device holding the partition
+    start, size - partition start & size in 512B sectors
+    Extents are absolute sectors in path and clipped to the partition.
+    """
+    backend = importlib.import_module(BACKENDS[fstype])
+    with Volume(path, start, size) as volume:
+        for estart, n in backend.used_extents(volume):
+            n = min(estart + n, size) - estart
+            if n > 0:
+                yield (start + estart, n)
+
+class Volume(object):
+    "Read-only access to a partition inside an image file or device."
+    def __init__(self, path, start, size):
+        "start, size - partition offset & size in 512B sectors"
+        self.path = path
+        self.offset = 512 * start
+        self.size = 512 * size
+        self.fd = None
+
+    def __enter__(self):
+        self.fd = os.open(self.path, os.O_RDONLY)
+        return self
+
+    def __exit__(self, *exc):
+        os.close(self.fd)
+        self.fd = None
+
+    def read(self, pos, size):
+        "Returns size bytes at byte position pos in the partition."
+        if pos < 0 or pos + size > self.size:
+            raise Exception('Read {}:{} outside partition of {} bytes!'
+                                .format(pos, size, self.size))
+        data = os.pread(self.fd, size, self.offset + pos)
+        if len(data) != size:
+            raise Exception('Short read {}:{} from {}!'
+                                .format(pos, size, self.path))
+        return data
+
+_notzero = re.compile(b'[^\x00]')
+_notfull = re.compile(b'[^\xff]')
+
+def bit_runs(bitmap, msb_first=False):
+    """Yields (first bit, count) for every run of set bits in a bitmap.
+
+    Bits are numbered from the least significant bit of each byte unless
+    msb_first. Whole 0x00 and 0xFF bytes are skipped by regex search, so only
+    the bytes where runs start or end are examined bit by bit.
+    """
+    order = range(7, -1, -1) if msb_first else range(8)
+    first = None
+    i, n = 0, len(bitmap)
+    while i < n:
+        m = (_notzero if first is None else _notfull).search(bitmap, i)
+        if m is None:
+            break
+        i = m.start()
+        byte = bitmap[i]
+        for pos, bit in enumerate(order):
+            if byte >> bit & 1:
+                if first is None:
+                    first = 8 * i + pos
+            elif first is not None:
+                yield (first, 8 * i + pos - first)
+                first = None
+        i += 1
+    if first is not None:
+        yield (first, 8 * n - first)
@@ -10,7 +10,7 @@ subject to this statement and the copyright notice above being included.
 THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND.
 IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
 """
-import logging, os
+import logging
 import helpers, fs
 
 # For debugging: import pdb; pdb.set_trace()
@@ -82,7 +82,8 @@ def scanmeta_running(options, device, ptable, mode='ro', partinfo=[]):
                     logging.warning('Detected errors on partition: {}'
                                         .format(partn))
                 # Walk the filesystem to read all inodes - required
+                # The walker lstats every inode so nothing else is needed
                 if mode != 'rw':
-                    for path in helpers.fswalk(options, loop):
-                        os.stat(path)
+                    for path, st in helpers.fswalk(options, loop):
+                        pass
 
@@ -11,26 +11,111 @@ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND.
 IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
 """
 from btrace import BtraceParser
+from extents import ExtentStore
+from array import array
 import helpers
 import ddrescue
-import fsmeta, clone
-import os, re, logging, shutil
+import fsmeta, clone, fiemap, fsmap, freespace, checkpoint, priority, impact
+import extentops
+import os, re, stat, glob, signal, random, logging, shutil, multiprocessing
 from shlex import quote
 
 # For debugging: import pdb; pdb.set_trace() # DEBUG
 
+# Partitions mapped at once when walking the source device itself
+device_jobs = 1
+# Extents collected before they are added to the store in bulk
+batch_extents = 2**20
+# The mapper in the parent process, inherited by forked pool workers
+_mapper = None
+# Held by a pool worker finding free space, which writes to the destination
+_free_lock = None
+
+def _worker_exit(sig, frame):
+    # Unwinds the worker so its mounts are removed
+    raise SystemExit(1)
+
+def _pool_init():
+    "Sets up a mapping pool worker; the parent handles Ctrl+C and cleans up."
+    # Forked workers would otherwise pick the same random mount points
+    random.seed()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for sig in (signal.SIGHUP, signal.SIGQUIT, signal.SIGTERM):
+        signal.signal(sig, _worker_exit)
+
+def _map_worker(job):
+    return _mapper._mappart(*job)
+
 class MapExtents(BtraceParser):
     "Class for getting used filesystem space either by walking files or filling empty space."
-    def __init__(self, options, devsize, usedevice=False):
+    def __init__(self, options, devsize, usedevice=False, resume=False):
         self.usedevice = usedevice
+        # Only a run resumed at this stage may load the checkpoints
+        self.resume = resume
         self.devsize = devsize
         self.options = options
-        self.extents = []
-        self.start_sectors = []
+        self.store = ExtentStore()
+        self.batch = extentops.Batch()
+        self.extent_reader = fiemap.ExtentReader(self._filefrag_extents)
+        # Checkpoint of the partition being mapped & resumed walk positions
+        self.checkpoint = None
+        self.positions = {}
+        # Extents of the files matching the --priority rules
+        rules = getattr(options, 'priority', None)
+        self.priority = priority.PriorityMap(rules) if rules else None
+        # Starts of the partitions whose files were all walked for the map
+        self.walked = set()
+        # Index every file's extents for the damage report, see impact.py
+        self.impact = getattr(options, 'impact', False)
 
     ddrlog_suffix = '.used.log'
+    checkpoint_suffix = '.map.{}.ckpt'
     logmagic = 'DataRescue'
 
+    def add_extent(self, start, n):
+        "Collects an extent, they are added to the store in bulk by _flush."
+        if start < 0 or n < 0:
+            raise Exception('add_extent: Input less than zero: {}:{}'
+                                .format(start, n))
+        self.batch.add(start, n)
+        if self.checkpoint is not None:
+            self.checkpoint.add(start, n)
+        if len(self.batch) >= batch_extents:
+            self._flush()
+
+    def add_runs(self, runs):
+        "Adds an extentops run set, e.g. a whole filesystem's extents, in bulk."
+        self._flush()
+        self.store.update(*runs)
+        if self.checkpoint is not None:
+            for extent in extentops.extents(runs):
+                self.checkpoint.add(*extent)
+
+    def _flush(self):
+        "Adds the collected extents to the store."
+        if len(self.batch):
+            self.store.update(*self.batch.runs())
+            self.batch = extentops.Batch()
+
+    def _checkpoint_path(self, start):
+        return helpers.image(self.options) + self.checkpoint_suffix.format(start)
+
+    def _start_checkpoint(self, start, size):
+        "Returns the checkpoint recording the extents added for a partition."
+        self.checkpoint = checkpoint.Checkpoint(self._checkpoint_path(start),
+                                                start, size)
+        return self.checkpoint
+
+    def _end_checkpoint(self, completed=None):
+        """Closes the partition's checkpoint, first saving an unfinished walk.
+
+        completed - walk position of the last completely mapped entry
+        """
+        ckpt, self.checkpoint = self.checkpoint, None
+        if not ckpt.done and completed is not None:
+            ckpt.mark(completed, force=True)
+        ckpt.close()
+
     def _getpartn(self, source, mode, partinfo):
         """Generator for returning mounted partitions in the source.
 
@@ -45,7 +130,6 @@ class MapExtents(BtraceParser):
                         yield mnt, fstype, start, size
 
     _pat_filefrag = re.compile(r"\s*\d+:\s+\d+\.\.\s+\d+:\s+(\d+)\.\.\s+(\d+):\s+(\d+)")
-    # hdparm --fibmap v9.43 has a bug fixed in v9.45
     # filefrag has a bug in v1.42.9 fixed in v1.42.12
     # Another bug requires 1.43-WIP 2015 or later
     # Example:
@@ -61,60 +145,34 @@ class MapExtents(BtraceParser):
     # 186:  6152192.. 6275071:   32641024..  32763903: 122880:   33308416:
     # 187:  6275072.. 6291455:   32784384..  32800767:  16384:   32763904: eof
     #edisk.img: 185 extents found
-    def _parse_extents(self, path, offset, diskorder=True):
-        "Parse file extents & return sorted extent list & the number of sectors."
+    def _filefrag_extents(self, path):
+        "Returns the file's extents in file order from filefrag, relative to partition start."
         text = helpers.get_procoutput(['filefrag', '-b512', '-e', path])[1]
         genline = (m.group(0) for m in re.finditer(r"^.+$", text, re.MULTILINE))
-        total = 0
         extent_list = []
         for line in genline:
             ematch = self._pat_filefrag.match(line)
             if ematch:
                 extent = ematch.groups()
-                # filefrag returns physical offsets relative to partition start
-                start = int(extent[0]) + offset
-                size = int(extent[2])
-                total += size
-                extent_list += [(start, size)]
-        if total > 0 and len(extent_list) > 0:
-            # merge consecutive extents
-            if diskorder:
-                # sort by start sector; default is file order
-                extent_list.sort(key=lambda e: e[0])
-            mergetotal = 0
-            merged = []
-            prev_start, prev_size = None, None
-            for estart, esize in extent_list:
-                # start
-                if prev_start is None:
-                    prev_start, prev_size = estart, esize
-                # consecutive
-                elif prev_start + prev_size == estart:
-                    prev_size += esize
-                elif estart + esize == prev_start:
-                    prev_start = estart
-                    prev_size += esize
-                # overlap!
-                elif (prev_start <= estart < prev_start + prev_size or
-                      prev_start < estart + esize <= prev_start + prev_size):
-                    logging.error('Overlap found: {}:{} & {}:{}'
-                            .format(prev_start, prev_size, estart, esize))
-                    prev_start = min(prev_start, estart)
-                    prev_size = max(prev_start + prev_size, estart + esize) - prev_start
-                # gap
-                else:
-                    merged += [(prev_start, prev_size)]
-                    mergetotal += prev_size
-                    prev_start, prev_size = estart, esize
-            merged += [(prev_start, prev_size)]
-            mergetotal += prev_size
-            logging.debug('Merged extents: before={}:{}, after={}:{}, list={}'
-                .format(len(extent_list), total, len(merged), mergetotal, merged))
-            if total != mergetotal:
-                logging.warning('filefrag extent overlaps giving incorrect size!')
-            extent_list = merged
-            total = mergetotal
-        return total, extent_list
+                extent_list += [(int(extent[0]), int(extent[2]))]
+        return extent_list
+
+    def _parse_extents(self, path, offset):
+        "Parse file extents & return sorted, merged extent list & the number of sectors."
+        starts, lengths = array('q'), array('q')
+        # FIEMAP, or filefrag where unsupported, gives offsets relative to partition start
+        for start, size in self.extent_reader(path):
+            starts.append(start + offset)
+            lengths.append(size)
+        total = sum(lengths)
+        runs = extentops.normalise(starts, lengths)
+        mergetotal = extentops.sectors(runs)
+        extent_list = extentops.extents(runs)
+        logging.debug('Merged extents: before={}:{}, after={}:{}, list={}'
+            .format(len(starts), total, len(extent_list), mergetotal, extent_list))
+        if total != mergetotal:
+            logging.warning('File extent overlaps giving incorrect size!')
+        return mergetotal, extent_list
 
     def _getfreesectors(self, mnt):
         "Returns integer numbers: (blocksize, freespace) in 512 byte sectors."
@@ -130,28 +188,23 @@ class MapExtents(BtraceParser):
         """
         nsectors, elist = self._parse_extents(freespace, pstart)
         if nsectors > 1024:
-            usedstart = pstart
-            usedtotal = 0
-            # Add dummy free extent for end of partition space
-            elist += [(pstart + psize, 0)]
-            for estart, esize in elist:
-                usedsize = estart - usedstart
-                self.add_extent(usedstart, usedsize)
-                usedstart = estart + esize
-                usedtotal += usedsize
-            logging.info('Found {} MB used.'.format(usedtotal//2048))
+            used = extentops.complement(extentops.from_extents(elist),
+                                        pstart, pstart + psize)
+            self.add_runs(used)
+            logging.info('Found {} MB used.'.format(extentops.sectors(used)//2048))
             return nsectors
         else:
             return 0
 
-    def _findfreesectors(self, mnt, start, size):
+    def _findfreesectors(self, mnt, start, size, fstype=None):
         """Gets the list of free sectors by allocating them to a file.
 
         Needs rw permission.
-        Tries 3 techniques (uses the equivalent python file commands instead of dd):
-        1. hdparm --fallocate <nk>(1024bytes) <file> - returns 95 on operation not supported
-        2. dd if=/dev/zero of=<file> bs=512*1024 count=1 seek=<nsectors//1024-1>
-        3. dd if=/dev/zero of=<file> bs=<512*x> count=<nsectors//x>
+        Tries 3 techniques from freespace, the one that last worked for the
+        fstype first:
+        1. fallocate: fallocate(2) the reported free space, no data written
+        2. sparse: write the last 512KiB at the free space size
+        3. fill: O_DIRECT zero writes until the filesystem is full
         """
         free = self._getfreesectors(mnt)[1]
         if free <= 1024:
@@ -160,43 +213,40 @@ class MapExtents(BtraceParser):
             return 0
         # Some filesystems sometimes can't seem to fill all reported free space
         free -= 64
+        if _free_lock is None:
+            return self._freetechniques(mnt, start, size, fstype, free)
+        # One worker at a time, so each checks the space left by the others
+        with _free_lock:
+            return self._freetechniques(mnt, start, size, fstype, free)
+
+    def _freetechniques(self, mnt, start, size, fstype, free):
+        "Tries the freespace techniques in turn, see _findfreesectors."
         empty = os.path.join(mnt, 'emptyspace.zeros')
-        # 1. FALLOCATE
-        cmd = ['hdparm', '--fallocate', str(free // 2), empty]
-        proc = helpers.get_procoutput(cmd)[0]
-        if proc.returncode == 0:
-            nsectors = self._foundfree(empty, start, size)
-            if nsectors:
+        cache = freespace.TechniqueCache(self.options.dest_directory)
+        for technique in cache.order(fstype):
+            if technique == 'fill':
+                # Check destination has enough space
+                destfree = self._getfreesectors(self.options.dest_directory)[1]
+                if free > destfree:
+                    logging.error('Not enough destination space to fill empty blocks')
+                    continue
+                logging.warning('Filling image free space with zeros to find extents...')
+            try:
+                getattr(freespace, 'by_' + technique)(empty, free * 512)
+                nsectors = self._foundfree(empty, start, size)
+            except OSError as e:
+                logging.debug('Free space technique {} failed: {}'
+                                .format(technique, e))
+                nsectors = 0
+            finally:
                 helpers.removefile(empty)
+            if nsectors:
+                cache.record(fstype, technique)
                 return nsectors
-        helpers.removefile(empty)
-        # 2. DD SPARSE
-        with open(empty, 'wb') as f:
-            with open('/dev/zero', 'rb') as z:
-                f.seek((free - 1024) * 512)
-                zeros = z.read(1024 * 512)
-                f.write(zeros)
-        nsectors = self._foundfree(empty, start, size)
-        helpers.removefile(empty)
-        if nsectors:
-            return nsectors
-        # 3. DD FILL
-        # Check destination has enough space
-        destfree = self._getfreesectors(self.options.dest_directory)[1]
-        if free > destfree:
-            logging.error('Not enough destination space to fill empty blocks')
-            return 0
-        else:
-            logging.warning('Filling image free space with zeros to find extents...')
-        with open(empty, 'wb') as f:
-            for _ in range(free//1024):
-                f.write(zeros)
-        nsectors = self._foundfree(empty, start, size)
-        helpers.removefile(empty)
-        return nsectors
-
-    def _dataclone(self, partinfo, usedmethod, source, mode):
-        "Tries to clone the data otherwise maps the data blocks."
+        return 0
+
+    def _dataclone(self, partinfo):
+        "Tries to clone the data. Returns (partinfo, partitions still to map)."
         # (devpath, start, size, fstype, clonemeta & clonedata results)
         partinfo = clone.clonedata(self.options, self.devsize, partinfo)
         tomap = []
@@ -206,31 +256,146 @@ class MapExtents(BtraceParser):
             else:
                 logging.info('Skipping data map of {}: start={}, size={}, type={}'
                                     .format(*part[:4]))
-        if tomap:
-            self._findallused(usedmethod, source, mode, tomap)
+        return partinfo, tomap
+
+    def _nativemap(self, partinfo):
+        """Maps partitions by reading their allocation maps directly.
+
+        Needs no mount or image copy. Returns the partitions left to map,
+        unsupported or failed ones.
+        """
+        if self.usedevice:
+            source = self.options.device
         else:
-            # Create empty usedlog in case of resume
-            self.write_log()
-            logging.info("No mapping required!")
-        return partinfo
+            source = helpers.image(self.options)
+        tomap = []
+        for part in partinfo:
+            start, size, fstype = part[1:4]
+            if not fsmap.supported(fstype):
+                tomap += [part]
+                continue
+            logging.info('Reading {} allocation map of pt {}:{}'
+                            .format(fstype, start, size))
+            found = ExtentStore()
+            try:
+                for extent in fsmap.used_extents(fstype, source, start, size):
+                    found.add(*extent)
+            except Exception as e:
+                logging.warning('Native {} map of pt {}:{} failed, using fallback: {}'
+                                    .format(fstype, start, size, e))
+                tomap += [part]
+                continue
+            ckpt = self._start_checkpoint(start, size)
+            try:
+                self.add_runs(found.runs())
+                ckpt.finish()
+            finally:
+                self._end_checkpoint()
+            logging.info('Found {} MB used.'.format(found.sectors()//2048))
+        return tomap
+
+    def _resume(self, partinfo):
+        """Loads the extents of earlier, interrupted runs from the checkpoints.
+
+        Returns the partitions not completely mapped, their walk positions are
+        kept in self.positions.
+        """
+        tomap = []
+        for part in partinfo:
+            start, size = part[1:3]
+            ckpt = checkpoint.Checkpoint(self._checkpoint_path(start), start, size)
+            position = ckpt.load(self.add_extent)
+            if ckpt.done:
+                logging.info('Skipping data map of pt {}:{}, mapped before resume'
+                                .format(start, size))
+                continue
+            if position:
+                self.positions[start] = position
+            tomap += [part]
+        return tomap
 
     def map(self, partinfo, usedmethod=None):
         "Setup the mapping."
-        if usedmethod is True:
-            mode = 'ro'
+        if usedmethod is True or self.usedevice:
+            return self._map(partinfo, usedmethod, None)
+        # Take image copy before we clone the data
+        with helpers.ImageCopy(self.options) as imagecopy:
+            return self._map(partinfo, usedmethod, imagecopy)
+
+    def _map(self, partinfo, usedmethod, imagecopy):
+        """Clones the data, then maps the rest natively or by usedmethod.
+
+        imagecopy - scratch copy of the image for the Free method, or None
+        """
+        partinfo, tomap = self._dataclone(partinfo)
+        towalk = tomap
+        if self.resume:
+            tomap = self._resume(tomap)
+        else:
+            # Checkpoints of another run, e.g. kept logs, do not describe this one
+            remove_checkpoints(self.options, force=True)
+        if self.impact:
+            # Indexes of a previous run are only valid for partitions not remapped
+            for part in tomap:
+                impact.remove_partition(self.options, part[1])
+        if tomap and usedmethod is None:
+            tomap = self._nativemap(tomap)
+        if not tomap:
+            logging.info("No further mapping required!")
+        elif usedmethod is True:
             if self.usedevice:
                 source = self.options.device
             else:
                 source = helpers.image(self.options)
-            return self._dataclone(partinfo, usedmethod, source, mode)
+            self._findallused(usedmethod, source, 'ro', tomap)
         else:
-            mode = 'rw'
             if self.usedevice:
                 raise Exception('Writing to device using free space method is not permitted.')
             else:
-                # Take image copy before we clone the data
-                with helpers.ImageCopy(self.options) as source:
-                    return self._dataclone(partinfo, usedmethod, source, mode)
+                self._findallused(usedmethod, imagecopy, 'rw', tomap)
+        if self.priority is not None:
+            self._prioritize(towalk)
+        # Create usedlog in case of resume
+        self.write_log()
+        return partinfo
+
+    def _prioritize_file(self, mnt, start, filepath, st, extents=None):
+        """Adds a regular file's extents to its priority tier, if it has one.
+
+        extents - the file's extents if already known, else they are read
+        """
+        if not stat.S_ISREG(st.st_mode):
+            return
+        tier = self.priority.tier(os.path.relpath(filepath, mnt), st.st_size)
+        if tier is None:
+            return
+        if extents is None:
+            extents = self._parse_extents(filepath, start)[1]
+        self.priority.add_file(tier, extents)
+
+    def _prioritize(self, partinfo):
+        """Writes the priority domain mapfiles for the partitions to rescue.
+
+        Partitions mapped without a full walk, natively, by free space or
+        before a resume, are walked read only for the files matching a rule;
+        only those files' extents are read.
+        """
+        towalk = [part for part in partinfo if part[1] not in self.walked]
+        if towalk:
+            if self.usedevice:
+                source = self.options.device
+            else:
+                source = helpers.image(self.options)
+            try:
+                for mnt, fstype, start, size in self._getpartn(source, 'ro', towalk):
+                    logging.info('Finding priority files in pt {}:{} of type {}'
+                                    .format(start, size, fstype))
+                    for filepath, st in helpers.getfile(mnt):
+                        self._prioritize_file(mnt, start, filepath, st)
+            except Exception as e:
+                # The priority passes are an optimisation, the rescue goes on
+                logging.warning('Finding priority files failed: {}'.format(e))
+        self.priority.write_domains(self.options, self.devsize)
 
     def _findallused(self, usedmethod, source, mode, partinfo):
         """Gets the used disk extents.
@@ -241,29 +406,156 @@ class MapExtents(BtraceParser):
         By default perform the Used method for ext2, ext3 and NTFS,
         otherwise Free. This is for performance reasons on finding free space.
         Can be overridden by passing usedmethod=True/False as parameter.
+        Partitions are mapped concurrently by a pool of processes, see _jobs;
+        their free space is found one at a time as it fills the destination.
         """
-        for mnt, fstype, start, size in self._getpartn(source, mode, partinfo):
-            logging.info('Mapping {} pt {}:{} of type {} on {}'
-            .format(source, str(start), str(size), fstype, mnt))
-
-            if (usedmethod is True or
-                (usedmethod is None and fstype in ['ext2', 'ext3', 'ntfs'])):
-                total_sectors = 0
-                for filepath in helpers.getfile(mnt):
+        global _mapper, _free_lock
+        with helpers.AttachLoop(source, mode) as loop:
+            jobs = [(usedmethod, mode, loopdev, fstype, start, size)
+                    for dev, loopdev, start, size, fstype, rclonemeta, rclonedata
+                        in helpers.getcommonparts(partinfo, loop)]
+            nworkers = min(len(jobs), self._jobs(source))
+            if nworkers <= 1:
+                for job in jobs:
+                    self._merge(*self._mappart(*job))
+                return
+            logging.info('Mapping {} partitions with {} processes'
+                            .format(len(jobs), nworkers))
+            # Forked workers inherit the mapper instead of it being pickled
+            _mapper = self
+            context = multiprocessing.get_context('fork')
+            _free_lock = context.Lock()
+            try:
+                with context.Pool(nworkers, _pool_init) as pool:
+                    for result in pool.imap_unordered(_map_worker, jobs):
+                        self._merge(*result)
+            finally:
+                _mapper = None
+                _free_lock = None
+
+    def _jobs(self, source):
+        "Returns the number of partitions to map at once when walking source."
+        jobs = getattr(self.options, 'jobs', 0) or os.cpu_count() or 1
+        if source == self.options.device:
+            # Concurrent walks would make a failing source seek back and forth
+            jobs = min(jobs, device_jobs)
+        return jobs
+
+    def _mappart(self, usedmethod, mode, loopdev, fstype, start, size):
+        """Maps one partition into new stores, in a pool worker or not.
+
+        Returns (start, extent store, priority map or None, all files walked).
+        """
+        saved = self.store, self.batch, self.priority
+        self.store = ExtentStore()
+        self.batch = extentops.Batch()
+        if self.priority is not None:
+            self.priority = priority.PriorityMap(self.priority.rules)
+        try:
+            with helpers.MountPoint(self.options) as mnt, \
+                 helpers.Mount(loopdev, mnt, mode):
+                logging.info('Mapping {} pt {}:{} of type {} on {}'
+                .format(loopdev, str(start), str(size), fstype, mnt))
+                if (usedmethod is True or
+                    (usedmethod is None and fstype in ['ext2', 'ext3', 'ntfs'])):
+                    walked = self._mapused(mnt, start, size)
+                else:
+                    self._mapfree(mnt, fstype, start, size)
+                    walked = False
+            self._flush()
+            return (start, self.store, self.priority, walked)
+        finally:
+            self.store, self.batch, self.priority = saved
+
+    def _merge(self, start, store, tiers, walked):
+        "Adds the mapping of a partition returned by _mappart."
+        self.add_runs(store.runs())
+        if tiers is not None:
+            self.priority.merge(tiers)
+        if walked:
+            self.walked.add(start)
+
+    def _mapused(self, mnt, start, size):
+        "Maps the partition by walking its files. Returns True if all were walked."
+        total_sectors = 0
+        ckpt = self._start_checkpoint(start, size)
+        walk = helpers.getfile(mnt, self.positions.get(start, 0))
+        index = None
+        if self.impact:
+            index = impact.IndexWriter(self.options, start)
+        completed = None
+        try:
+            for filepath, st in walk:
+                # Links are walked through their target; outside targets
+                # are not on this filesystem
+                if not stat.S_ISLNK(st.st_mode):
                     sects, elist = self._parse_extents(filepath, start)
                     for e in elist: self.add_extent(*e)
                     logging.log(5, 'Used: {} sectors in {} extents for {}'
                                 .format(sects, len(elist), filepath))
                     total_sectors += sects
-                logging.info('Found {} MB used.'.format(total_sectors//2048))
-            else:
-                # Requires rw permission
-                sects = self._findfreesectors(mnt, start, size)
-                logging.info('Found {} MB free.'.format(sects//2048))
-        self.write_log()
+                    if self.priority is not None:
+                        self._prioritize_file(mnt, start, filepath, st, elist)
+                    if index is not None and stat.S_ISREG(st.st_mode):
+                        index.add_file(os.path.relpath(filepath, mnt),
+                                        st.st_size, elist)
+                completed = walk.position
+                ckpt.mark(completed)
+            ckpt.finish()
+        finally:
+            self._end_checkpoint(completed)
+            if index is not None:
+                # A resumed walk did not see the files before its position
+                index.close(ckpt.done and not walk.skip)
+        logging.info('Found {} MB used.'.format(total_sectors//2048))
+        logging.debug('FIEMAP calls: {}, filefrag fallbacks: {}'
+                        .format(self.extent_reader.calls,
+                                self.extent_reader.fallbacks))
+        return not walk.skip
+
+    def _mapfree(self, mnt, fstype, start, size):
+        "Maps the partition by allocating its free space, needs rw permission."
+        # A partly filled partition is redone
+        ckpt = self._start_checkpoint(start, size)
+        try:
+            sects = self._findfreesectors(mnt, start, size, fstype)
+            if sects:
+                ckpt.finish()
+        finally:
+            self._end_checkpoint()
+        logging.info('Found {} MB free.'.format(sects//2048))
+
+    def index_files(self, partinfo):
+        """Indexes the files of partitions not walked while mapping, see impact.py.
+
+        Walks the image read only, after the data rescue its metadata is complete.
+        """
+        done = impact.indexed(self.options)
+        towalk = [part for part in partinfo if not part[5] and part[1] not in done]
+        if not towalk:
+            return
+        if self.usedevice:
+            source = self.options.device
+        else:
+            source = helpers.image(self.options)
+        for mnt, fstype, start, size in self._getpartn(source, 'ro', towalk):
+            logging.info('Indexing files of pt {}:{} of type {}'
+                            .format(start, size, fstype))
+            index = impact.IndexWriter(self.options, start)
+            complete = False
+            try:
+                for filepath, st in helpers.getfile(mnt):
+                    if stat.S_ISREG(st.st_mode):
+                        elist = self._parse_extents(filepath, start)[1]
+                        index.add_file(os.path.relpath(filepath, mnt),
+                                        st.st_size, elist)
+                complete = True
+            finally:
+                index.close(complete)
 
     def write_log(self):
         "Overwrites a ddrescue compatible file, output is directly useful."
+        self._flush()
         helpers.removefile(ddrescue.ddrlog)
         self.write_ddrescuelog(self.options, 'non-tried', 'bad-sector',
                                 0, self.devsize)
@@ -272,5 +564,18 @@ class MapExtents(BtraceParser):
         else:
             shutil.move(self.usedlog, ddrescue.ddrlog)
             self.usedlog = None
+            # The used log is now the resume point
+            remove_checkpoints(self.options, force=True)
         return
 
+
+def checkpoint_paths(options):
+    "Returns the paths of MapExtents checkpoints left by an interrupted run."
+    pattern = MapExtents.checkpoint_suffix.format('*')
+    return glob.glob(glob.escape(helpers.image(options)) + pattern)
+
+def remove_checkpoints(options, force=False):
+    "Removes the MapExtents checkpoints unless logs are kept."
+    if force or not options.keeplogs:
+        for path in checkpoint_paths(options):
+            helpers.removefile(path)
@@ -12,15 +12,19 @@ IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
 """
 import subprocess
 import signal
-import os, io, sys, time, re
+import os, io, sys, time
 import logging
-import parse_args
+import parse_args, walker, imagecopy
 import random, string, glob
 from contextlib import contextmanager
 
 @contextmanager
 def ImageCopy(options):
-    "Uses cp command to preserve sparse files. Python shutil does not do this."
+    """Writable scratch copy of the image, removed on normal exit.
+
+    Reflinked where the destination supports it, otherwise only the data
+    segments are copied so holes are preserved. Python shutil does not do this.
+    """
     source = image(options)
     imglist = glob.glob(os.path.join(options.dest_directory, 'img.????????'))
     if len(imglist) > 1:
@@ -32,13 +36,10 @@ def ImageCopy(options):
     else:
         dest = randpath(options, 'img.')
         logging.info("Copying image to {}.".format(dest))
-        cmd = ['cp', '--sparse=always', source, dest]
         try:
-            proc = get_procoutput(cmd)[0]
-            if proc.returncode != 0:
-                raise Exception("Image copy failed!")
+            imagecopy.copy_sparse(source, dest)
         except:
-            os.remove(dest)
+            removefile(dest)
             raise
     yield dest
     # Only removes on normal exit for resume, not Exception
@@ -128,19 +129,19 @@ def randstring8():
     return ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(8))
 
 def fswalk(options, device):
-    "Generator for mounting and walking a filesystem ro, returning file/dir paths."
+    "Generator for mounting and walking a filesystem ro, returning (path, lstat) tuples."
     with MountPoint(options) as mnt:
         with Mount(device, mnt):
-            for path in getfile(mnt):
-                yield path
+            for path, st in getfile(mnt):
+                yield path, st
 
-def getfile(mnt):
-    "Generator for getting individual filesystem elements (files/dirs)."
-    for dirpath, dirs, files in os.walk(mnt):
-        for name in files:
-            yield os.path.join(dirpath, name)
-        for name in dirs:
-            yield os.path.join(dirpath, name)
+def getfile(mnt, skip=0):
+    """Generator for getting individual filesystem elements (files/dirs/links).
+
+    Yields (path, lstat) once per inode, in inode order for disk locality.
+    skip - walker position to continue an earlier walk from
+    """
+    return walker.Walker(mnt, inode_order=True, skip=skip)
 
 def getparts(looppath):
     """Get the list of subdevices for each partition detected in a block device.
@@ -234,18 +235,25 @@ def get_device_size(devpath):
         size = -1
     return size
 
+def get_device_queue(devpath, attribute):
+    "Returns an integer sysfs queue attribute of a block device, None if unavailable."
+    devname = os.path.split(devpath)[1]
+    paths = [os.path.join('/sys/class/block/', devname, 'queue', attribute),
+             # partitions have no queue directory of their own
+             os.path.join('/sys/class/block/', devname, '..', 'queue', attribute)]
+    for path in paths:
+        try:
+            with open(path, 'r') as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            pass
+    logging.debug("No queue attribute {} for {}".format(attribute, devpath))
+    return None
+
 def get_freeloop():
     "Returns the next free loop device string."
     return get_procoutput(['losetup', '--find'])[1]
 
-def grep(log, text):
-    "Quick grep for text in log, returns True if found."
-    with open(log, 'r') as fdesc:
-        for line in fdesc:
-            if re.search(text, line):
-                return True
-    return False
-
 def image(options):
     "Returns the image path."
     return os.path.join(options.dest_directory, options.image_filename)
@@ -274,12 +282,22 @@ def cmdlog(bulk, ret):
         bulk += ', RETURNCODE={}'.format(ret)
         logging.info(bulk)
 
+# Pids of every command the tool runs, so its own disk I/O can be told apart
+SPAWNED = set()
+SPAWN_LISTENERS = []
+def track_pid(pid):
+    "Records a pid started by the tool and tells any listeners."
+    SPAWNED.add(pid)
+    for listener in SPAWN_LISTENERS:
+        listener(pid)
+
 STRERROR = None
 def get_procoutput(cmd, cwd=None, shell=False, log=True, prunelog=True):
     "Runs a subprocess and returns (process object, stdout) tuple."
     global STRERROR
     proc = subprocess.Popen(cmd, cwd=cwd, shell=shell,
                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    track_pid(proc.pid)
     (stdout, stderr) = proc.communicate()
     out = stdout.decode('utf-8').strip()
     err = stderr.decode('utf-8').strip()
@@ -317,6 +335,7 @@ def generator_context_switch(cmd, cwd=None):
                     parse_args.reset_logging_config()
                     proc = subprocess.Popen(cmd, cwd=cwd,
                         stdin=old_stds[0], stdout=old_stds[1], stderr=old_stds[2])
+                    track_pid(proc.pid)
                     # Ensure we yield proc at least once
                     yield proc
                     while(proc.poll() == None):
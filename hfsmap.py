@@ -0,0 +1,79 @@
+"""
+HFS+ used blocks from the allocation file.
+
+The volume header holds the allocation file's fork data, whose extent records
+locate a bitmap with one bit per allocation block, most significant bit first.
+Only the 8 extents in the volume header are followed; an allocation file
+continued in the extents overflow file is reported as an error so the Free
+method is used instead. HFSX volumes have the same layout.
+
+##License:
+Original work Copyright 2016 Richard Case
+
+Everyone is permitted to copy, distribute and modify this software,
+subject to this statement and the copyright notice above being included.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND.
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
+"""
+import struct, logging
+from fsmap import bit_runs
+
+HFSPLUS_SIGNATURES = (b'H+', b'HX')
+HFS_SIGNATURE = b'BD'
+VOLUME_HEADER_POS = 1024
+ALLOCATION_FORK_POS = 0x70
+# Bitmap bytes per read
+chunksize = 4 * 2**20
+
+class VolumeHeader(object):
+    "The HFS+ volume header fields needed to read the allocation file."
+    def __init__(self, data):
+        signature = data[:2]
+        if signature == HFS_SIGNATURE:
+            raise Exception('HFS volumes and HFS wrapped HFS+ are not supported')
+        if signature not in HFSPLUS_SIGNATURES:
+            raise Exception('Bad HFS+ signature: {!r}'.format(signature))
+        self.blocksize, self.total_blocks = struct.unpack_from('>II', data, 0x28)
+        (self.alloc_size, clump, self.alloc_blocks) = \
+            struct.unpack_from('>QII', data, ALLOCATION_FORK_POS)
+        extents = struct.unpack_from('>16I', data, ALLOCATION_FORK_POS + 16)
+        self.alloc_extents = [(extents[i], extents[i + 1])
+                                for i in range(0, 16, 2) if extents[i + 1]]
+        if sum(n for start, n in self.alloc_extents) < self.alloc_blocks:
+            raise Exception('HFS+ allocation file continues in the extents '
+                            'overflow file, not supported')
+
+def used_blocks(volume, header):
+    "Yields (first allocation block, count) of used blocks."
+    remaining = min(header.alloc_size, -(-header.total_blocks // 8))
+    bit = 0
+    for start, count in header.alloc_extents:
+        size = min(count * header.blocksize, remaining)
+        done = 0
+        while done < size:
+            n = min(chunksize, size - done)
+            chunk = volume.read(start * header.blocksize + done, n)
+            for first, runlen in bit_runs(chunk, msb_first=True):
+                runlen = min(first + runlen, header.total_blocks - bit) - first
+                if runlen > 0:
+                    yield (bit + first, runlen)
+            bit += 8 * n
+            done += n
+        remaining -= size
+        if remaining <= 0:
+            break
+
+def used_extents(volume):
+    "Yields used (start, n_sectors) extents."
+    header = VolumeHeader(volume.read(VOLUME_HEADER_POS, 512))
+    logging.debug('hfsplus: {} blocks of {}B, allocation file in {} extents'
+                    .format(header.total_blocks, header.blocksize,
+                            len(header.alloc_extents)))
+    factor = header.blocksize // 512
+    # Boot blocks & volume header, then the alternate volume header
+    yield (0, 3)
+    end = header.total_blocks * factor
+    yield (end - 2, 2)
+    for start, n in used_blocks(volume, header):
+        yield (start * factor, n * factor)
@@ -0,0 +1,141 @@
+"""
+Fast sparse copies of image files for writable scratch images.
+
+Techniques are tried in order:
+  reflink - FICLONE ioctl, instant and shares blocks on btrfs & XFS destinations
+  copy_file_range - in-kernel copy of only the data segments found with
+                    SEEK_DATA/SEEK_HOLE, holes stay holes in the copy
+  read/write - the same segments through a userspace buffer, when the kernel
+               cannot copy between the two filesystems
+Progress and throughput are logged as the data segments are copied.
+
+##License:
+Original work Copyright 2016 Richard Case
+
+Everyone is permitted to copy, distribute and modify this software,
+subject to this statement and the copyright notice above being included.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND.
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
+"""
+import os, errno, time, logging
+from fcntl import ioctl
+
+FICLONE = 0x40049409
+# errnos meaning this technique cannot be used, try the next one
+fallback_errnos = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL,
+                   errno.ENOSYS, errno.EPERM, errno.EBADF)
+chunksize = 64 * 2**20
+progress_interval = 5.0
+
+def data_segments(fd, size):
+    "Yields (offset, length) of the data in a file, the whole file if holes are unknown."
+    pos = 0
+    while pos < size:
+        try:
+            start = os.lseek(fd, pos, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # Only a hole remains
+                return
+            if e.errno != errno.EINVAL:
+                raise
+            yield (pos, size - pos)
+            return
+        end = os.lseek(fd, start, os.SEEK_HOLE)
+        yield (start, end - start)
+        pos = end
+
+class Progress(object):
+    "Logs bytes copied and throughput at most every progress_interval seconds."
+    def __init__(self, label, total):
+        self.label = label
+        self.total = total
+        self.done = 0
+        self.start = self.last = time.monotonic()
+
+    def rate(self):
+        elapsed = time.monotonic() - self.start
+        return self.done / elapsed / 2**20 if elapsed > 0 else 0.0
+
+    def add(self, nbytes):
+        self.done += nbytes
+        now = time.monotonic()
+        if now - self.last >= progress_interval:
+            self.last = now
+            logging.info('{}: {} of {} MB data ({:.1f}%), {:.1f} MB/s'
+                            .format(self.label, self.done // 2**20,
+                                    self.total // 2**20,
+                                    100 * self.done / max(self.total, 1),
+                                    self.rate()))
+
+def _reflink(src, dst):
+    ioctl(dst, FICLONE, src)
+
+def _copy_range(src, dst, offset, length, progress):
+    end = offset + length
+    while offset < end:
+        n = os.copy_file_range(src, dst, min(chunksize, end - offset),
+                                offset, offset)
+        if n == 0:
+            raise OSError(errno.EIO, 'copy_file_range copied nothing at {}'
+                                        .format(offset))
+        offset += n
+        progress.add(n)
+
+def _copy_buffered(src, dst, offset, length, progress):
+    end = offset + length
+    while offset < end:
+        data = os.pread(src, min(chunksize, end - offset), offset)
+        if not data:
+            raise OSError(errno.EIO, 'Unexpected end of file at {}'.format(offset))
+        written = 0
+        while written < len(data):
+            written += os.pwrite(dst, data[written:], offset + written)
+        offset += len(data)
+        progress.add(len(data))
+
+def copy_sparse(source, dest):
+    """Copies source to a new file dest keeping holes. Returns the technique used.
+
+    Raises OSError on failure, dest may then be partially written.
+    """
+    src = os.open(source, os.O_RDONLY)
+    try:
+        size = os.fstat(src).st_size
+        dst = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            try:
+                _reflink(src, dst)
+                logging.info('Reflinked {} to {}'.format(source, dest))
+                return 'reflink'
+            except OSError as e:
+                if e.errno not in fallback_errnos:
+                    raise
+                logging.debug('Reflink not possible: {}'.format(e))
+            os.ftruncate(dst, size)
+            segments = list(data_segments(src, size))
+            progress = Progress('Copying {}'.format(os.path.basename(source)),
+                                sum(length for offset, length in segments))
+            technique = 'copy_file_range'
+            for offset, length in segments:
+                if technique == 'copy_file_range':
+                    try:
+                        _copy_range(src, dst, offset, length, progress)
+                        continue
+                    except OSError as e:
+                        if e.errno not in fallback_errnos:
+                            raise
+                        logging.debug('copy_file_range not possible: {}'.format(e))
+                        technique = 'read/write'
+                # Restart the segment, a partial in-kernel copy is simply rewritten
+                _copy_buffered(src, dst, offset, length, progress)
+            os.fsync(dst)
+            logging.info('Copied {} MB data in {} segments by {}, {:.1f} MB/s'
+                            .format(progress.done // 2**20, len(segments),
+                                    technique, progress.rate()))
+            return technique
+        finally:
+            os.close(dst)
+    finally:
+        os.close(src)
@@ -0,0 +1,225 @@
+"""
+Reports the files hit by the sectors ddrescue could not rescue.
+
+The file extents found while mapping are kept in an on-disk index, one set of
+files per partition so partitions can be indexed concurrently:
+  IMAGE.impact.START.paths - per file records of (size, path length, path);
+                             a file's id is the offset of its record
+  IMAGE.impact.START.idx - (byte start, byte length, file id) records, written
+                           as runs of up to run_records sorted by start
+  IMAGE.impact.START.json - the runs, written once all files are indexed
+The runs are merged into one sorted stream and joined in a single sweep with
+the sorted damaged ranges of the final mapfile, so the report takes time linear
+in files plus errors and memory in the runs and the damaged files only.
+
+##License:
+Original work Copyright 2016 Richard Case
+
+Everyone is permitted to copy, distribute and modify this software,
+subject to this statement and the copyright notice above being included.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND.
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
+"""
+import os, sys, glob, json, heapq, struct, logging
+from array import array
+from collections import deque
+import helpers, mapfile
+
+paths_suffix = '.impact.{}.paths'
+index_suffix = '.impact.{}.idx'
+meta_suffix = '.impact.{}.json'
+report_suffix = '.impact.tsv'
+# non-trimmed, non-scraped & bad-sector; unused space is also bad-sector but
+# is never in a file
+damaged_status = '*/-'
+file_struct = struct.Struct('<QI')
+record_size = 3 * 8
+run_records = 2**20
+read_records = 2**16
+
+def _paths(options, start):
+    base = helpers.image(options)
+    return (base + paths_suffix.format(start), base + index_suffix.format(start),
+            base + meta_suffix.format(start))
+
+class IndexWriter(object):
+    "Writes a new index of the files & extents of the partition at start."
+    def __init__(self, options, start):
+        self.paths_path, self.index_path, self.meta_path = _paths(options, start)
+        # An index without metadata is incomplete
+        helpers.removefile(self.meta_path)
+        self.runs = []
+        self.paths = open(self.paths_path, 'wb')
+        self.index = open(self.index_path, 'wb')
+        self.pending = array('Q')
+        self.files = 0
+
+    def add_file(self, relpath, size, extents):
+        "Adds a file's (start, n_sectors) extents."
+        fid = self.paths.tell()
+        path = os.fsencode(relpath)
+        self.paths.write(file_struct.pack(size, len(path)))
+        self.paths.write(path)
+        for start, n in extents:
+            self.pending.extend((512 * start, 512 * n, fid))
+        self.files += 1
+        if len(self.pending) >= 3 * run_records:
+            self._write_run()
+
+    def _write_run(self):
+        if not self.pending:
+            return
+        p = self.pending
+        records = sorted(zip(p[0::3], p[1::3], p[2::3]))
+        out = array('Q')
+        for record in records:
+            out.extend(record)
+        if sys.byteorder == 'big':
+            out.byteswap()
+        offset = self.index.tell() // record_size
+        self.index.write(out.tobytes())
+        self.runs.append((offset, len(records)))
+        self.pending = array('Q')
+
+    def close(self, complete=True):
+        """Closes the index; only a complete one gets its metadata and is used.
+
+        complete - False if not all the partition's files were added
+        """
+        self._write_run()
+        self.paths.close()
+        self.index.close()
+        if complete:
+            mapfile.replace_atomic(self.meta_path, json.dumps({'runs': self.runs}))
+        logging.debug('Impact index {}: {} files, {} runs{}'
+                        .format(self.paths_path, self.files, len(self.runs),
+                                '' if complete else ', incomplete'))
+
+def indexed(options):
+    "Returns {partition start: runs} of the completely indexed partitions."
+    prefix, suffix = _paths(options, '\0')[2].split('\0')
+    result = {}
+    for path in glob.glob(glob.escape(prefix) + '*' + glob.escape(suffix)):
+        start = path[len(prefix):len(path) - len(suffix)]
+        if not start.isdigit():
+            continue
+        try:
+            with open(path) as f:
+                result[int(start)] = json.load(f)['runs']
+        except (OSError, ValueError, KeyError):
+            logging.warning('Ignoring unreadable impact index {}'.format(path))
+    return result
+
+def _read_run(path, partstart, offset, count):
+    "Yields the (start, length, (partition start, file id)) records of one sorted run."
+    with open(path, 'rb') as f:
+        f.seek(offset * record_size)
+        while count > 0:
+            n = min(count, read_records)
+            block = array('Q')
+            block.frombytes(f.read(n * record_size))
+            if sys.byteorder == 'big':
+                block.byteswap()
+            if len(block) < 3 * n:
+                raise Exception('Impact index {} is truncated'.format(path))
+            for start, length, fid in zip(block[0::3], block[1::3], block[2::3]):
+                yield (start, length, (partstart, fid))
+            count -= n
+
+def extents(options):
+    "Yields all indexed (start, length, file key) in start order, in bytes."
+    runs = []
+    for partstart, partruns in sorted(indexed(options).items()):
+        index_path = _paths(options, partstart)[1]
+        runs += [_read_run(index_path, partstart, offset, count)
+                    for offset, count in partruns]
+    return heapq.merge(*runs)
+
+def damaged(path):
+    "Yields the (pos, size) in bytes of the damaged ranges of a mapfile."
+    for pos, size, status in mapfile.runs(path):
+        if status in damaged_status:
+            yield (pos, size)
+
+def join(extents, errors):
+    """Returns {file key: bytes lost} from start sorted extents & errors.
+
+    Errors must not overlap each other, extents may. Errors are only buffered
+    while they overlap the current extent.
+    """
+    lost = {}
+    window = deque()
+    errors = iter(errors)
+    pending = next(errors, None)
+    for start, length, fid in extents:
+        end = start + length
+        while window and window[0][0] + window[0][1] <= start:
+            window.popleft()
+        while pending is not None and pending[0] < end:
+            if pending[0] + pending[1] > start:
+                window.append(pending)
+            pending = next(errors, None)
+        for epos, esize in window:
+            if epos >= end:
+                break
+            overlap = min(end, epos + esize) - max(start, epos)
+            if overlap > 0:
+                lost[fid] = lost.get(fid, 0) + overlap
+    return lost
+
+def _file_records(options, keys):
+    "Yields ((partition start, file id), size, relpath) reading in file order."
+    f = None
+    current = None
+    try:
+        for key in sorted(keys):
+            partstart, fid = key
+            if partstart != current:
+                if f is not None:
+                    f.close()
+                f = open(_paths(options, partstart)[0], 'rb')
+                current = partstart
+            f.seek(fid)
+            size, pathlen = file_struct.unpack(f.read(file_struct.size))
+            yield (key, size, os.fsdecode(f.read(pathlen)))
+    finally:
+        if f is not None:
+            f.close()
+
+def report(options, ddrlog):
+    """Writes the per file damage report, worst first. Returns its path.
+
+    Columns: partition start sector, bytes lost, percent intact, size, path
+    """
+    lost = join(extents(options), damaged(ddrlog))
+    rows = []
+    for key, size, relpath in _file_records(options, lost):
+        nlost = min(lost[key], size)
+        intact = 100.0 * (size - nlost) / size if size else 0.0
+        rows.append((intact, -nlost, key[0], relpath, size))
+    rows.sort()
+    path = helpers.image(options) + report_suffix
+    with open(path, 'w') as f:
+        f.write('# partition\tbytes_lost\tpercent_intact\tsize\tpath\n')
+        for intact, nlost, partstart, relpath, size in rows:
+            f.write('{}\t{}\t{:.2f}\t{}\t{}\n'.format(partstart, -nlost, intact,
+                                                    size, relpath))
+    total = sum(-row[1] for row in rows)
+    if rows:
+        logging.warning('{} files are damaged, {} KiB lost, see {}'
+                            .format(len(rows), total // 1024, path))
+    else:
+        logging.info('No indexed file is damaged, see {}'.format(path))
+    return path
+
+def remove_partition(options, start):
+    "Removes the index files of the partition at start."
+    for path in _paths(options, start):
+        helpers.removefile(path)
+
+def remove_index(options):
+    "Removes the index files unless logs are kept, the report is kept."
+    if not options.keeplogs:
+        for partstart in indexed(options):
+            remove_partition(options, partstart)
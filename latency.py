@@ -0,0 +1,136 @@
+"""
+I/O latency histograms built from paired blktrace queue, issue and complete events.
+
+Latencies are binned on a log2 scale of microseconds, split by read/write and
+by disk zone so slow regions of a failing drive show up before ddrescue reads
+them:
+  Q2D - time queued in the kernel before issue to the device
+  D2C - device service time
+  Q2C - total request latency
+
+##License:
+Original work Copyright 2016 Richard Case
+
+Everyone is permitted to copy, distribute and modify this software,
+subject to this statement and the copyright notice above being included.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND.
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
+"""
+
+def bucket_label(bucket):
+    "Upper bound of a log2 microsecond bucket, e.g. '<4us'."
+    return '<{}us'.format(1 << bucket)
+
+def label_bucket(label):
+    "Inverse of bucket_label."
+    return (int(label[1:-2])).bit_length() - 1
+
+def zone_percentiles(latency, kind='D2C', fraction=0.9, rw='R'):
+    """Returns {zone index: latency upper bound in us} from a todict() result.
+
+    rw - 'R' or 'W', the percentile is taken over those requests only
+    """
+    merged = {}
+    for zone, hist in latency.get(kind, {}).get(rw, {}).items():
+        counts = merged.setdefault(int(zone[:-3]), {})
+        for label, count in hist.items():
+            bucket = label_bucket(label)
+            counts[bucket] = counts.get(bucket, 0) + count
+    gib = LatencyHistograms.zone_sectors // (2 * 1024**2)
+    result = {}
+    for zone, counts in merged.items():
+        total = sum(counts.values())
+        seen = 0
+        for bucket in sorted(counts):
+            seen += counts[bucket]
+            if seen >= fraction * total:
+                result[zone // gib] = 1 << bucket
+                break
+    return result
+
+def bucket_of(latency_ns):
+    "Returns the log2 microsecond bucket: 0 is <1us, 1 is <2us, 2 is <4us..."
+    return (max(latency_ns, 0) // 1000).bit_length()
+
+class LatencyHistograms(object):
+    "Pairs Q, D & C events per request start sector into latency histograms."
+    zone_sectors = 2 * 1024**2 # 1GiB zones
+    max_pending = 1000000
+
+    def __init__(self):
+        # (rw, sector) -> ns timestamp of the queue and issue events
+        self.queued = {}
+        self.issued = {}
+        # (kind, rw, zone) -> {bucket: count}
+        self.hists = {}
+        self.dropped = 0
+
+    def _add(self, kind, rw, sector, latency_ns):
+        key = (kind, rw, sector // self.zone_sectors)
+        hist = self.hists.setdefault(key, {})
+        bucket = bucket_of(latency_ns)
+        hist[bucket] = hist.get(bucket, 0) + 1
+
+    def event(self, action, rw, sector, time_ns):
+        """Records one trace event.
+
+        action - blkparse action character, rw - 'R' or 'W'
+        """
+        key = (rw, sector)
+        if 'Q' == action:
+            if len(self.queued) >= self.max_pending:
+                # Requests never completed, e.g. aborted; start again
+                self.dropped += len(self.queued)
+                self.queued.clear()
+            self.queued[key] = time_ns
+        elif 'D' == action:
+            if len(self.issued) >= self.max_pending:
+                self.dropped += len(self.issued)
+                self.issued.clear()
+            self.issued[key] = time_ns
+            queued = self.queued.get(key)
+            if queued is not None:
+                self._add('Q2D', rw, sector, time_ns - queued)
+        elif 'C' == action:
+            queued = self.queued.pop(key, None)
+            issued = self.issued.pop(key, None)
+            if issued is not None:
+                self._add('D2C', rw, sector, time_ns - issued)
+            if queued is not None:
+                self._add('Q2C', rw, sector, time_ns - queued)
+        elif action in 'MF':
+            # Merged into another request, so it will not complete on its own
+            self.queued.pop(key, None)
+
+    def todict(self):
+        "Returns JSON-able nested dicts: kind -> R/W -> zone start GiB -> bucket -> count."
+        out = {}
+        gib = self.zone_sectors // (2 * 1024**2)
+        for (kind, rw, zone), hist in sorted(self.hists.items()):
+            zones = out.setdefault(kind, {}).setdefault(rw, {})
+            zones['{}GiB'.format(zone * gib)] = dict(
+                (bucket_label(b), hist[b]) for b in sorted(hist))
+        return out
+
+    def summary(self, kind='D2C'):
+        """Returns a list of (rw, zone GiB, count, p50, p99) with the percentiles
+        as bucket upper bounds, worst p99 first."""
+        rows = []
+        gib = self.zone_sectors // (2 * 1024**2)
+        for (hkind, rw, zone), hist in self.hists.items():
+            if hkind != kind:
+                continue
+            count = sum(hist.values())
+            p50, p99 = None, None
+            seen = 0
+            for b in sorted(hist):
+                seen += hist[b]
+                if p50 is None and seen >= 0.5 * count:
+                    p50 = bucket_label(b)
+                if p99 is None and seen >= 0.99 * count:
+                    p99 = bucket_label(b)
+                    top = b
+            rows.append((top, rw, zone * gib, count, p50, p99))
+        rows.sort(key=lambda r: (-r[0], r[1], r[2]))
+        return [row[1:] for row in rows]
@@ -0,0 +1,389 @@
+"""
+Reading, writing and combining ddrescue mapfiles (logs).
+
+Mapfiles are streamed a line at a time: the parser yields (pos, size, status)
+runs in bytes and the operations below consume and yield runs, so memory does
+not grow with the map. Only the header is indexed, so checks like the resume
+state read just the first few lines.
+
+The operations match ddrescuelog:
+  and - finished where finished in both maps
+  or - finished where finished in either map
+  xor - finished where finished in exactly one map
+  invert - finished blocks become non-tried, all others finished
+  change - status characters in old replaced by those in new
+Non-finished blocks keep the status of the first map, or of the second where
+the first is finished. Areas outside a map are non-tried.
+
+##License:
+Original work Copyright 2016 Richard Case
+
+Everyone is permitted to copy, distribute and modify this software,
+subject to this statement and the copyright notice above being included.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND.
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
+"""
+import os, io, re, time, logging
+from bisect import bisect_right
+
+NON_TRIED = '?'
+NON_TRIMMED = '*'
+NON_SCRAPED = '/'
+BAD_SECTOR = '-'
+FINISHED = '+'
+STATUSES = NON_TRIED + NON_TRIMMED + NON_SCRAPED + BAD_SECTOR + FINISHED
+
+_pat_creator = re.compile(r"#.*Created by (.+)$")
+_pat_command = re.compile(r"#\s*(?:(\w+) )?Command line: (.*)$")
+
+def line(pos, size, status_char):
+    "Returns a mapfile data line, pos and size in bytes."
+    return '{:#012X}  {:#012X}  {}\n'.format(pos, size, status_char)
+
+class Header(object):
+    """The header of a mapfile: comments and the current position line.
+
+    Indexes what the tool checks without reading the data lines:
+      creator - the program after 'Created by', e.g. 'ddrescue_used v0.6.0'
+      magic - the word before 'Command line:' in logs written by this tool
+      command - the command line that wrote the map
+      current_pos, current_status, current_pass - from the status line
+      data_offset - byte offset of the first data line
+    """
+    def __init__(self):
+        self.comments = []
+        self.creator = None
+        self.magic = None
+        self.command = None
+        self.current_pos = 0
+        self.current_status = NON_TRIED
+        self.current_pass = None
+        self.data_offset = 0
+
+    def read(self, f):
+        "Reads up to the status line from a binary file object. Returns True if found."
+        while True:
+            text = f.readline()
+            if not text:
+                self.data_offset = f.tell()
+                return False
+            decoded = text.decode(errors='replace').rstrip('\n')
+            fields = decoded.split()
+            if not fields:
+                continue
+            if fields[0].startswith('#'):
+                self.comments.append(decoded)
+                m = _pat_creator.match(decoded)
+                if m and self.creator is None:
+                    self.creator = m.group(1).strip()
+                m = _pat_command.match(decoded)
+                if m and self.command is None:
+                    self.magic, self.command = m.group(1), m.group(2)
+                continue
+            self.current_pos = int(fields[0], 0)
+            if len(fields) > 1:
+                self.current_status = fields[1]
+            if len(fields) > 2:
+                self.current_pass = int(fields[2])
+            self.data_offset = f.tell()
+            return True
+
+    def written_by(self, creator, magic=None):
+        "Returns True if a program starting with creator, and magic if given, wrote the map."
+        return (self.creator is not None and self.creator.startswith(creator) and
+                (magic is None or self.magic == magic))
+
+    def write(self, f):
+        "Writes the comments and status line to a text file object."
+        for comment in self.comments:
+            f.write(comment + '\n')
+        status = '{:#012x}   {}'.format(self.current_pos, self.current_status)
+        if self.current_pass is not None:
+            status += '     {}'.format(self.current_pass)
+        f.write(status + '\n')
+
+def read_header(path):
+    "Returns the Header of a mapfile, None if it has no status line."
+    header = Header()
+    with open(path, 'rb') as f:
+        if header.read(f):
+            return header
+    return None
+
+def runs(path):
+    """Yields (pos, size, status_char) in bytes for each data line of a mapfile.
+
+    Streams the file, so memory does not grow with the map.
+    """
+    with open(path, 'rb') as f:
+        if not Header().read(f):
+            return
+        for text in f:
+            fields = text.split()
+            if not fields or fields[0].startswith(b'#'):
+                continue
+            try:
+                pos, size = int(fields[0], 0), int(fields[1], 0)
+                status = fields[2].decode()
+            except (ValueError, IndexError):
+                raise Exception('Bad mapfile line in {}: {!r}'.format(path, text))
+            if status not in STATUSES:
+                raise Exception('Bad mapfile status in {}: {!r}'.format(path, text))
+            yield (pos, size, status)
+
+def coalesce(runs):
+    "Yields the runs with adjacent runs of the same status joined."
+    prev = None
+    for pos, size, status in runs:
+        if size <= 0:
+            continue
+        if prev is not None and prev[2] == status and prev[0] + prev[1] == pos:
+            prev = (prev[0], prev[1] + size, status)
+            continue
+        if prev is not None:
+            yield prev
+        prev = (pos, size, status)
+    if prev is not None:
+        yield prev
+
+def _tiled(runs):
+    "Yields contiguous runs from 0, with gaps non-tried, then non-tried forever."
+    pos = 0
+    for start, size, status in runs:
+        if start > pos:
+            yield (pos, start - pos, NON_TRIED)
+        elif start < pos:
+            raise Exception('Mapfile runs overlap or are unsorted at {:#x}'
+                                .format(start))
+        yield (start, size, status)
+        pos = start + size
+    yield (pos, None, NON_TRIED)
+
+def combine(a, b, op):
+    """Yields the runs of op(status_a, status_b) over two run streams.
+
+    Ends where both maps end. op is a function of two status characters.
+    """
+    ia, ib = _tiled(a), _tiled(b)
+    ra, rb = next(ia), next(ib)
+    pos = 0
+    while ra[1] is not None or rb[1] is not None:
+        ends = [r[0] + r[1] for r in (ra, rb) if r[1] is not None]
+        end = min(ends)
+        yield (pos, end - pos, op(ra[2], rb[2]))
+        pos = end
+        if ra[1] is not None and ra[0] + ra[1] <= pos:
+            ra = next(ia)
+        if rb[1] is not None and rb[0] + rb[1] <= pos:
+            rb = next(ib)
+
+def _and(sa, sb):
+    if sa == FINISHED:
+        return sb
+    return sa
+
+def _or(sa, sb):
+    if FINISHED in (sa, sb):
+        return FINISHED
+    return sa
+
+def _xor(sa, sb):
+    if sa == FINISHED and sb == FINISHED:
+        return NON_TRIED
+    if FINISHED in (sa, sb):
+        return FINISHED
+    return sa
+
+def and_runs(a, b):
+    return coalesce(combine(a, b, _and))
+
+def or_runs(a, b):
+    return coalesce(combine(a, b, _or))
+
+def xor_runs(a, b):
+    return coalesce(combine(a, b, _xor))
+
+def invert_runs(runs):
+    return coalesce((pos, size, NON_TRIED if status == FINISHED else FINISHED)
+                        for pos, size, status in runs)
+
+def change_runs(runs, old, new):
+    "Replaces each status character in old with the one at the same place in new."
+    if len(old) != len(new):
+        raise Exception('Status change {!r} to {!r} differ in length'
+                            .format(old, new))
+    table = dict(zip(old, new))
+    return coalesce((pos, size, table.get(status, status))
+                        for pos, size, status in runs)
+
+OPERATIONS = {'and': and_runs, 'or': or_runs, 'xor': xor_runs,
+              'invert': invert_runs, 'change': change_runs}
+
+def write_runs(path, header, runs):
+    "Streams a mapfile of the header and runs, replacing path atomically."
+    tmppath = path + '.tmp'
+    with open(tmppath, 'w') as f:
+        header.write(f)
+        f.write('#      pos        size  status\n')
+        for pos, size, status in runs:
+            f.write(line(pos, size, status))
+        f.write('\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmppath, path)
+    return path
+
+def rewrite(path, operation, *args):
+    """Applies an operation to a mapfile in place, keeping its header.
+
+    args - the second mapfile path for and, or & xor; old & new for change
+    """
+    header = read_header(path)
+    if header is None:
+        raise Exception('No mapfile status line in {}'.format(path))
+    if operation in ('and', 'or', 'xor'):
+        result = OPERATIONS[operation](runs(path), runs(args[0]))
+    else:
+        result = OPERATIONS[operation](runs(path), *args)
+    return write_runs(path, header, result)
+
+def store_lines(store, lo, hi, extent_char, fill_char):
+    "Yields (sector, line) tiling [lo, hi) with the store's extents and fills."
+    prev = lo
+    for start, n in store.irange(lo, hi):
+        if start > prev:
+            yield (prev, line(512 * prev, 512 * (start - prev), fill_char))
+        yield (start, line(512 * start, 512 * n, extent_char))
+        prev = start + n
+    if hi > prev:
+        yield (prev, line(512 * prev, 512 * (hi - prev), fill_char))
+
+def write_store(path, write_header, store, extent_char, fill_char,
+                    sectstart, sectend):
+    """Streams a whole mapfile for the store, replacing path atomically.
+
+    For one-off writes; nothing is cached so memory does not grow with the map.
+    """
+    tmppath = path + '.tmp'
+    with open(tmppath, 'w') as f:
+        write_header(f)
+        for pos, text in store_lines(store, sectstart, sectend,
+                                        extent_char, fill_char):
+            f.write(text)
+        f.write('\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmppath, path)
+    return path
+
+def replace_atomic(path, text):
+    "Writes text to a temporary file beside path, then renames it over path."
+    tmppath = path + '.tmp'
+    with open(tmppath, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmppath, path)
+
+class MapfileWriter(object):
+    """Incrementally rewrites a mapfile from an ExtentStore.
+
+    The store records the sector range changed since the last flush. Only the
+    data lines covering that range are rebuilt, the rest are reused. Flushes are
+    throttled to every interval seconds or maxadds new extents, whichever is
+    first, and the file is replaced atomically so a crash never leaves a
+    truncated mapfile.
+    """
+    interval = 2.0
+    maxadds = 10000
+
+    def __init__(self, store, path, write_header, extent_char, fill_char,
+                    sectstart, sectend, copies=()):
+        """store - ExtentStore to render
+        path - mapfile path
+        write_header - callable writing the header to a file object
+        extent_char, fill_char - status characters for extents and gaps
+        sectstart, sectend - sector range the mapfile covers
+        copies - other paths to replace with the same content, e.g. the viewer log
+        """
+        self.store = store
+        self.path = path
+        self.write_header = write_header
+        self.extent_char = extent_char
+        self.fill_char = fill_char
+        self.sectstart = sectstart
+        self.sectend = sectend
+        self.copies = list(copies)
+        # Cached data lines: start sector of each line and its text.
+        # Lines tile [sectstart, sectend) alternating fills and extents.
+        self.lines_pos = []
+        self.lines_text = []
+        self.pending = 0
+        self.dirty = None
+        self.last_flush = 0.0
+        self.flushes = 0
+        # Changes before the first flush are covered by the full build
+        self.store.take_dirty()
+        self._render(self.sectstart, self.sectend)
+
+    def _render_range(self, lo, hi):
+        "Returns (positions, texts) of lines tiling [lo, hi) from the store."
+        positions, texts = [], []
+        for pos, text in store_lines(self.store, lo, hi,
+                                        self.extent_char, self.fill_char):
+            positions.append(pos)
+            texts.append(text)
+        return (positions, texts)
+
+    def _render(self, lo, hi):
+        "Rebuilds the cached lines spanning the changed sector range [lo, hi)."
+        pos = self.lines_pos
+        # Widen to whole fill lines either side: an extent touching lo or hi
+        # would have been merged into the dirty range by the store
+        i = max(bisect_right(pos, max(lo - 1, self.sectstart)) - 1, 0)
+        j = bisect_right(pos, hi)
+        a = pos[i] if pos else self.sectstart
+        b = pos[j] if j < len(pos) else self.sectend
+        newpos, newtext = self._render_range(a, b)
+        self.lines_pos[i:j] = newpos
+        self.lines_text[i:j] = newtext
+        logging.log(5, 'MapfileWriter: rebuilt {}-{}, {} lines replaced with {}'
+                        .format(a, b, j - i, len(newpos)))
+
+    def update(self, force=False):
+        "Flushes if forced or the throttle limits are reached. Returns True if written."
+        dirty, adds = self.store.take_dirty()
+        if dirty is not None:
+            self.pending += adds
+            if self.dirty is None:
+                self.dirty = dirty
+            else:
+                self.dirty = (min(self.dirty[0], dirty[0]), max(self.dirty[1], dirty[1]))
+        if not force and self.flushes:
+            if self.dirty is None:
+                return False
+            if (self.pending < self.maxadds and
+                    time.monotonic() - self.last_flush < self.interval):
+                return False
+        self.flush()
+        return True
+
+    def flush(self):
+        "Rebuilds the dirty lines and atomically replaces the mapfile(s)."
+        if self.dirty is not None:
+            lo = max(self.dirty[0], self.sectstart)
+            hi = min(self.dirty[1], self.sectend)
+            self._render(lo, hi)
+        with io.StringIO() as f:
+            self.write_header(f)
+            f.writelines(self.lines_text)
+            f.write('\n')
+            text = f.getvalue()
+        for path in [self.path] + self.copies:
+            replace_atomic(path, text)
+        self.dirty = None
+        self.pending = 0
+        self.last_flush = time.monotonic()
+        self.flushes += 1
+        return self.path
@@ -0,0 +1,146 @@
+"""
+NTFS used clusters from the $Bitmap metadata file.
+
+The boot sector gives the cluster size and the location of $MFT. MFT record 6
+is $Bitmap, whose non-resident $DATA attribute holds one bit per cluster of the
+volume. Its data runs are decoded and the bitmap is read run by run in large
+chunks, so the whole map is one mostly sequential read with no mount.
+
+##License:
+Original work Copyright 2016 Richard Case
+
+Everyone is permitted to copy, distribute and modify this software,
+subject to this statement and the copyright notice above being included.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND.
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
+"""
+import struct, logging
+from fsmap import bit_runs
+
+NTFS_OEM = b'NTFS    '
+MFT_RECORD_BITMAP = 6
+AT_ATTRIBUTE_LIST = 0x20
+AT_DATA = 0x80
+AT_END = 0xFFFFFFFF
+# Update sequence fixups protect the last 2 bytes of every 512 bytes
+NTFS_BLOCK_SIZE = 512
+# Bitmap bytes per read
+chunksize = 4 * 2**20
+
+class BootSector(object):
+    "The NTFS boot sector fields needed to find $Bitmap."
+    def __init__(self, data):
+        if data[3:11] != NTFS_OEM:
+            raise Exception('Not an NTFS boot sector: {!r}'.format(data[3:11]))
+        self.bytes_per_sector, spc = struct.unpack_from('<HB', data, 0x0B)
+        # Values over 0x80 are negative powers of two, for clusters over 64KiB
+        if spc > 0x80:
+            spc = 1 << (256 - spc)
+        self.cluster_size = self.bytes_per_sector * spc
+        self.total_sectors, self.mft_lcn = struct.unpack_from('<QQ', data, 0x28)
+        cpr = struct.unpack_from('<b', data, 0x40)[0]
+        if cpr < 0:
+            self.record_size = 1 << -cpr
+        else:
+            self.record_size = cpr * self.cluster_size
+        self.clusters = self.total_sectors * self.bytes_per_sector // self.cluster_size
+        if not self.cluster_size or not self.record_size:
+            raise Exception('Bad NTFS geometry: cluster {} record {}'
+                                .format(self.cluster_size, self.record_size))
+
+def apply_fixups(record):
+    "Returns the MFT record bytes with the update sequence array fixups applied."
+    if record[:4] != b'FILE':
+        raise Exception('Bad MFT record magic: {!r}'.format(record[:4]))
+    usa_ofs, usa_count = struct.unpack_from('<HH', record, 4)
+    record = bytearray(record)
+    usn = record[usa_ofs:usa_ofs + 2]
+    for i in range(1, usa_count):
+        end = i * NTFS_BLOCK_SIZE
+        if end > len(record):
+            break
+        if record[end - 2:end] != usn:
+            raise Exception('MFT record fixup mismatch in block {}'.format(i))
+        record[end - 2:end] = record[usa_ofs + 2 * i:usa_ofs + 2 * i + 2]
+    return bytes(record)
+
+def find_attribute(record, attr_type):
+    "Returns the offset of the first unnamed attribute of a type, or None."
+    offset = struct.unpack_from('<H', record, 0x14)[0]
+    while offset + 8 <= len(record):
+        atype, length = struct.unpack_from('<II', record, offset)
+        if atype == AT_END or length == 0:
+            return None
+        if atype == AT_ATTRIBUTE_LIST:
+            raise Exception('$Bitmap has an attribute list, not supported')
+        if atype == attr_type and record[offset + 9] == 0:
+            return offset
+        offset += length
+    return None
+
+def data_runs(record, offset):
+    "Yields (lcn or None if sparse, n clusters) from a non-resident attribute."
+    if not record[offset + 8]:
+        raise Exception('$Bitmap data is resident')
+    pos = offset + struct.unpack_from('<H', record, offset + 0x20)[0]
+    lcn = 0
+    while record[pos]:
+        header = record[pos]
+        lsize, osize = header & 0xF, header >> 4
+        pos += 1
+        length = int.from_bytes(record[pos:pos + lsize], 'little')
+        pos += lsize
+        if osize:
+            lcn += int.from_bytes(record[pos:pos + osize], 'little', signed=True)
+            yield (lcn, length)
+        else:
+            yield (None, length)
+        pos += osize
+
+def used_clusters(volume, boot):
+    "Yields (first cluster, count) of used clusters."
+    pos = boot.mft_lcn * boot.cluster_size + MFT_RECORD_BITMAP * boot.record_size
+    record = apply_fixups(volume.read(pos, boot.record_size))
+    offset = find_attribute(record, AT_DATA)
+    if offset is None:
+        raise Exception('$Bitmap has no $DATA attribute')
+    data_size = struct.unpack_from('<Q', record, offset + 0x30)[0]
+    # Bits past the last cluster are padding
+    remaining = min(data_size, -(-boot.clusters // 8))
+    bit = 0
+    for lcn, length in data_runs(record, offset):
+        size = min(length * boot.cluster_size, remaining)
+        if lcn is None:
+            # Sparse: all zero, nothing used
+            bit += 8 * size
+            remaining -= size
+            continue
+        done = 0
+        while done < size:
+            n = min(chunksize, size - done)
+            chunk = volume.read(lcn * boot.cluster_size + done, n)
+            for start, count in bit_runs(chunk):
+                count = min(start + count, boot.clusters - bit) - start
+                if count > 0:
+                    yield (bit + start, count)
+            bit += 8 * n
+            done += n
+        remaining -= size
+        if remaining <= 0:
+            break
+    if remaining > 0:
+        logging.warning('NTFS $Bitmap runs end {} bytes short'.format(remaining))
+
+def used_extents(volume):
+    "Yields used (start, n_sectors) extents."
+    boot = BootSector(volume.read(0, 512))
+    logging.debug('ntfs: {} clusters of {}B, MFT at cluster {}, {}B records'
+                    .format(boot.clusters, boot.cluster_size, boot.mft_lcn,
+                            boot.record_size))
+    factor = boot.cluster_size // 512
+    for start, n in used_clusters(volume, boot):
+        yield (start * factor, n * factor)
+    # Backup boot sector after the last whole sector of the volume
+    yield (boot.total_sectors * boot.bytes_per_sector // 512,
+            boot.bytes_per_sector // 512)
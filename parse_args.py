@@ -17,6 +17,7 @@ import sys
 import stat
 import logging
 import helpers
+import priority
 
 def writable_dir(dirpath):
     "Check to see if the destination is a directory and writable."
@@ -45,6 +46,13 @@ def readable_blockfile(filepath):
         raise argparse.ArgumentTypeError('{} is not readable'
                                             .format(filepath))
 
+def priority_rule(text):
+    "Parses a --priority rule."
+    try:
+        return priority.Rule(text)
+    except Exception as e:
+        raise argparse.ArgumentTypeError(str(e))
+
 def check_used(options):
     "Checks the --used and --free switches. Returns True, False or None."
     if options.used == True and options.free == True:
@@ -98,7 +106,29 @@ Example usage:
     parser.add_argument('--diff', '-d', action='store_true', default=False,
         help='diff the corresponding device and image filesystems after transfer to stdout. Not recommended for failing source drives')
     parser.add_argument('--stats', '-s', action='store_true', default=False,
-        help='print statistics from the btrace parsing that captures metadata blocks')
+        help='print statistics and per zone I/O latencies from the btrace parsing that captures metadata blocks, always saved as JSON')
+    parser.add_argument('--rawtrace', '-r', action='store_true', default=False,
+        help='parse the binary blktrace stream directly instead of piping it through blkparse')
+    parser.add_argument('--capture', '-c', action='store_true', default=False,
+        help='record the trace stream to a compressed file in the destination, see replay.py')
+    parser.add_argument('--ownio', '-o', action='store_true', default=False,
+        help='only map metadata read by processes the tool starts, ignoring e.g. udev, blkid and automounters')
+    parser.add_argument('--bridge', type=int, default=0, metavar='KIB',
+        help='join rescue extents separated by gaps smaller than KIB kibibytes to reduce seeking, default 0')
+    parser.add_argument('--align', action='store_true', default=False,
+        help="align rescue extents to the device's physical sector and optimal I/O size")
+    parser.add_argument('--maxextents', type=int, default=0, metavar='N',
+        help='join the smallest gaps until at most N rescue extents remain, default 0 (no limit)')
+    parser.add_argument('--slowzone', type=int, default=0, metavar='MS',
+        help='defer 1GiB zones whose p90 read latency is at least MS milliseconds to a later ddrescue pass, default 0 (off)')
+    parser.add_argument('--probe', type=int, default=0, metavar='N',
+        help='with --slowzone, also time N random direct reads per zone before rescuing, default 0')
+    parser.add_argument('--priority', '-p', type=priority_rule, action='append', metavar='RULE',
+        help="rescue files matching RULE first, e.g. '*.docx', 'DCIM/**' or '<10M'; conditions joined by ',' must all match; repeat for later passes")
+    parser.add_argument('--impact', '-i', action='store_true', default=False,
+        help='after the data rescue, report the files hit by unrescued sectors to IMAGE.impact.tsv')
+    parser.add_argument('--jobs', '-j', type=int, default=0, metavar='N',
+        help='map up to N partitions of the image at once, default 0 (one per CPU); walks of the source device are never concurrent')
     parser.add_argument('--used', '-u', action='store_true', default=False,
         help='force used space to be mapped directly by walking the filesystem')
     parser.add_argument('--free', '-f', action='store_true', default=False,
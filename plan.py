@@ -0,0 +1,135 @@
+"""
+Orders the ddrescue passes so slow regions of the source are rescued last.
+
+The disk is split into the same zones as the btrace latency histograms. A zone
+is slow when its 90th percentile read latency, from the trace stats and/or a
+quick sampled read probe, reaches a threshold. A ddrescue domain mapfile is
+written for the fast zones and another for the slow zones, and ddrescue runs
+once per domain in that order. On a degrading drive this recovers the most data
+per hour before the slow, likely failing, regions are worked on.
+
+##License:
+Original work Copyright 2016 Richard Case
+
+Everyone is permitted to copy, distribute and modify this software,
+subject to this statement and the copyright notice above being included.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND.
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
+"""
+import os, mmap, time, random, json, logging
+import helpers, constants, mapfile, btrace
+from extents import ExtentStore
+from latency import LatencyHistograms, zone_percentiles
+
+zone_sectors = LatencyHistograms.zone_sectors
+domain_suffix = '.{}.domain.log'
+# Latency given to a probe read that fails, always slow
+probe_error_us = 2**30
+
+def trace_latencies(options):
+    "Returns {zone: read p90 us} from the saved btrace stats, empty if there are none."
+    filename = helpers.image(options) + btrace.statsjson_suffix
+    try:
+        with open(filename) as f:
+            stats = json.load(f)
+    except (OSError, ValueError):
+        logging.debug('No btrace latencies in {}'.format(filename))
+        return {}
+    return zone_percentiles(stats.get('latency', {}))
+
+def probe_latencies(device, devsize, samples, seed=0):
+    """Returns {zone: slowest us} timing random 4KiB direct reads in every zone.
+
+    Reads bypass the page cache so cached metadata does not hide a slow zone.
+    """
+    result = {}
+    # mmap memory is page aligned as O_DIRECT requires
+    buf = mmap.mmap(-1, 4096)
+    rand = random.Random(seed)
+    fd = os.open(device, os.O_RDONLY | os.O_DIRECT)
+    try:
+        for zone in range(-(-devsize // zone_sectors)):
+            lo = zone * zone_sectors
+            hi = max(min(lo + zone_sectors, devsize) - 8, lo + 1)
+            worst = 0
+            for _ in range(samples):
+                sector = rand.randrange(lo, hi) & ~7
+                start = time.perf_counter()
+                try:
+                    os.preadv(fd, [buf], 512 * sector)
+                except OSError as e:
+                    logging.debug('Probe read of sector {} failed: {}'
+                                    .format(sector, e))
+                    worst = probe_error_us
+                    continue
+                worst = max(worst, int(1e6 * (time.perf_counter() - start)))
+            result[zone] = worst
+    finally:
+        os.close(fd)
+        buf.close()
+    return result
+
+def classify(latencies, slow_us):
+    "Returns the sorted zones whose latency is at least slow_us."
+    return sorted(zone for zone, us in latencies.items() if us >= slow_us)
+
+def zone_store(zones, devsize):
+    "Returns an ExtentStore covering the given zones, clipped to the device."
+    store = ExtentStore()
+    for zone in zones:
+        start = zone * zone_sectors
+        store.add(start, min(zone_sectors, devsize - start))
+    return store
+
+def write_header(f):
+    "Domain mapfile header; ddrescue only reads the current_pos line."
+    f.write('# Domain mapfile. Created by {}\n'.format(constants.version))
+    f.write('# current_pos  current_status\n0x0000000000   ?\n')
+    f.write('#        pos          size  status\n')
+
+def domain_path(options, name):
+    return helpers.image(options) + domain_suffix.format(name)
+
+def write_domain(options, name, store, devsize):
+    "Writes a domain mapfile with the store's extents finished, returns its path."
+    return mapfile.write_store(domain_path(options, name), write_header, store,
+                                '+', '?', 0, devsize)
+
+def passes(options, devsize):
+    """Returns a list of extra ddrescue argument lists, one per pass in order.
+
+    Without slow zone deferral, or if no zone is slow, this is one plain pass.
+    """
+    if not options.slowzone:
+        return [[]]
+    latencies = trace_latencies(options)
+    if options.probe:
+        logging.info('Probing {} zones with {} reads each'
+                        .format(-(-devsize // zone_sectors), options.probe))
+        for zone, us in probe_latencies(options.device, devsize,
+                                        options.probe).items():
+            latencies[zone] = max(us, latencies.get(zone, 0))
+    nzones = -(-devsize // zone_sectors)
+    slow = [zone for zone in classify(latencies, 1000 * options.slowzone)
+                if zone < nzones]
+    if not slow:
+        logging.info('No slow zones found in {} zones with latencies'
+                        .format(len(latencies)))
+        return [[]]
+    slowset = set(slow)
+    fast = [zone for zone in range(nzones) if zone not in slowset]
+    logging.info('Deferring {} slow zones (GiB): {}'.format(len(slow),
+                    ' '.join(str(zone * zone_sectors // 2**21) for zone in slow)))
+    result = []
+    for name, zones in (('fast', fast), ('slow', slow)):
+        if zones:
+            path = write_domain(options, name, zone_store(zones, devsize), devsize)
+            result.append(['-m', path])
+    return result
+
+def remove_domains(options):
+    "Removes the domain mapfiles unless logs are kept."
+    if not options.keeplogs:
+        for name in ('fast', 'slow'):
+            helpers.removefile(domain_path(options, name))
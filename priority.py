@@ -0,0 +1,150 @@
+"""
+Rescues the most valuable files first with one ddrescue pass per priority rule.
+
+A rule is one or more comma separated conditions that must all match a file:
+  glob - e.g. '*.docx' matches the file name, 'DCIM/**' the path from the
+         filesystem root; '*' and '?' stop at '/', '**' spans directories.
+         Case insensitive, as on the FAT & NTFS volumes that customers bring.
+  size - '<10M' or '>1G', in bytes with optional K, M, G or T binary suffixes
+A file belongs to the first rule it matches. The extents of each rule's files
+become a ddrescue domain mapfile and the rules are rescued in the order given,
+followed by the ordinary passes over everything else that is used.
+
+##License:
+Original work Copyright 2016 Richard Case
+
+Everyone is permitted to copy, distribute and modify this software,
+subject to this statement and the copyright notice above being included.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND.
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
+"""
+import os, re, glob, logging
+import helpers, plan
+from extents import ExtentStore
+
+domain_name = 'prio{}'
+size_units = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+_pat_size = re.compile(r"([<>])\s*(\d+)\s*([KMGT]?)i?B?\Z", re.IGNORECASE)
+
+def glob_regex(pattern):
+    "Compiles a glob pattern to a regex matching a whole '/' separated path."
+    out = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            out.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i):
+            out.append('.*')
+            i += 2
+        elif pattern[i] == '*':
+            out.append('[^/]*')
+            i += 1
+        elif pattern[i] == '?':
+            out.append('[^/]')
+            i += 1
+        else:
+            out.append(re.escape(pattern[i]))
+            i += 1
+    return re.compile(''.join(out) + r'\Z', re.IGNORECASE | re.DOTALL)
+
+class Rule(object):
+    "A priority rule parsed from its text, see the module description."
+    def __init__(self, text):
+        self.text = text
+        # (match whole path, regex)
+        self.globs = []
+        self.minsize = None
+        self.maxsize = None
+        for cond in text.split(','):
+            cond = cond.strip()
+            if not cond:
+                continue
+            m = _pat_size.match(cond)
+            if m:
+                nbytes = int(m.group(2)) * size_units[m.group(3).upper()]
+                if m.group(1) == '<':
+                    self.maxsize = nbytes
+                else:
+                    self.minsize = nbytes
+            elif cond[0] in '<>':
+                raise Exception('Bad size condition {!r} in priority rule {!r}'
+                                    .format(cond, text))
+            else:
+                self.globs.append(('/' in cond.strip('/'),
+                                    glob_regex(cond.strip('/'))))
+        if not self.globs and self.minsize is None and self.maxsize is None:
+            raise Exception('Empty priority rule {!r}'.format(text))
+
+    def __repr__(self):
+        return self.text
+
+    def match(self, relpath, size):
+        "Returns True if the file at relpath, from the filesystem root, matches."
+        if self.maxsize is not None and size >= self.maxsize:
+            return False
+        if self.minsize is not None and size <= self.minsize:
+            return False
+        for wholepath, regex in self.globs:
+            target = relpath if wholepath else os.path.basename(relpath)
+            if not regex.match(target):
+                return False
+        return True
+
+class PriorityMap(object):
+    "Collects the extents of the files matching each rule."
+    def __init__(self, rules):
+        self.rules = rules
+        self.tiers = [ExtentStore() for rule in rules]
+        self.files = [0] * len(rules)
+
+    def tier(self, relpath, size):
+        "Returns the index of the first rule the file matches, None if none do."
+        for i, rule in enumerate(self.rules):
+            if rule.match(relpath, size):
+                return i
+        return None
+
+    def add_file(self, tier, extents):
+        "Adds a file's (start, n_sectors) extents to a tier."
+        for start, n in extents:
+            self.tiers[tier].add(start, n)
+        self.files[tier] += 1
+
+    def merge(self, other):
+        "Adds the tiers of another map with the same rules, e.g. from a worker."
+        for i, store in enumerate(other.tiers):
+            for start, n in store:
+                self.tiers[i].add(start, n)
+            self.files[i] += other.files[i]
+
+    def write_domains(self, options, devsize):
+        "Writes a domain mapfile per tier with files, replacing older ones."
+        remove_domains(options, force=True)
+        for i, (rule, store) in enumerate(zip(self.rules, self.tiers)):
+            logging.info('Priority {} {!r}: {} files, {} MB'
+                            .format(i, rule.text, self.files[i],
+                                    store.sectors() // 2048))
+            if len(store):
+                plan.write_domain(options, domain_name.format(i), store, devsize)
+
+def domains(options):
+    "Returns the priority domain mapfiles in rescue order."
+    prefix, suffix = plan.domain_path(options, domain_name.format('\0')).split('\0')
+    found = []
+    for path in glob.glob(glob.escape(prefix) + '*' + glob.escape(suffix)):
+        number = path[len(prefix):len(path) - len(suffix)]
+        if number.isdigit():
+            found.append((int(number), path))
+    return [path for number, path in sorted(found)]
+
+def passes(options):
+    "Returns the extra ddrescue args of the priority passes, run before the others."
+    return [['-m', path] for path in domains(options)]
+
+def remove_domains(options, force=False):
+    "Removes the priority domain mapfiles unless logs are kept."
+    if force or not options.keeplogs:
+        for path in domains(options):
+            helpers.removefile(path)
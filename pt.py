@@ -16,6 +16,7 @@ import btrace
 import time
 import zlib
 import helpers
+import extentops
 
 # For debugging: import pdb; pdb.set_trace()
 
@@ -352,30 +353,17 @@ class PartitionTable(object):
     # Already sorted in order of start sector above
     def get_unaccounted_sectors(self):
         # Remove Es and Xs & build list of extents
-        extents = []
+        starts, lengths = [], []
         for entry in self.pt:
             # *PEXL
             if not (entry[1] == 'E' or entry[1] == 'X'):
-                e = btrace.Extent(entry[3], entry[5])
-                extents.append(e)
+                starts.append(entry[3])
+                lengths.append(entry[5])
         # Union overlaps
-        distinct = []
-        i_prev = None
-        for e in extents:
-            if i_prev is None:
-                distinct.append(e)
-                i_prev = distinct.index(e)
-            else:
-                if e.overlaps(distinct[i_prev]):
-                    distinct[i_prev] = distinct[i_prev].union(e)
-                else:
-                    distinct.append(e)
-                    i_prev = distinct.index(e)
-        logging.debug('PT: Distinct extents: {}'.format(distinct))
+        distinct = extentops.normalise(starts, lengths)
+        logging.debug('PT: Distinct extents: {}'.format(extentops.extents(distinct)))
         # Add up the sizes
-        total = 0
-        for e in distinct:
-            total += e.n
+        total = extentops.sectors(distinct)
         # Take away from total device size:
         self.unaccounted = self.devsize - total
         if self.unaccounted > self.unaccounted_limit:
@@ -0,0 +1,55 @@
+#!/usr/bin/python3
+"""
+Rebuilds a btrace log from a trace capture recorded with ddrescue_used --capture.
+
+Does not need root or the source device, so metadata maps can be re-derived
+after a crash and parser changes can be timed against real traces.
+
+##License:
+Original work Copyright 2016 Richard Case
+
+Everyone is permitted to copy, distribute and modify this software,
+subject to this statement and the copyright notice above being included.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND.
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
+"""
+import argparse, logging, sys, time
+import btrace
+
+def parse():
+    "Parse commandline arguments."
+    parser = argparse.ArgumentParser(description="""
+Replays a compressed blktrace (binary) or blkparse (text) capture and writes the
+ddrescue compatible btrace log that the live trace would have produced.
+""", epilog="""
+Example usage:
+  ./replay.py ~/diskrecovery/sdb.img.blktrace.gz $(blockdev --getsz /dev/sdb) \\
+      ~/diskrecovery/sdb.img.btrace.log
+""", formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('capture',
+        help='capture file, <image>.blktrace.gz or <image>.blkparse.gz')
+    parser.add_argument('sectors', type=int,
+        help='size of the traced device in 512B sectors')
+    parser.add_argument('logfile',
+        help='btrace log to write')
+    parser.add_argument('--stats', '-s', action='store_true', default=False,
+        help='print statistics from the btrace parsing')
+    parser.add_argument('--verbose', '-v', action='count', default=0,
+        help='use multiple times to increase stderr verbosity')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse()
+    level = {0:logging.WARNING, 1:logging.INFO}.get(args.verbose, logging.DEBUG)
+    logging.basicConfig(level=level, format='{levelname}:{module}:{message}',
+                        style='{', stream=sys.stderr)
+    start = time.perf_counter()
+    replayer = btrace.replay(args.capture, args.sectors, args.logfile)
+    elapsed = time.perf_counter() - start
+    events = replayer.stats['read_lines']
+    print('Replayed {} events into {} extents in {:.2f} s ({:.0f} events/s): {}'
+            .format(events, len(replayer.store), elapsed,
+                    events / elapsed if elapsed else 0, args.logfile))
+    if args.stats:
+        replayer.pprint_stats()
@@ -0,0 +1,156 @@
+"""
+Small filesystem images for checking the native allocation map readers.
+
+FsImage runs the filesystem's mkfs from fs.py on a loop device, copies in files
+of the makedisk.py sizes, deletes some so the free space is scattered, and
+records the filesystem's own free space count and the files' FIEMAP extents.
+NativeMapCheck compares fsmap.used_extents with those. The checks need root for
+the loop device and mount, and skip without it or without the mkfs.
+
+##License:
+Original work Copyright 2016 Richard Case
+
+Everyone is permitted to copy, distribute and modify this software,
+subject to this statement and the copyright notice above being included.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND.
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
+"""
+import os, sys, random, shutil, tempfile, subprocess, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fs, fsmap, fiemap, extentops
+
+fileblksz = 787
+# path, size in 787B blocks, as makedisk.py
+files = [
+    ('file.1', 1),
+    ('file.2', 13),
+    ('lotsOFrandomGARBAGEforTHEfileNAME.3', 12613),
+    ('directory/file.4', 113),
+    ('directory/DEEPER/file.5', 4261),
+]
+# Written before the files above and every other one deleted again
+churn_files = 40
+churn_blocks = 97
+
+def run(cmd, shell=False):
+    "Runs a command quietly, raises on failure."
+    subprocess.check_call(cmd, shell=shell, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+
+class FsImage(object):
+    """A partition image of fstype holding the test files.
+
+    path, sectors - the image file and its size in 512B sectors
+    free - free bytes as counted by the filesystem, from statvfs
+    blocksize - the filesystem's allocation unit in bytes
+    file_extents - (start, n_sectors) of the files, None without FIEMAP
+    """
+    def __init__(self, fstype, mbytes=64):
+        self.fstype = fstype
+        self.sectors = mbytes * 2048
+        self.tmp = None
+        self.path = None
+
+    def __enter__(self):
+        if os.geteuid() != 0:
+            raise unittest.SkipTest('needs root for loop devices and mount')
+        mkfs = fs.mkfs(self.fstype, '', 0)
+        if shutil.which(mkfs.split()[0]) is None:
+            raise unittest.SkipTest('{} is not installed'.format(mkfs.split()[0]))
+        self.tmp = tempfile.mkdtemp(prefix='fsimage.')
+        try:
+            self.path = os.path.join(self.tmp, self.fstype + '.img')
+            with open(self.path, 'wb') as f:
+                f.truncate(512 * self.sectors)
+            loop = subprocess.check_output(['losetup', '--find', '--show', self.path])
+            loop = loop.decode().strip()
+            try:
+                run(fs.mkfs(self.fstype, loop, 0), shell=True)
+                self._populate(loop)
+            finally:
+                run(['losetup', '--detach', loop])
+        except BaseException:
+            self.__exit__()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        if self.tmp is not None:
+            shutil.rmtree(self.tmp)
+            self.tmp = None
+
+    def _populate(self, loop):
+        mnt = os.path.join(self.tmp, 'mnt')
+        os.mkdir(mnt)
+        run(['mount', loop, mnt])
+        try:
+            rand = random.Random(1)
+            for i in range(churn_files):
+                with open(os.path.join(mnt, 'churn.{}'.format(i)), 'wb') as f:
+                    f.write(rand.randbytes(fileblksz * churn_blocks * (1 + i % 3)))
+            os.sync()
+            for i in range(0, churn_files, 2):
+                os.remove(os.path.join(mnt, 'churn.{}'.format(i)))
+            paths = [os.path.join(mnt, 'churn.{}'.format(i))
+                        for i in range(1, churn_files, 2)]
+            for relpath, blocks in files:
+                path = os.path.join(mnt, relpath)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as f:
+                    f.write(rand.randbytes(fileblksz * blocks))
+                paths.append(path)
+            os.sync()
+            stat = os.statvfs(mnt)
+            self.free = stat.f_bfree * stat.f_frsize
+            self.blocksize = stat.f_frsize
+            reader = fiemap.ExtentReader()
+            extents = []
+            for path in paths:
+                extents += reader(path)
+            self.file_extents = None if reader.unsupported else extents
+        finally:
+            run(['umount', mnt])
+
+    def used_extents(self):
+        "Returns the run set of the native map of the image."
+        return extentops.from_extents(
+                    fsmap.used_extents(self.fstype, self.path, 0, self.sectors))
+
+class NativeMapCheck(object):
+    """Checks fsmap.used_extents against the filesystem, mix into a TestCase.
+
+    fstype, mbytes - the image to make
+    slack_blocks - blocks by which the free space may differ from statvfs, e.g.
+                   a partial last block
+    """
+    fstype = None
+    mbytes = 64
+    slack_blocks = 1
+
+    @classmethod
+    def setUpClass(cls):
+        cls.image = FsImage(cls.fstype, cls.mbytes).__enter__()
+        cls.addClassCleanup(cls.image.__exit__)
+        cls.used = cls.image.used_extents()
+
+    def test_files_are_used(self):
+        "Every file's data is in the used map."
+        if self.image.file_extents is None:
+            self.skipTest('no FIEMAP on {}'.format(self.fstype))
+        self.assertTrue(self.image.file_extents)
+        files = extentops.from_extents(self.image.file_extents)
+        self.assertEqual(extentops.extents(extentops.subtract(files, self.used)), [])
+
+    def test_free_space(self):
+        "The space not in the used map is the filesystem's own free count."
+        free = 512 * (self.image.sectors - extentops.sectors(self.used))
+        self.assertAlmostEqual(free, self.image.free,
+                                delta=self.slack_blocks * self.image.blocksize)
+
+    def test_within_partition(self):
+        "The used extents lie inside the partition."
+        runs = extentops.extents(self.used)
+        self.assertTrue(runs)
+        self.assertGreaterEqual(runs[0][0], 0)
+        self.assertLessEqual(runs[-1][0] + runs[-1][1], self.image.sectors)
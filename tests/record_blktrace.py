@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+"""
+Records the blktrace fixture used by test_btrace.py. Run with sudo.
+
+./tests/record_blktrace.py
+  Traces a small ext4 image on a loop device while blkid, direct reads and a
+  direct write run, then writes data/loop.blktrace.gz (blktrace -o- output) and
+  data/loop.blkparse.gz (blkparse -q of the same trace).
+./tests/record_blktrace.py --construct
+  Where blktrace can't run, writes a constructed trace of the same workload and
+  renders the text in blkparse -q's default format instead. The committed
+  fixture is constructed, so it checks the two parsers agree, not that they
+  match blkparse; test_btrace.RealLine checks that against real output.
+
+##License:
+Original work Copyright 2016 Richard Case
+
+Everyone is permitted to copy, distribute and modify this software,
+subject to this statement and the copyright notice above being included.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND.
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
+"""
+import os, sys, gzip, time, signal, subprocess, tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from btrace import BtraceParser
+
+datadir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+raw_fixture = os.path.join(datadir, 'loop.blktrace.gz')
+text_fixture = os.path.join(datadir, 'loop.blkparse.gz')
+
+def workload(device):
+    "The I/O traced: a blkid probe, direct 4KiB reads and a direct write."
+    subprocess.call(['blkid', '-p', device], stdout=subprocess.DEVNULL)
+    subprocess.call(['dd', 'if=' + device, 'of=/dev/null', 'bs=4k', 'count=8',
+                        'skip=100', 'iflag=direct'], stderr=subprocess.DEVNULL)
+    subprocess.call(['dd', 'if=/dev/zero', 'of=' + device, 'bs=4k', 'count=2',
+                        'seek=3000', 'oflag=direct,sync'], stderr=subprocess.DEVNULL)
+
+def record():
+    "Records the fixture from a loop device with blktrace & blkparse."
+    with tempfile.TemporaryDirectory() as tmp:
+        image = os.path.join(tmp, 'disk.img')
+        with open(image, 'wb') as f:
+            f.truncate(16 * 2**20)
+        subprocess.check_call(['mkfs.ext4', '-q', '-F', image])
+        loop = subprocess.check_output(['losetup', '--find', '--show', image])
+        loop = loop.decode().strip()
+        rawpath = os.path.join(tmp, 'trace.bin')
+        try:
+            with open(rawpath, 'wb') as out:
+                tracer = subprocess.Popen(['blktrace', '-o-', loop], stdout=out,
+                                            stderr=subprocess.DEVNULL)
+                time.sleep(1)
+                workload(loop)
+                time.sleep(1)
+                tracer.send_signal(signal.SIGINT)
+                tracer.wait()
+        finally:
+            subprocess.call(['losetup', '--detach', loop])
+        with open(rawpath, 'rb') as f:
+            raw = f.read()
+        text = subprocess.check_output(['blkparse', '-q', '-i', rawpath])
+    return raw, text
+
+# blkparse -q default format: "%D %2c %8s %5T.%9t %5p %2a %3d " then per action
+text_line = '{:3d},{:<3d} {:2d} {:8d} {:5d}.{:09d} {:5d} {:>2} {:>3} {}\n'
+# (cpu, pid, action letter, action flags, sector, sectors, error)
+constructed = [
+    # blkid -p probes the superblock areas
+    (0, 1201, 'Q', 0, 0, 8, 0),
+    (0, 1201, 'G', 0, 0, 8, 0),
+    (0, 1201, 'P', 0, 0, 0, 0),
+    (0, 1201, 'I', 0, 0, 8, 0),
+    (0, 1201, 'U', 0, 0, 0, 0),
+    (0, 1201, 'D', 0, 0, 8, 0),
+    (0, 1201, 'C', 0, 0, 8, 0),
+    (0, 1201, 'Q', 0, 8, 8, 0),
+    (0, 1201, 'M', 0, 16, 8, 0),
+    (0, 1201, 'D', 0, 8, 16, 0),
+    (1, 1201, 'C', 0, 8, 16, 0),
+    (0, 1201, 'Q', 0, 32760, 8, 0),
+    (0, 1201, 'D', 0, 32760, 8, 0),
+    (0, 1201, 'C', 0, 32760, 8, 0),
+    # dd direct reads, one unreadable
+    (1, 1202, 'Q', 0, 800, 8, 0),
+    (1, 1202, 'G', 0, 800, 8, 0),
+    (1, 1202, 'D', 0, 800, 8, 0),
+    (1, 1202, 'C', 0, 800, 8, 0),
+    (1, 1202, 'Q', 0, 808, 8, 0),
+    (1, 1202, 'D', 0, 808, 8, 0),
+    (1, 1202, 'C', 0, 808, 8, 65531),
+    (1, 1202, 'Q', 0, 816, 48, 0),
+    (1, 1202, 'D', 0, 816, 48, 0),
+    (0, 1202, 'C', 0, 816, 48, 0),
+    # dd direct sync write, ext4 style metadata read
+    (0, 1203, 'Q', BtraceParser.BLK_TC_WRITE | BtraceParser.BLK_TC_SYNC, 24000, 16, 0),
+    (0, 1203, 'D', BtraceParser.BLK_TC_WRITE | BtraceParser.BLK_TC_SYNC, 24000, 16, 0),
+    (0, 1203, 'C', BtraceParser.BLK_TC_WRITE | BtraceParser.BLK_TC_SYNC, 24000, 16, 0),
+    (0, 1203, 'Q', BtraceParser.BLK_TC_META | BtraceParser.BLK_TC_SYNC, 2048, 8, 0),
+    (0, 1203, 'D', BtraceParser.BLK_TC_META | BtraceParser.BLK_TC_SYNC, 2048, 8, 0),
+    (0, 1203, 'C', BtraceParser.BLK_TC_META | BtraceParser.BLK_TC_SYNC, 2048, 8, 0),
+    (1, 1203, 'Q', BtraceParser.BLK_TC_FLUSH | BtraceParser.BLK_TC_WRITE, 0, 0, 0),
+]
+commands = {1201: 'blkid', 1202: 'dd', 1203: 'dd'}
+
+def _rwbs(action, nbytes):
+    "blkparse's fill_rwbs(), written out separately from BtraceParser.trace_rwbs."
+    rwbs = ''
+    if action & BtraceParser.BLK_TC_FLUSH:
+        rwbs += 'F'
+    if action & BtraceParser.BLK_TC_DISCARD:
+        rwbs += 'D'
+    elif action & BtraceParser.BLK_TC_WRITE:
+        rwbs += 'W'
+    elif nbytes:
+        rwbs += 'R'
+    else:
+        rwbs += 'N'
+    for flag, char in ((BtraceParser.BLK_TC_FUA, 'F'), (BtraceParser.BLK_TC_AHEAD, 'A'),
+                       (BtraceParser.BLK_TC_SYNC, 'S'), (BtraceParser.BLK_TC_META, 'M')):
+        if action & flag:
+            rwbs += char
+    return rwbs
+
+def _other(act, pid, sector, n, error):
+    "The per action part of a blkparse line."
+    if act == 'C':
+        return '{} + {} [{}]'.format(sector, n, error)
+    if act == 'P':
+        return '[{}]'.format(commands[pid])
+    if act == 'U':
+        return '[{}] 1'.format(commands[pid])
+    return '{} + {} [{}]'.format(sector, n, commands[pid])
+
+def construct():
+    "Returns (binary trace, blkparse text) of the constructed trace."
+    trace = BtraceParser.trace_struct
+    magic = BtraceParser.trace_magic | 7
+    device = (7 << 20) | 0
+    genesis = 1700000000123456789
+    raw, text = [], []
+    seqs = {}
+    named = set()
+    for i, (cpu, pid, act, flags, sector, n, error) in enumerate(constructed):
+        ns = genesis + i * 137000 + (i % 5) * 911
+        if pid not in named:
+            # Process notify, the payload is the NUL padded command name
+            named.add(pid)
+            name = commands[pid].encode('ascii').ljust(16, b'\0')
+            raw.append(trace.pack(magic, 0, ns, 0, 0,
+                        BtraceParser.BLK_TC_NOTIFY | BtraceParser.BLK_TN_PROCESS,
+                        pid, device, cpu, 0, len(name)) + name)
+        seqs[cpu] = seqs.get(cpu, 0) + 1
+        action = BtraceParser.trace_actions.index(act) | flags
+        raw.append(trace.pack(magic, seqs[cpu], ns, sector, 512 * n, action,
+                                pid, device, cpu, error, 0))
+        rel = ns - genesis
+        text.append(text_line.format(7, 0, cpu, seqs[cpu], rel // 10**9,
+                                        rel % 10**9, pid, act,
+                                        _rwbs(action, 512 * n),
+                                        _other(act, pid, sector, n, error)))
+    return b''.join(raw), ''.join(text).encode('ascii')
+
+def main():
+    if '--construct' in sys.argv[1:]:
+        raw, text = construct()
+    else:
+        if not os.geteuid() == 0:
+            sys.exit('Must be run as root (sudo), or use --construct')
+        raw, text = record()
+    os.makedirs(datadir, exist_ok=True)
+    # mtime=0 keeps the fixture bytes reproducible
+    with gzip.GzipFile(raw_fixture, 'wb', mtime=0) as f:
+        f.write(raw)
+    with gzip.GzipFile(text_fixture, 'wb', mtime=0) as f:
+        f.write(text)
+    print('{}: {} bytes\n{}: {} lines'.format(raw_fixture, len(raw), text_fixture,
+                                              text.count(b'\n')))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+"""
+Binary blktrace ingestion against blkparse text.
+
+The fixture in data/ is constructed by record_blktrace.py --construct, which
+also renders its text, so comparing the two parsers on it checks they agree
+with each other and not with blkparse. RealLine checks both against a line of
+real blkparse -q output. Needs neither root nor a device:
+python3 -m unittest discover tests
+
+##License:
+Original work Copyright 2016 Richard Case
+
+Everyone is permitted to copy, distribute and modify this software,
+subject to this statement and the copyright notice above being included.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND.
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
+"""
+import os, io, sys, gzip, unittest, subprocess
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import btrace
+from btrace import BtraceParser, BtraceFormatError, PidFilter
+import record_blktrace
+
+datadir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+raw_fixture = os.path.join(datadir, 'loop.blktrace.gz')
+text_fixture = os.path.join(datadir, 'loop.blkparse.gz')
+
+def parse(path, chunksize=None):
+    "Returns the parser after reading a whole capture, as replay.py does."
+    with btrace.open_capture(path) as source:
+        parser = BtraceParser(source)
+        if chunksize is not None:
+            parser.chunksize = chunksize
+        parser.read_btrace()
+    return parser
+
+class RawTrace(unittest.TestCase):
+    def test_capture_types(self):
+        "open_capture tells binary from text captures by the magic."
+        with btrace.open_capture(raw_fixture) as source:
+            self.assertTrue(BtraceParser(source).raw)
+        with btrace.open_capture(text_fixture) as source:
+            self.assertFalse(BtraceParser(source).raw)
+
+    def test_raw_matches_text(self):
+        "The binary path gives the stats, extents & latencies of the text path."
+        # A consistency check: both inputs come from record_blktrace.py
+        text = parse(text_fixture)
+        raw = parse(raw_fixture)
+        self.assertGreater(text.stats['read_lines'], 0)
+        self.assertEqual(raw.stats, text.stats)
+        self.assertEqual(raw.extents, text.extents)
+        self.assertEqual(raw.latency.todict(), text.latency.todict())
+
+    def test_records_straddle_chunks(self):
+        "Records split across reads are kept until whole."
+        whole = parse(raw_fixture)
+        for chunksize in (1, 47, 100):
+            split = parse(raw_fixture, chunksize)
+            self.assertEqual(split.stats, whole.stats)
+            self.assertEqual(split.extents, whole.extents)
+
+    def test_bad_magic(self):
+        "Corrupt input raises BtraceFormatError with its offset in the stream."
+        with gzip.open(raw_fixture, 'rb') as f:
+            data = bytearray(f.read())
+        size = BtraceParser.trace_struct.size
+        # The first record is a process notify with a 16 byte name
+        bad = size + 16
+        data[bad:bad + 4] = b'\0\0\0\0'
+        parser = BtraceParser(io.BufferedReader(io.BytesIO(bytes(data))))
+        parser.chunksize = 7
+        with self.assertRaises(BtraceFormatError) as caught:
+            parser.read_btrace()
+        self.assertEqual(caught.exception.offset, bad)
+        self.assertEqual(caught.exception.magic, 0)
+
+# From a blkparse -q trace of testdisk on loop7, quoted in btrace.py
+real_line = '  7,0    0       12     0.005528571 30641  Q   R 12583104 + 8 [testdisk]\n'
+
+class RealLine(unittest.TestCase):
+    def setUp(self):
+        self.text = BtraceParser(io.TextIOWrapper(io.BytesIO(real_line.encode()),
+                                                    encoding='ascii'))
+        self.text.read_btrace()
+
+    def test_text(self):
+        "The text parser reads the fields of a real blkparse line."
+        self.assertEqual(self.text.extents, [(12583104, 8)])
+        self.assertEqual(self.text.stats['commands'], {'testdisk': 1})
+        self.assertEqual(self.text.stats['actions'], {'Q': 1})
+        self.assertEqual(self.text.stats['RWBS'], {'R': 1})
+        self.assertEqual(self.text.stats['R_sectors'], 8)
+
+    def test_raw(self):
+        "The same event packed as blk_io_trace records parses the same."
+        trace = BtraceParser.trace_struct
+        magic = BtraceParser.trace_magic | 7
+        device = (7 << 20) | 0
+        name = b'testdisk'.ljust(16, b'\0')
+        raw = (trace.pack(magic, 0, 0, 0, 0,
+                    BtraceParser.BLK_TC_NOTIFY | BtraceParser.BLK_TN_PROCESS,
+                    30641, device, 0, 0, len(name)) + name +
+               trace.pack(magic, 12, 5528571, 12583104, 8 * 512,
+                    BtraceParser.trace_actions.index('Q'), 30641, device, 0, 0, 0))
+        parser = BtraceParser(io.BufferedReader(io.BytesIO(raw)))
+        parser.read_btrace()
+        self.assertEqual(parser.stats, self.text.stats)
+        self.assertEqual(parser.extents, self.text.extents)
+
+    def test_fixture_format(self):
+        "record_blktrace.py renders the line as blkparse printed it."
+        self.assertEqual(record_blktrace.text_line.format(7, 0, 0, 12, 0, 5528571,
+                            30641, 'Q', 'R', '12583104 + 8 [testdisk]'), real_line)
+
+def gone_pid(command):
+    "Returns the pid of a command that has exited."
+    proc = subprocess.Popen([command], stdout=subprocess.DEVNULL)
+    proc.wait()
+    return proc.pid
+
+class OwnIo(unittest.TestCase):
+    def setUp(self):
+        self.shell = subprocess.Popen(['sh', '-c', 'sleep 30 & wait'])
+        self.pidfilter = PidFilter([self.shell.pid], exact=(os.getpid(),))
+
+    def tearDown(self):
+        subprocess.call(['pkill', '-P', str(self.shell.pid)])
+        self.shell.kill()
+        self.shell.wait()
+
+    def scan_child(self):
+        "Scans until the shell's sleep child is recorded, returns its pid."
+        for _ in range(100):
+            self.pidfilter.scan()
+            children = self.pidfilter.pids - {self.shell.pid}
+            # Until it execs, the child still has the shell's name
+            if children and 'sleep' in self.pidfilter.commands:
+                return children.pop()
+            subprocess.call(['sleep', '0.02'])
+        self.fail('scan() did not find the child of the tracked shell')
+
+    def test_scanned_child(self):
+        "A descendant recorded by scan() is admitted after it exits."
+        child = self.scan_child()
+        subprocess.call(['kill', str(child)])
+        self.shell.wait()
+        self.assertEqual(self.pidfilter.admit(child, 'sleep'), True)
+
+    def test_gone_commands(self):
+        "A gone pid never seen is admitted only for a command the tool runs."
+        self.scan_child()
+        # Not the tool's own name, which a just forked child still has
+        self.assertEqual(self.pidfilter.commands, {'sh', 'sleep'})
+        self.assertIs(self.pidfilter.admit(gone_pid('true'), 'sleep'), PidFilter.GONE)
+        self.assertEqual(self.pidfilter.admit(gone_pid('true'), 'blkid'), False)
+
+    def test_gone_stats(self):
+        "Admitted gone pids and rejected ones are counted apart."
+        self.scan_child()
+        parser = BtraceParser(io.BufferedReader(io.BytesIO(b'')))
+        parser.pidfilter = self.pidfilter
+        self.assertTrue(parser.admitted('Q', gone_pid('true'), 'sleep', 8))
+        self.assertFalse(parser.admitted('Q', gone_pid('true'), 'blkid', 16))
+        self.assertEqual(parser.stats['unverified_sectors'], 8)
+        self.assertEqual(parser.stats['rejected_sectors'], 16)
+        self.assertEqual(parser.stats['rejected_commands'], {'blkid': 1})
+
+if __name__ == '__main__':
+    unittest.main()
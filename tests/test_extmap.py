@@ -0,0 +1,65 @@
+"""
+Native ext2/3/4 allocation map against the filesystem, see fsimage.py.
+
+Besides the common checks, the map must be exactly the complement of the free
+block ranges dumpe2fs lists per block group.
+
+##License:
+Original work Copyright 2016 Richard Case
+
+Everyone is permitted to copy, distribute and modify this software,
+subject to this statement and the copyright notice above being included.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND.
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
+"""
+import re, shutil, unittest, subprocess
+from fsimage import NativeMapCheck
+import extentops
+
+_pat_free = re.compile(r"^\s+Free blocks: (.*)$", re.MULTILINE)
+
+def dumpe2fs_free(path):
+    "Returns (block size, free block runs) from dumpe2fs."
+    out = subprocess.check_output(['dumpe2fs', path],
+                                    stderr=subprocess.DEVNULL).decode()
+    blocksize = int(re.search(r"^Block size:\s+(\d+)", out, re.MULTILINE).group(1))
+    extents = []
+    for ranges in _pat_free.findall(out):
+        for item in ranges.split(','):
+            item = item.strip()
+            if not item:
+                continue
+            first, _, last = item.partition('-')
+            last = last or first
+            extents.append((int(first), int(last) - int(first) + 1))
+    return blocksize, extentops.from_extents(extents)
+
+class ExtCheck(NativeMapCheck):
+    def test_dumpe2fs(self):
+        "The map is the complement of dumpe2fs's free blocks."
+        if shutil.which('dumpe2fs') is None:
+            self.skipTest('dumpe2fs is not installed')
+        blocksize, free = dumpe2fs_free(self.image.path)
+        per = blocksize // 512
+        free = extentops.from_extents((start * per, n * per)
+                                        for start, n in extentops.extents(free))
+        expected = extentops.complement(free, 0, self.image.sectors)
+        self.assertEqual(extentops.extents(self.used), extentops.extents(expected))
+
+class Ext2(ExtCheck, unittest.TestCase):
+    fstype = 'ext2'
+
+class Ext3(ExtCheck, unittest.TestCase):
+    fstype = 'ext3'
+
+class Ext4(ExtCheck, unittest.TestCase):
+    fstype = 'ext4'
+
+class Ext4Large(ExtCheck, unittest.TestCase):
+    "4KiB blocks and several flex groups."
+    fstype = 'ext4'
+    mbytes = 600
+
+if __name__ == '__main__':
+    unittest.main()
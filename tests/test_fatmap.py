@@ -0,0 +1,29 @@
+"""
+Native FAT and exFAT allocation maps against the filesystem, see fsimage.py.
+
+##License:
+Original work Copyright 2016 Richard Case
+
+Everyone is permitted to copy, distribute and modify this software,
+subject to this statement and the copyright notice above being included.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND.
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
+"""
+import unittest
+from fsimage import NativeMapCheck
+
+class Fat16(NativeMapCheck, unittest.TestCase):
+    "mkfs.fat picks FAT16 for small volumes."
+    fstype = 'vfat'
+
+class Fat32(NativeMapCheck, unittest.TestCase):
+    "mkfs.fat picks FAT32 from 512MB."
+    fstype = 'vfat'
+    mbytes = 600
+
+class Exfat(NativeMapCheck, unittest.TestCase):
+    fstype = 'exfat'
+
+if __name__ == '__main__':
+    unittest.main()
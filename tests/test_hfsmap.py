@@ -0,0 +1,21 @@
+"""
+Native HFS+ allocation map against the filesystem, see fsimage.py.
+
+##License:
+Original work Copyright 2016 Richard Case
+
+Everyone is permitted to copy, distribute and modify this software,
+subject to this statement and the copyright notice above being included.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND.
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
+"""
+import unittest
+from fsimage import NativeMapCheck
+
+class Hfsplus(NativeMapCheck, unittest.TestCase):
+    "mkfs.hfsplus makes an unjournaled volume, which Linux mounts read-write."
+    fstype = 'hfsplus'
+
+if __name__ == '__main__':
+    unittest.main()
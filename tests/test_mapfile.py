@@ -0,0 +1,152 @@
+"""
+Mapfile reading, writing and the ddrescuelog operations, on hand-built maps.
+
+The expected results follow the operations as documented in mapfile.py.
+
+##License:
+Original work Copyright 2016 Richard Case
+
+Everyone is permitted to copy, distribute and modify this software,
+subject to this statement and the copyright notice above being included.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND.
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
+"""
+import os, sys, shutil, tempfile, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mapfile, ddrescue
+
+header_text = ('# Mapfile. Created by ddrescue_used v0.6.0\n'
+               '# ddrescue_used Command line: ./ddrescue_used.py /dev/sdz /mnt\n'
+               '# current_pos  current_status  current_pass\n'
+               '0x00004000     +               1\n')
+
+# 0x0000-0x1000 finished, 0x1000-0x3000 bad, 0x3000-0x4000 non-trimmed,
+# 0x4000-0x6000 finished
+map_a = [(0x0, 0x1000, '+'), (0x1000, 0x2000, '-'), (0x3000, 0x1000, '*'),
+         (0x4000, 0x2000, '+')]
+# Different boundaries and longer: 0x0800-0x3800 finished, then non-scraped
+map_b = [(0x0, 0x800, '?'), (0x800, 0x3000, '+'), (0x3800, 0x3800, '/')]
+
+def write_map(path, runs, header=header_text):
+    with open(path, 'w') as f:
+        f.write(header)
+        f.write('#      pos        size  status\n')
+        for pos, size, status in runs:
+            f.write(mapfile.line(pos, size, status))
+
+class MapfileCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='mapfile.')
+        self.a = os.path.join(self.tmp, 'a.log')
+        self.b = os.path.join(self.tmp, 'b.log')
+        write_map(self.a, map_a)
+        write_map(self.b, map_b)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+class Reading(MapfileCase):
+    def test_header(self):
+        "The header indexes the creator, magic, command and status line."
+        header = mapfile.read_header(self.a)
+        self.assertTrue(header.written_by('ddrescue_used', 'ddrescue_used'))
+        self.assertFalse(header.written_by('GNU ddrescue'))
+        self.assertEqual(header.command, './ddrescue_used.py /dev/sdz /mnt')
+        self.assertEqual((header.current_pos, header.current_status,
+                            header.current_pass), (0x4000, '+', 1))
+
+    def test_runs(self):
+        self.assertEqual(list(mapfile.runs(self.a)), map_a)
+
+    def test_bad_status(self):
+        write_map(self.a, [(0, 0x1000, 'x')])
+        with self.assertRaises(Exception):
+            list(mapfile.runs(self.a))
+
+    def test_no_status_line(self):
+        with open(self.a, 'w') as f:
+            f.write('# nothing here\n')
+        self.assertIsNone(mapfile.read_header(self.a))
+        self.assertEqual(list(mapfile.runs(self.a)), [])
+
+class Operations(MapfileCase):
+    def test_coalesce(self):
+        "Adjacent runs of one status join, empty runs go."
+        runs = [(0, 0x200, '+'), (0x200, 0, '-'), (0x200, 0x200, '+'),
+                (0x400, 0x200, '-'), (0x800, 0x200, '-')]
+        self.assertEqual(list(mapfile.coalesce(runs)),
+                            [(0, 0x400, '+'), (0x400, 0x200, '-'), (0x800, 0x200, '-')])
+
+    def test_and(self):
+        "Finished only where both are, else a's status, or b's where a is finished."
+        self.assertEqual(list(mapfile.and_runs(map_a, map_b)),
+                            [(0x0, 0x800, '?'), (0x800, 0x800, '+'),
+                             (0x1000, 0x2000, '-'), (0x3000, 0x1000, '*'),
+                             (0x4000, 0x2000, '/'), (0x6000, 0x1000, '?')])
+
+    def test_or(self):
+        "Finished where either is, else a's status; outside a map is non-tried."
+        self.assertEqual(list(mapfile.or_runs(map_a, map_b)),
+                            [(0x0, 0x3800, '+'), (0x3800, 0x800, '*'),
+                             (0x4000, 0x2000, '+'), (0x6000, 0x1000, '?')])
+
+    def test_xor(self):
+        "Finished where exactly one is, non-tried where both are."
+        self.assertEqual(list(mapfile.xor_runs(map_a, map_b)),
+                            [(0x0, 0x800, '+'), (0x800, 0x800, '?'),
+                             (0x1000, 0x2800, '+'), (0x3800, 0x800, '*'),
+                             (0x4000, 0x2000, '+'), (0x6000, 0x1000, '?')])
+
+    def test_invert(self):
+        self.assertEqual(list(mapfile.invert_runs(map_a)),
+                            [(0x0, 0x1000, '?'), (0x1000, 0x3000, '+'),
+                             (0x4000, 0x2000, '?')])
+
+    def test_change(self):
+        "Each character of old maps to the one at the same place in new."
+        self.assertEqual(list(mapfile.change_runs(map_a, '-*', '??')),
+                            [(0x0, 0x1000, '+'), (0x1000, 0x3000, '?'),
+                             (0x4000, 0x2000, '+')])
+        with self.assertRaises(Exception):
+            list(mapfile.change_runs(map_a, '-*', '?'))
+
+    def test_overlap(self):
+        with self.assertRaises(Exception):
+            list(mapfile.or_runs([(0, 0x1000, '+'), (0x800, 0x1000, '-')], map_b))
+
+class Writing(MapfileCase):
+    def test_round_trip(self):
+        "write_runs keeps the header and the runs read back unchanged."
+        out = os.path.join(self.tmp, 'out.log')
+        mapfile.write_runs(out, mapfile.read_header(self.a), mapfile.runs(self.a))
+        self.assertEqual(list(mapfile.runs(out)), map_a)
+        header, written = mapfile.read_header(self.a), mapfile.read_header(out)
+        self.assertEqual(written.comments, header.comments)
+        self.assertEqual((written.current_pos, written.current_status,
+                            written.current_pass), (0x4000, '+', 1))
+        self.assertFalse(os.path.exists(out + '.tmp'))
+
+    def test_rewrite(self):
+        "rewrite applies an operation in place, keeping the header."
+        mapfile.rewrite(self.a, 'and', self.b)
+        self.assertEqual(list(mapfile.runs(self.a)),
+                            list(mapfile.and_runs(map_a, map_b)))
+        self.assertEqual(mapfile.read_header(self.a).command,
+                            './ddrescue_used.py /dev/sdz /mnt')
+
+    def test_logop(self):
+        "ddrescue.logop rewrites the ddrescue log."
+        saved = ddrescue.ddrlog
+        ddrescue.ddrlog = self.a
+        try:
+            ddrescue.logop(None, 'change', '-', '?')
+            ddrescue.logop(None, 'invert')
+        finally:
+            ddrescue.ddrlog = saved
+        self.assertEqual(list(mapfile.runs(self.a)),
+                            [(0x0, 0x1000, '?'), (0x1000, 0x3000, '+'),
+                             (0x4000, 0x2000, '?')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,22 @@
+"""
+Native NTFS allocation map against the filesystem, see fsimage.py.
+
+##License:
+Original work Copyright 2016 Richard Case
+
+Everyone is permitted to copy, distribute and modify this software,
+subject to this statement and the copyright notice above being included.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND.
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
+"""
+import unittest
+from fsimage import NativeMapCheck
+
+class Ntfs(NativeMapCheck, unittest.TestCase):
+    fstype = 'ntfs'
+    # The backup boot sector and the part cluster after the last cluster
+    slack_blocks = 2
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+"""
+The trace worker's shared memory extent snapshot.
+
+##License:
+Original work Copyright 2016 Richard Case
+
+Everyone is permitted to copy, distribute and modify this software,
+subject to this statement and the copyright notice above being included.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND.
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
+"""
+import os, sys, unittest, multiprocessing
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from extents import ExtentStore
+from traceworker import Snapshot
+
+def scattered_store(count):
+    store = ExtentStore()
+    for i in range(count):
+        store.add(16 * i, 1 + i % 8)
+    return store
+
+def _publish(snapshot, count):
+    snapshot.publish(scattered_store(count))
+
+class SnapshotCase(unittest.TestCase):
+    def test_round_trip(self):
+        snapshot = Snapshot()
+        self.assertEqual(snapshot.read(), [])
+        store = scattered_store(1000)
+        snapshot.publish(store)
+        self.assertEqual(snapshot.read(), store.tolist())
+
+    def test_grows_across_fork(self):
+        "A writer in a forked process grows the snapshot past its first size."
+        snapshot = Snapshot(size=4096)
+        count = 100000
+        process = multiprocessing.get_context('fork').Process(
+                        target=_publish, args=(snapshot, count))
+        process.start()
+        process.join()
+        self.assertEqual(process.exitcode, 0)
+        self.assertEqual(snapshot.read(), scattered_store(count).tolist())
+
+if __name__ == '__main__':
+    unittest.main()
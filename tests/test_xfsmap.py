@@ -0,0 +1,42 @@
+"""
+Native XFS allocation map against the filesystem, see fsimage.py.
+
+statvfs leaves out the reserved block pool and counts the AG free lists, so
+the free space is compared with the total of the free space btrees from xfs_db
+instead, which is what the map is read from.
+
+##License:
+Original work Copyright 2016 Richard Case
+
+Everyone is permitted to copy, distribute and modify this software,
+subject to this statement and the copyright notice above being included.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND.
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
+"""
+import re, shutil, unittest, subprocess
+from fsimage import NativeMapCheck
+import extentops
+
+def xfs_db_free_blocks(path):
+    "Returns the free blocks in the free space btrees from xfs_db."
+    out = subprocess.check_output(['xfs_db', '-r', '-c', 'freesp -s', path],
+                                    stderr=subprocess.DEVNULL).decode()
+    return int(re.search(r"total free blocks (\d+)", out).group(1))
+
+class Xfs(NativeMapCheck, unittest.TestCase):
+    fstype = 'xfs'
+    # mkfs.xfs refuses volumes under 300MB
+    mbytes = 320
+
+    def test_free_space(self):
+        "The space not in the used map is the free space btrees' total."
+        if shutil.which('xfs_db') is None:
+            self.skipTest('xfs_db is not installed')
+        free = 512 * (self.image.sectors - extentops.sectors(self.used))
+        self.assertAlmostEqual(free, self.image.blocksize *
+                                        xfs_db_free_blocks(self.image.path),
+                                delta=self.slack_blocks * self.image.blocksize)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+"""
+Runs the btrace parser in a worker process, off the state machine thread.
+
+The worker reads the blktrace/blkparse pipe in large non-blocking chunks,
+merges extents and writes the throttled btrace log. After every log flush it
+publishes the merged extents into a shared memory snapshot and sends the stats
+to the main process, which only has to collect messages on each poll.
+
+##License:
+Original work Copyright 2016 Richard Case
+
+Everyone is permitted to copy, distribute and modify this software,
+subject to this statement and the copyright notice above being included.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND.
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
+"""
+import os, mmap, select, signal, struct, time, logging, gzip, shutil
+import multiprocessing
+from array import array
+import btrace, coalesce, helpers
+
+class Snapshot(object):
+    """Shared memory extent list guarded by a sequence lock.
+
+    Layout: sequence number, number of runs, then the start sectors and the
+    next sectors as uint64 arrays, copied straight from the store's runs. The
+    sequence is odd while a write is in progress. The memory file is shared
+    with processes forked after creation and is only backed by memory as far
+    as it is written. The writer grows it to fit the store and readers map
+    the new size when they find more runs than they can see.
+    """
+    header = struct.Struct('=QQ')
+    def __init__(self, size=1024**2):
+        self.fd = os.memfd_create('btrace-snapshot')
+        os.ftruncate(self.fd, size)
+        self.mem = mmap.mmap(self.fd, size)
+        self.header.pack_into(self.mem, 0, 0, 0)
+
+    def _remap(self, size):
+        self.mem.close()
+        self.mem = mmap.mmap(self.fd, size)
+
+    def publish(self, store):
+        "Writer side: copies the store into the snapshot."
+        starts, nexts = store.runs()
+        nbytes = starts.itemsize * len(starts)
+        size = self.header.size + 2 * nbytes
+        if size > len(self.mem):
+            # Doubling keeps the number of remaps low as the store grows
+            size = max(size, 2 * len(self.mem))
+            os.ftruncate(self.fd, size)
+            self._remap(size)
+            logging.debug('Snapshot: grown to {} bytes for {} extents'
+                            .format(size, len(starts)))
+        seq = self.header.unpack_from(self.mem, 0)[0]
+        self.header.pack_into(self.mem, 0, seq + 1, 0)
+        offset = self.header.size
+        self.mem[offset:offset + nbytes] = starts
+        self.mem[offset + nbytes:offset + 2 * nbytes] = nexts
+        self.header.pack_into(self.mem, 0, seq + 2, len(starts))
+
+    def read(self, retries=100):
+        "Reader side: returns a consistent list of (start, n) tuples."
+        for _ in range(retries):
+            seq, nruns = self.header.unpack_from(self.mem, 0)
+            if seq & 1 == 0:
+                offset = self.header.size
+                nbytes = 8 * nruns
+                if offset + 2 * nbytes > len(self.mem):
+                    # The writer has grown the memory file
+                    self._remap(os.fstat(self.fd).st_size)
+                    continue
+                starts = array('Q', self.mem[offset:offset + nbytes])
+                nexts = array('Q', self.mem[offset + nbytes:offset + 2 * nbytes])
+                if self.header.unpack_from(self.mem, 0)[0] == seq:
+                    return [(start, nxt - start) for start, nxt in zip(starts, nexts)]
+            time.sleep(0.001)
+        raise Exception('Snapshot: could not read a consistent extent list')
+
+def _command(parser, cmd):
+    "Handles a command sent by TraceWorker."
+    if cmd[0] == 'add':
+        parser.add_extent(*cmd[1:])
+    elif cmd[0] == 'pid' and parser.pidfilter is not None:
+        parser.pidfilter.add_pid(cmd[1])
+
+def _work(reader, raw, conn, snapshot, options, devsize, copies, capture):
+    "Worker process main loop, exits once the trace reaches EOF."
+    # Ctrl-C and hangups are for the main process, which stops blktrace
+    for sig in (signal.SIGINT, signal.SIGHUP, signal.SIGQUIT):
+        signal.signal(sig, signal.SIG_IGN)
+    parser = btrace.BtraceParser(reader, raw)
+    if options.ownio:
+        # Processes started before the fork are inherited, later ones are sent
+        parser.pidfilter = btrace.PidFilter(helpers.SPAWNED, exact=(os.getppid(),))
+    if capture is not None:
+        # Fast compression keeps up with the trace; replay with replay.py
+        parser.capture = gzip.open(capture, 'wb', compresslevel=1)
+    fd = reader.stdout.fileno()
+    events = 0
+    while not parser.eof:
+        select.select([fd, conn], [], [], 0.1)
+        while conn.poll():
+            _command(parser, conn.recv())
+        if parser.pidfilter is not None:
+            # Record children of tracked pids before they exit
+            parser.pidfilter.scan()
+        events += parser.read_btrace()
+        # unused are marked finished so the metadata rescue only reads
+        # the traced extents
+        if parser.update_ddrescuelog(options, 'non-tried', 'finished',
+                                        0, devsize, copies):
+            snapshot.publish(parser.store)
+            conn.send(('update', parser.get_stats(), parser.usedlog, events))
+            events = 0
+    while conn.poll():
+        _command(parser, conn.recv())
+    parser.update_ddrescuelog(options, 'non-tried', 'finished',
+                                0, devsize, copies, force=True)
+    if coalesce.active(options):
+        # The live log is exact, the final one handed to ddrescue is coalesced
+        parser.write_ddrescuelog(options, 'non-tried', 'finished', 0, devsize)
+        for path in copies:
+            shutil.copyfile(parser.usedlog, path)
+    if parser.capture is not None:
+        parser.capture.close()
+    snapshot.publish(parser.store)
+    conn.send(('final', parser.get_stats(), parser.usedlog, events))
+    conn.close()
+
+class TraceWorker(object):
+    """Main process handle on a BtraceParser running in a worker process.
+
+    Offers the parts of the BtraceParser interface the tool uses.
+    """
+    def __init__(self, reader, raw, options, devsize, copies=(), capture=None):
+        """copies - other paths the btrace log is written to
+        capture - path to record the compressed raw trace stream to
+        """
+        # fork so the reader pipe and the snapshot mapping are inherited
+        context = multiprocessing.get_context('fork')
+        self.conn, child_conn = context.Pipe()
+        self.snapshot = Snapshot()
+        self.process = context.Process(target=_work, name='btrace',
+                        args=(reader, raw, child_conn, self.snapshot,
+                              options, devsize, list(copies), capture),
+                        daemon=True)
+        self.process.start()
+        child_conn.close()
+        logging.debug('TraceWorker: started pid {}'.format(self.process.pid))
+        self.stats = {}
+        self.usedlog = None
+        self.done = False
+        # True if the worker exited without its final update
+        self.died = False
+
+    def add_extent(self, start, n):
+        "Queues a used extent for the worker's extent store."
+        if start < 0 or n < 0:
+            raise Exception('add_extent: Input less than zero: {}:{}'
+                                .format(start, n))
+        self.conn.send(('add', start, n))
+
+    def add_pid(self, pid):
+        "Tells the worker's pid filter about a process the tool started."
+        if not self.done:
+            self.conn.send(('pid', pid))
+
+    def read_btrace(self):
+        "Collects published updates without blocking, returns the new event count."
+        events = 0
+        while not self.done and self.conn.poll():
+            try:
+                kind, self.stats, self.usedlog, count = self.conn.recv()
+            except EOFError:
+                logging.error('TraceWorker: worker exited without a final update')
+                self.done = True
+                self.died = True
+                break
+            events += count
+            if kind == 'final':
+                self.done = True
+                self.process.join()
+        if events > 0:
+            logging.info('read_btrace: lines read = {}'.format(events))
+        return events
+
+    def finished(self):
+        "Returns True once the worker has published its final update."
+        self.read_btrace()
+        if not self.done and not self.process.is_alive():
+            # Pick up a final message sent just before exit
+            self.read_btrace()
+            if not self.done:
+                logging.error('TraceWorker: worker died, exit code {}'
+                                .format(self.process.exitcode))
+                self.done = True
+                self.died = True
+        return self.done
+
+    @property
+    def extents(self):
+        "Sorted list of (start_sector, n_sectors) tuples from the last snapshot."
+        return self.snapshot.read()
+
+    def get_stats(self):
+        "Returns the stats from the last update."
+        return self.stats
+
+    def pprint_stats(self):
+        btrace.pprint_stats(self.stats)
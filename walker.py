@@ -0,0 +1,112 @@
+"""
+Filesystem tree walker used for mapping files and reading every inode.
+
+Built on os.scandir, so the directory entry types and inode numbers come free
+with the directory read. Each inode is yielded once: further hardlinks to an
+already seen (st_dev, st_ino) are skipped so their extents are not mapped again.
+
+With inode ordering, directories are visited lowest inode first and the entries
+of each directory are stat'ed in inode number order. On most filesystems inode
+numbers follow their position on disk, so the walk reads the inode tables
+mostly sequentially instead of seeking in name order.
+
+The walk order only depends on the directory contents, so a walk of an
+unchanged filesystem can be continued: position counts the directory entries
+visited and a new walk skips that many without stat'ing them.
+
+##License:
+Original work Copyright 2016 Richard Case
+
+Everyone is permitted to copy, distribute and modify this software,
+subject to this statement and the copyright notice above being included.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND.
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
+"""
+import os, stat, time, heapq, logging
+
+class Walker(object):
+    """Yields (path, lstat result) for every file, directory and link under root.
+
+    The root itself is not yielded. Unreadable directories are logged and skipped.
+    """
+    def __init__(self, root, inode_order=False, skip=0):
+        """skip - number of entries to pass over, the position of an earlier walk;
+                  hardlinks seen in that part are not known to the new walk"""
+        self.root = root
+        self.inode_order = inode_order
+        self.skip = skip
+        self.position = 0
+        self.seen = set()
+        self.entries = 0
+        self.dirs = 0
+        self.hardlinks = 0
+        self.errors = 0
+        self.elapsed = 0.0
+
+    def _scan(self, dirpath):
+        "Returns the directory's entries, in inode order if required."
+        try:
+            with os.scandir(dirpath) as it:
+                entries = list(it)
+        except OSError as e:
+            logging.debug('Walker: cannot read {}: {}'.format(dirpath, e))
+            self.errors += 1
+            return []
+        if self.inode_order:
+            entries.sort(key=lambda entry: entry.inode())
+        return entries
+
+    def __iter__(self):
+        start = time.monotonic()
+        # Pending directories as (inode, path); a plain stack unless inode ordered
+        pending = [(0, self.root)]
+        try:
+            while pending:
+                if self.inode_order:
+                    dirpath = heapq.heappop(pending)[1]
+                else:
+                    dirpath = pending.pop()[1]
+                self.dirs += 1
+                for entry in self._scan(dirpath):
+                    self.position += 1
+                    # Directory type & inode come from the directory read, so
+                    # skipped entries are queued the same without a stat
+                    try:
+                        isdir = entry.is_dir(follow_symlinks=False)
+                    except OSError:
+                        isdir = False
+                    if isdir:
+                        if self.inode_order:
+                            heapq.heappush(pending, (entry.inode(), entry.path))
+                        else:
+                            pending.append((entry.inode(), entry.path))
+                    if self.position <= self.skip:
+                        continue
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError as e:
+                        logging.debug('Walker: cannot stat {}: {}'
+                                        .format(entry.path, e))
+                        self.errors += 1
+                        continue
+                    if st.st_nlink > 1 and not stat.S_ISDIR(st.st_mode):
+                        key = (st.st_dev, st.st_ino)
+                        if key in self.seen:
+                            self.hardlinks += 1
+                            continue
+                        self.seen.add(key)
+                    self.entries += 1
+                    yield (entry.path, st)
+        finally:
+            self.elapsed = time.monotonic() - start
+            logging.info('Walked {}'.format(self.report()))
+
+    def report(self):
+        "Returns a one line summary of the walk and its throughput."
+        rate = self.entries / self.elapsed if self.elapsed > 0 else 0
+        return ('{}: {} entries in {} dirs in {:.1f}s ({:.0f}/s), '
+                '{} hardlinks skipped, {} errors, {} resumed past'
+                    .format(self.root, self.entries, self.dirs, self.elapsed,
+                            rate, self.hardlinks, self.errors,
+                            min(self.skip, self.position)))
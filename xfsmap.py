@@ -0,0 +1,118 @@
+"""
+XFS used blocks from the per allocation group free space B+trees.
+
+Each AG's AGF gives the root of its bnobt, the free extents sorted by block
+number. The leftmost path is followed down to the leaf level and the leaves
+are read along their right sibling links, so every AG is one ordered walk. The
+used blocks are the gaps between free extents, which include the AG headers,
+free list and all B+tree blocks. Both v4 and v5 (CRC) btree blocks are read;
+the realtime and external log devices are not part of the partition.
+
+##License:
+Original work Copyright 2016 Richard Case
+
+Everyone is permitted to copy, distribute and modify this software,
+subject to this statement and the copyright notice above being included.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND.
+IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM.
+"""
+import struct, logging
+
+XFS_SB_MAGIC = b'XFSB'
+XFS_AGF_MAGIC = b'XAGF'
+XFS_ABTB_MAGIC = b'ABTB'
+XFS_ABTB_CRC_MAGIC = b'AB3B'
+NULLAGBLOCK = 0xFFFFFFFF
+# Short form btree block header sizes, without and with CRC
+BTREE_SBLOCK_LEN = 16
+BTREE_SBLOCK_CRC_LEN = 56
+XFS_BTREE_MAXLEVELS = 9
+
+class Superblock(object):
+    "The XFS superblock fields needed to find each AG's free space btree."
+    def __init__(self, data):
+        if data[:4] != XFS_SB_MAGIC:
+            raise Exception('Bad XFS superblock magic: {!r}'.format(data[:4]))
+        self.blocksize, self.dblocks = struct.unpack_from('>IQ', data, 0x04)
+        self.agblocks, self.agcount = struct.unpack_from('>II', data, 0x54)
+        self.versionnum, self.sectsize = struct.unpack_from('>HH', data, 0x64)
+        self.crc = (self.versionnum & 0xF) == 5
+
+class FreeSpaceTree(object):
+    "Reader for one AG's by-block-number free space btree."
+    def __init__(self, volume, sb, agno):
+        self.volume = volume
+        self.sb = sb
+        self.agno = agno
+        self.agstart = agno * sb.agblocks * sb.blocksize
+        agf = volume.read(self.agstart + sb.sectsize, 64)
+        if agf[:4] != XFS_AGF_MAGIC:
+            raise Exception('Bad AGF magic in AG {}: {!r}'.format(agno, agf[:4]))
+        seqno, self.length, self.root = struct.unpack_from('>III', agf, 0x08)
+        self.levels = struct.unpack_from('>I', agf, 0x1C)[0]
+        if seqno != agno or not 0 < self.levels <= XFS_BTREE_MAXLEVELS:
+            raise Exception('Bad AGF in AG {}: seqno {} levels {}'
+                                .format(agno, seqno, self.levels))
+        self.hdrlen = BTREE_SBLOCK_CRC_LEN if sb.crc else BTREE_SBLOCK_LEN
+        self.magic = XFS_ABTB_CRC_MAGIC if sb.crc else XFS_ABTB_MAGIC
+
+    def read_block(self, agbno, level):
+        "Returns (block data, numrecs, right sibling) of a btree block."
+        if agbno >= self.length:
+            raise Exception('bnobt block {} outside AG {}'.format(agbno, self.agno))
+        data = self.volume.read(self.agstart + agbno * self.sb.blocksize,
+                                self.sb.blocksize)
+        if data[:4] != self.magic:
+            raise Exception('Bad bnobt magic in AG {} block {}: {!r}'
+                                .format(self.agno, agbno, data[:4]))
+        blevel, numrecs, rightsib = struct.unpack_from('>HHxxxxI', data, 4)
+        if blevel != level:
+            raise Exception('bnobt level {} found, {} expected in AG {} block {}'
+                                .format(blevel, level, self.agno, agbno))
+        return data, numrecs, rightsib
+
+    def free_extents(self):
+        "Yields (AG block, count) free extents in block order."
+        agbno = self.root
+        # Down the leftmost path: the first pointer of each node
+        for level in range(self.levels - 1, 0, -1):
+            data, numrecs, rightsib = self.read_block(agbno, level)
+            maxrecs = (self.sb.blocksize - self.hdrlen) // 12
+            agbno = struct.unpack_from('>I', data, self.hdrlen + 8 * maxrecs)[0]
+        leaves = 0
+        while agbno != NULLAGBLOCK:
+            data, numrecs, agbno = self.read_block(agbno, 0)
+            for rec in struct.iter_unpack('>II', data[self.hdrlen:
+                                                      self.hdrlen + 8 * numrecs]):
+                yield rec
+            leaves += 1
+            if leaves > self.length:
+                raise Exception('bnobt sibling loop in AG {}'.format(self.agno))
+
+def used_blocks(volume):
+    "Yields (first filesystem block, count) of used blocks."
+    sb = Superblock(volume.read(0, 512))
+    logging.debug('xfs: {} AGs of {} {}B blocks, v{}'
+                    .format(sb.agcount, sb.agblocks, sb.blocksize,
+                            sb.versionnum & 0xF))
+    for agno in range(sb.agcount):
+        tree = FreeSpaceTree(volume, sb, agno)
+        base = agno * sb.agblocks
+        prev = 0
+        for start, count in tree.free_extents():
+            if start < prev:
+                raise Exception('bnobt out of order in AG {} at block {}'
+                                    .format(agno, start))
+            if start > prev:
+                yield (base + prev, start - prev)
+            prev = start + count
+        if tree.length > prev:
+            yield (base + prev, tree.length - prev)
+
+def used_extents(volume):
+    "Yields used (start, n_sectors) extents."
+    blocksize = Superblock(volume.read(0, 512)).blocksize
+    factor = blocksize // 512
+    for start, n in used_blocks(volume):
+        yield (start * factor, n * factor)